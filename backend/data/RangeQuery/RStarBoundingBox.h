@@ -102,6 +102,18 @@ struct RStarBoundingBox {
 		return true;
 	}
 	
+	// like overlaps, but boxes that only touch, or have no extent on an axis, intersect as well
+	inline bool intersects(const RStarBoundingBox<dimensions>& bb) const
+	{
+		for (std::size_t axis = 0; axis < dimensions; axis++)
+		{
+			if (bb.edges[axis].second < edges[axis].first || edges[axis].second < bb.edges[axis].first)
+				return false;
+		}
+
+		return true;
+	}
+	
 	// calculates the total overlapping area of two boxes
 	double overlap(const RStarBoundingBox<dimensions>& bb) const
 	{
@@ -254,6 +266,20 @@ struct SortBoundedItemsBySecondEdge :
 };
 
 
+template <typename BoundedItem>
+struct SortBoundedItemsByCenter : 
+	public std::binary_function< const BoundedItem * const, const BoundedItem * const, bool >
+{
+	const std::size_t m_axis;
+	explicit SortBoundedItemsByCenter (const std::size_t axis) : m_axis(axis) {}
+
+	bool operator() (const BoundedItem * const bi1, const BoundedItem * const bi2) const 
+	{
+		return bi1->bound.edges[m_axis].first + bi1->bound.edges[m_axis].second < bi2->bound.edges[m_axis].first + bi2->bound.edges[m_axis].second;
+	}
+};
+
+
 template <typename BoundedItem>
 struct SortBoundedItemsByDistanceFromCenter : 
 	public std::binary_function< const BoundedItem * const, const BoundedItem * const, bool >
@@ -7,6 +7,11 @@
 #include <algorithm>
 #include <cassert>
 #include <functional>
+#include <cmath>
+#include <cstdint>
+#include <stdexcept>
+#include <thread>
+#include <exception>
 
 #include <iostream>
 #include <sstream>
@@ -82,10 +87,16 @@ public:
 	
 	// destructor
 	~RStarTree() { 
-		Remove(
-			AcceptAny(), 
-			RemoveLeaf()
-		);
+		Clear();
+	}
+
+	// deletes every node and leaf, the root included
+	void Clear()
+	{
+		if (m_root)
+			DeleteNode(m_root);
+		m_root = NULL;
+		m_size = 0;
 	}
 	
 	// Single insert function, adds a new item to the tree
@@ -115,6 +126,77 @@ public:
 		m_size += 1;
 	}
 
+	// Sort-Tile-Recursive bulk loading, replaces the content of the tree.
+	// Items are sorted into slabs along each axis in turn and packed into full nodes,
+	// the levels above are packed the same way from the nodes below. The packed tree
+	// is shallower and its nodes overlap less than one built by repeated Insert.
+	void BulkLoad(const std::vector< std::pair<LeafType, BoundingBox> > &leaves)
+	{
+		Clear();
+		if (leaves.empty())
+			return;
+
+		std::vector< BoundedItem* > items;
+		items.reserve(leaves.size());
+		for (std::size_t i = 0; i < leaves.size(); ++i)
+		{
+			Leaf * leaf = new Leaf();
+			leaf->leaf  = leaves[i].first;
+			leaf->bound = leaves[i].second;
+			items.push_back(leaf);
+		}
+		m_size = leaves.size();
+
+		bool hasLeaves = true;
+		do
+		{
+			std::vector< std::vector< BoundedItem* > > groups;
+			Tile(items.begin(), items.end(), 0, groups);
+
+			std::vector< BoundedItem* > nodes;
+			nodes.reserve(groups.size());
+			for (std::size_t i = 0; i < groups.size(); ++i)
+			{
+				Node * node = new Node();
+				node->hasLeaves = hasLeaves;
+				node->items.swap(groups[i]);
+				node->bound = node->items[0]->bound;
+				std::for_each(node->items.begin(), node->items.end(), StretchBoundingBox<BoundedItem>(&node->bound));
+				nodes.push_back(node);
+			}
+			items.swap(nodes);
+			hasLeaves = false;
+		} while (items.size() > 1);
+
+		m_root = static_cast<Node*>(items[0]);
+	}
+
+	// writes the tree in pre-order, writeLeaf(out, leaf) writes the bound and content of a leaf
+	template <typename LeafWriter>
+	void Write(std::ostream &out, LeafWriter writeLeaf) const
+	{
+		uint64_t size = m_size;
+		uint8_t hasRoot = m_root != NULL;
+		out.write(reinterpret_cast<const char*>(&size), sizeof(size));
+		out.write(reinterpret_cast<const char*>(&hasRoot), sizeof(hasRoot));
+		if (m_root)
+			WriteNode(out, m_root, writeLeaf);
+	}
+
+	// reads a tree written by Write, readLeaf(in, leaf) fills the bound and content of a leaf
+	template <typename LeafReader>
+	void Read(std::istream &in, LeafReader readLeaf)
+	{
+		Clear();
+		uint64_t size;
+		uint8_t hasRoot;
+		ReadValue(in, size);
+		ReadValue(in, hasRoot);
+		if (hasRoot)
+			m_root = ReadNode(in, readLeaf);
+		m_size = size;
+	}
+
 	template <typename Acceptor, typename Visitor>
 	Visitor Query(const Acceptor &accept, Visitor visitor)
 	{
@@ -127,6 +209,60 @@ public:
 		return visitor;
 	}
 
+	// Query split over up to `threads` threads. The accepted nodes of the first levels are
+	// divided into contiguous runs, each run is visited with its own copy of visitor and the
+	// copies are merged in order with visitor.Merge(copy), so the leaves reach the merged
+	// visitor in the same order as with Query. The tree must not be modified meanwhile.
+	template <typename Acceptor, typename Visitor>
+	Visitor ParallelQuery(const Acceptor &accept, Visitor visitor, std::size_t threads)
+	{
+		std::vector< BoundedItem* > frontier;
+		if (m_root && accept(m_root))
+			frontier.push_back(m_root);
+		// expand until there are several nodes per thread, all leaves are at the same depth
+		while (!frontier.empty() && frontier.size() < threads * 4 && !static_cast<Node*>(frontier[0])->hasLeaves)
+		{
+			std::vector< BoundedItem* > children;
+			for (std::size_t i = 0; i < frontier.size(); ++i)
+			{
+				Node * node = static_cast<Node*>(frontier[i]);
+				for (std::size_t j = 0; j < node->items.size(); ++j)
+					if (accept(static_cast<Node*>(node->items[j])))
+						children.push_back(node->items[j]);
+			}
+			frontier.swap(children);
+		}
+		threads = std::min(threads, frontier.size());
+		if (threads <= 1)
+			return Query(accept, visitor);
+
+		std::vector< Visitor > parts(threads, visitor);
+		std::vector< std::exception_ptr > errors(threads);
+		std::vector< std::thread > workers;
+		for (std::size_t t = 0; t < threads; ++t)
+		{
+			workers.push_back(std::thread([&, t]() {
+				try {
+					QueryFunctor<Acceptor, Visitor> query(accept, parts[t]);
+					std::size_t first = frontier.size() * t / threads, last = frontier.size() * (t + 1) / threads;
+					for (std::size_t i = first; i < last; ++i)
+						query(frontier[i]);
+				} catch (...) {
+					errors[t] = std::current_exception();
+				}
+			}));
+		}
+		for (std::size_t t = 0; t < threads; ++t)
+			workers[t].join();
+		for (std::size_t t = 0; t < threads; ++t)
+		{
+			if (errors[t])
+				std::rethrow_exception(errors[t]);
+			visitor.Merge(parts[t]);
+		}
+		return visitor;
+	}
+
 	template <typename Acceptor, typename LeafRemover>
 	void Remove( const Acceptor &accept, LeafRemover leafRemover)
 	{
@@ -171,6 +307,115 @@ public:
 	
 	
 protected:
+
+	void DeleteNode(Node * node)
+	{
+		for (std::size_t i = 0; i < node->items.size(); ++i)
+		{
+			if (node->hasLeaves)
+				delete static_cast<Leaf*>(node->items[i]);
+			else
+				DeleteNode(static_cast<Node*>(node->items[i]));
+		}
+		delete node;
+	}
+
+	// sorts [first, last) along axis and splits it into slabs of whole nodes, each slab is
+	// tiled along the next axis, the slabs along the last axis are cut into nodes
+	void Tile(typename std::vector< BoundedItem* >::iterator first, typename std::vector< BoundedItem* >::iterator last,
+		std::size_t axis, std::vector< std::vector< BoundedItem* > > &groups)
+	{
+		std::size_t n = last - first;
+		std::sort(first, last, SortBoundedItemsByCenter<BoundedItem>(axis));
+		if (axis + 1 == dimensions || n <= max_child_items)
+		{
+			for (std::size_t start = 0; start < n; start += max_child_items)
+				groups.push_back(std::vector< BoundedItem* >(first + start, first + std::min(n, start + max_child_items)));
+			return;
+		}
+		std::size_t pages = (n + max_child_items - 1) / max_child_items;
+		std::size_t slabs = (std::size_t)std::ceil(std::pow((double)pages, 1.0 / (dimensions - axis)));
+		std::size_t slabSize = (pages + slabs - 1) / slabs * max_child_items;
+		for (std::size_t start = 0; start < n; start += slabSize)
+			Tile(first + start, first + std::min(n, start + slabSize), axis + 1, groups);
+	}
+
+	template <typename T>
+	static void ReadValue(std::istream &in, T &value)
+	{
+		if (!in.read(reinterpret_cast<char*>(&value), sizeof(value)))
+			throw std::runtime_error("truncated tree data");
+	}
+
+	static void WriteBound(std::ostream &out, const BoundingBox &bound)
+	{
+		for (std::size_t axis = 0; axis < dimensions; axis++)
+		{
+			out.write(reinterpret_cast<const char*>(&bound.edges[axis].first), sizeof(double));
+			out.write(reinterpret_cast<const char*>(&bound.edges[axis].second), sizeof(double));
+		}
+	}
+
+	static void ReadBound(std::istream &in, BoundingBox &bound)
+	{
+		for (std::size_t axis = 0; axis < dimensions; axis++)
+		{
+			ReadValue(in, bound.edges[axis].first);
+			ReadValue(in, bound.edges[axis].second);
+		}
+	}
+
+	template <typename LeafWriter>
+	void WriteNode(std::ostream &out, const Node * node, LeafWriter &writeLeaf) const
+	{
+		uint8_t hasLeaves = node->hasLeaves;
+		uint32_t count = node->items.size();
+		out.write(reinterpret_cast<const char*>(&hasLeaves), sizeof(hasLeaves));
+		out.write(reinterpret_cast<const char*>(&count), sizeof(count));
+		WriteBound(out, node->bound);
+		for (std::size_t i = 0; i < node->items.size(); ++i)
+		{
+			if (node->hasLeaves)
+				writeLeaf(out, static_cast<const Leaf*>(node->items[i]));
+			else
+				WriteNode(out, static_cast<const Node*>(node->items[i]), writeLeaf);
+		}
+	}
+
+	template <typename LeafReader>
+	Node * ReadNode(std::istream &in, LeafReader &readLeaf)
+	{
+		uint8_t hasLeaves;
+		uint32_t count;
+		ReadValue(in, hasLeaves);
+		ReadValue(in, count);
+		if (count > max_child_items)
+			throw std::runtime_error("corrupted tree data");
+		Node * node = new Node();
+		node->hasLeaves = hasLeaves;
+		try
+		{
+			ReadBound(in, node->bound);
+			node->items.reserve(count);
+			for (uint32_t i = 0; i < count; ++i)
+			{
+				if (hasLeaves)
+				{
+					Leaf * leaf = new Leaf();
+					node->items.push_back(leaf);
+					readLeaf(in, leaf);
+				}
+				else
+					node->items.push_back(ReadNode(in, readLeaf));
+			}
+		}
+		catch (...)
+		{
+			DeleteNode(node);
+			throw;
+		}
+		return node;
+	}
 	
 	// choose subtree: only pass this items that do not have leaves
 	// I took out the loop portion of this algorithm, so it only
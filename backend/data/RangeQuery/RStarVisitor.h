@@ -31,9 +31,10 @@ struct RStarAcceptEnclosing
 	const typename Node::BoundingBox &m_bound;
 	explicit RStarAcceptEnclosing(const typename Node::BoundingBox &bound) : m_bound(bound) {}
 	
+	// a node holding only points on the query boundary may still hold enclosed leaves
 	bool operator()(const Node * const node) const 
 	{ 
-		return m_bound.overlaps(node->bound);
+		return m_bound.intersects(node->bound);
 	}
 	
 	bool operator()(const Leaf * const leaf) const 
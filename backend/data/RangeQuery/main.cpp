@@ -11,27 +11,87 @@ using namespace pybind11::literals; // to bring in the `_a` literal
 #include <stdio.h>
 #include <time.h>
 #include <functional>
+#include <sstream>
+#include <stdexcept>
+#include <set>
+#include <cstdint>
+#include <memory>
+#include <limits>
 #include "RStarTree.h"
 
 const int nIndexedDims = 5;
 const int nLeafDims = 2;
 const int nBin = 50;
+// bump when the layout written by Dump changes
+const uint32_t formatVersion = 2;
+const char formatMagic[4] = {'R', 'T', 'R', 'E'};
+// visit the rows of the categorical bitmap directly when it selects less than 1 / directScanRatio of them
+const size_t directScanRatio = 8;
 
+// one bit per row
+typedef std::vector<uint64_t> Bitset;
+
+// the values of a leaf are in the columns of the tree, at row index
 struct LeafData {
 	int index;
-	std::vector<double> data;
 	LeafData(){}
-	LeafData(int index, const std::vector<double>& data): index(index), data(data) {}
+	LeafData(int index): index(index) {}
+};
+
+// values of one feature for all rows: float32 for 'index' features,
+// int8 or int16 for 'other' features, whichever holds all their values
+struct Column {
+	char type; // 'f' float32, 'b' int8, 'h' int16
+	std::vector<float> f32;
+	std::vector<int8_t> i8;
+	std::vector<int16_t> i16;
+
+	Column() : type('f') {}
+
+	double operator[](size_t row) const {
+		switch (type) {
+			case 'b': return i8[row];
+			case 'h': return i16[row];
+			default: return f32[row];
+		}
+	}
+
+	size_t size() const {
+		return type == 'b' ? i8.size() : (type == 'h' ? i16.size() : f32.size());
+	}
+
+	char* data() {
+		return type == 'b' ? reinterpret_cast<char*>(i8.data()) :
+			(type == 'h' ? reinterpret_cast<char*>(i16.data()) : reinterpret_cast<char*>(f32.data()));
+	}
+
+	size_t itemSize() const {
+		return type == 'b' ? 1 : (type == 'h' ? 2 : 4);
+	}
+
+	void resize(size_t n) {
+		if (type == 'b') i8.resize(n);
+		else if (type == 'h') i16.resize(n);
+		else f32.resize(n);
+	}
 };
 
 typedef RStarTree<LeafData, nIndexedDims, 32, 64> RTree;
 typedef RTree::BoundingBox BoundingBox;
 
+// numpy array owning the vector, without copying its elements
+template <typename T>
+py::array_t<T> toArray(std::vector<T>&& vec, const std::vector<py::ssize_t>& shape) {
+	std::vector<T>* owned = new std::vector<T>(std::move(vec));
+	py::capsule free(owned, [](void* p) { delete reinterpret_cast<std::vector<T>*>(p); });
+	return py::array_t<T>(shape, owned->data(), free);
+}
+
 struct MatrixVisitor {
 	MatrixVisitor(size_t nCol = 1, size_t nRow = 1) :
 		ContinueVisiting(true),
 		nCol(nCol), nRow(nRow),
-		getter([](const LeafData& vec) -> std::pair<int, int> { return std::make_pair((int)vec.data[0], (int)vec.data[1]); }),
+		getter([](const LeafData&) -> std::pair<int, int> { return std::make_pair(0, 0); }),
 		checker([](const LeafData&) -> bool { return true; }) {};
 
 	std::vector<std::pair<int, int>> values;
@@ -46,21 +106,16 @@ struct MatrixVisitor {
 		}
 	}
 
-	std::vector<std::vector<int>> matrix() {
-		std::vector<std::vector<int>> ret;
-		for (size_t i = 0; i < nRow; ++i) {
-			std::vector<int> row;
-			for (size_t j = 0; j < nCol; ++j) {
-				row.push_back(0);
-			}
-			ret.push_back(row);
-		}
+	void Merge(const MatrixVisitor& other) {
+		values.insert(values.end(), other.values.begin(), other.values.end());
+	}
 
+	py::array_t<int> matrix() {
+		std::vector<int> ret(nRow * nCol, 0);
 		for (auto v: values) {
-			ret[v.first][v.second]++;
+			ret[v.first * nCol + v.second]++;
 		}
-
-		return ret;
+		return toArray(std::move(ret), {(py::ssize_t)nRow, (py::ssize_t)nCol});
 	}
 };
 
@@ -74,7 +129,7 @@ struct DistributionVisitor {
 	DistributionVisitor(double minValue = 0.0, double maxValue = 1.0) :
 		ContinueVisiting(true),
 		minValue(minValue), maxValue(maxValue),
-		getter([](const LeafData& vec) -> double { return vec.data[0]; }),
+		getter([](const LeafData&) -> double { return 0.0; }),
 		checker([](const LeafData&) -> bool { return true; }) {};
 	
 	void operator()(const RTree::Leaf * const leaf) {
@@ -83,25 +138,35 @@ struct DistributionVisitor {
 		}
 	}
 
+	void Merge(const DistributionVisitor& other) {
+		values.insert(values.end(), other.values.begin(), other.values.end());
+	}
+
 	std::pair<std::vector<std::pair<double, double>>, std::vector<int>> distribution() {
 		std::vector<int> ret;
 		for (int i = 0; i < nBin; ++i)
 			ret.push_back(0);
 
 		for (size_t i = 0; i < values.size(); ++i) {
-			int index = (int)((values[i] - minValue) * nBin / (maxValue - minValue));
-			if (index >= nBin) index = nBin - 1;
-			ret[index]++;
+			ret[binIndex(values[i], minValue, maxValue)]++;
 		}
+		return std::make_pair(binEdges(minValue, maxValue), ret);
+	}
+
+	static int binIndex(double value, double minValue, double maxValue) {
+		int index = (int)((value - minValue) * nBin / (maxValue - minValue));
+		if (index >= nBin) index = nBin - 1;
+		return index;
+	}
 
+	static std::vector<std::pair<double, double>> binEdges(double minValue, double maxValue) {
 		std::vector<std::pair<double, double>> bins;
 		for (int i = 0; i < nBin; ++i) {
 			double start = minValue + (maxValue - minValue) / nBin * i;
 			double end = minValue + (maxValue - minValue) / nBin * (i + 1);
 			bins.push_back(std::make_pair(start, end));
 		}
-
-		return std::make_pair(bins, ret);
+		return bins;
 	}
 };
 
@@ -119,161 +184,354 @@ struct IndexVisitor {
 			index.push_back(leaf->leaf.index);
 		}
 	}
+
+	void Merge(const IndexVisitor& other) {
+		index.insert(index.end(), other.index.begin(), other.index.end());
+	}
+};
+
+struct GroupByVisitor {
+	bool ContinueVisiting;
+	// flat row * col * value counts of each group
+	std::vector<std::vector<int>> counts;
+	std::function<void(const LeafData&, std::vector<std::vector<int>>&)> counter;
+	std::function<bool(const LeafData&)> checker;
+
+	GroupByVisitor(const std::vector<std::vector<int>>& counts, std::function<void(const LeafData&, std::vector<std::vector<int>>&)> counter) :
+		ContinueVisiting(true),
+		counts(counts),
+		counter(counter),
+		checker([](const LeafData&) -> bool { return true; }) {};
+
+	void operator()(const RTree::Leaf * const leaf) {
+		if (checker(leaf->leaf)) {
+			counter(leaf->leaf, counts);
+		}
+	}
+
+	void Merge(const GroupByVisitor& other) {
+		for (size_t g = 0; g < counts.size(); ++g) {
+			for (size_t i = 0; i < counts[g].size(); ++i) counts[g][i] += other.counts[g][i];
+		}
+	}
 };
 
-std::vector<double> getIndex(const std::vector<double> &vec, const std::vector<int>& indexes) {
-	std::vector<double> ret;
-	for (int i: indexes) {
-		ret.push_back(vec[i]);
+struct LeafCollector {
+	std::vector<const RTree::Leaf*>* rows;
+	bool ContinueVisiting;
+	LeafCollector(std::vector<const RTree::Leaf*>* rows) : rows(rows), ContinueVisiting(true) {};
+
+	void operator()(const RTree::Leaf * const leaf) {
+		(*rows)[leaf->leaf.index] = leaf;
 	}
-	return ret;
-}
+};
 
-BoundingBox getBound(const std::vector<double>& vec) {
+// histogram column, bounds and the filters of one target of QueryDistributions
+struct DistributionTarget {
+	const Column* column;
+	double minValue, maxValue;
+	std::vector<std::tuple<const Column*, double, double>> ranges;
+	std::vector<std::pair<const Column*, std::set<double>>> values;
+
+	bool accepts(size_t row) const {
+		for (auto& range: ranges) {
+			double value = (*std::get<0>(range))[row];
+			if (value < std::get<1>(range) || value > std::get<2>(range)) return false;
+		}
+		for (auto& listed: values) {
+			if (!listed.second.count((*listed.first)[row])) return false;
+		}
+		return true;
+	}
+};
+
+// the point of a row in the indexed columns
+BoundingBox getBound(const std::vector<Column>& columns, const std::vector<int>& indexes, size_t row) {
 	BoundingBox bb;
-	for (size_t i = 0; i < vec.size(); ++i) {
-		bb.edges[i].first = bb.edges[i].second = vec[i];
+	for (size_t i = 0; i < indexes.size(); ++i) {
+		bb.edges[i].first = bb.edges[i].second = columns[indexes[i]][row];
 	}
 	return bb;
 }
 
+// values are stored in float32, compare the queries in float32 too
+double toFloat32(double value) {
+	if (std::fabs(value) >= std::numeric_limits<float>::max()) return value;
+	return (float)value;
+}
+
+// read-only stream over a buffer owned by python, e.g. a memory-mapped buffer column
+struct MemoryBuffer : std::streambuf {
+	MemoryBuffer(const char* data, size_t size) {
+		char* p = const_cast<char*>(data);
+		setg(p, p, p + size);
+	}
+};
+
+void writeString(std::ostream& out, const std::string& str) {
+	uint32_t size = str.size();
+	out.write(reinterpret_cast<const char*>(&size), sizeof(size));
+	out.write(str.data(), size);
+}
+
+std::string readString(std::istream& in) {
+	uint32_t size;
+	if (!in.read(reinterpret_cast<char*>(&size), sizeof(size)))
+		throw std::runtime_error("truncated tree data");
+	std::string str(size, '\0');
+	if (!in.read(&str[0], size))
+		throw std::runtime_error("truncated tree data");
+	return str;
+}
+
 class RangeTree {
 public:
-	RangeTree(){}
-	void Init(const std::vector<std::vector<double>> &data) {
-		std::vector<int> indexed_pos;
-
+	// queries release the GIL and only read the tree, so they can run from several threads at once.
+	// Init, Load, SetThreads and AddFeature(s) modify it and must not run concurrently with queries.
+	RangeTree() : threads(1), parallelRows(0) {}
+	// data: n * features array, rows in the order of the indexes returned by the queries.
+	// 'index' features are kept in float32, 'other' features must be integers that fit in int16.
+	void Init(py::array_t<double, py::array::c_style | py::array::forcecast> data) {
+		if (data.ndim() != 2)
+			throw std::invalid_argument("data must be a 2-D array");
+		auto rowsView = data.unchecked<2>();
+		size_t nRows = rowsView.shape(0), nCols = rowsView.shape(1);
+		std::vector<Column> newColumns(nCols);
 		for (auto name: features) {
-			if (featureType[name] == "index") {
-				indexed_pos.push_back(featureIndex[name]);
+			int pos = featurePos(name);
+			if (pos < 0 || (size_t)pos >= nCols)
+				throw std::invalid_argument("feature " + name + " is not a column of data");
+			if (featureType.at(name) == "index") continue;
+			double minValue = 0, maxValue = 0;
+			for (size_t i = 0; i < nRows; ++i) {
+				double value = rowsView(i, pos);
+				if (value != std::floor(value) || value < std::numeric_limits<int16_t>::min() || value > std::numeric_limits<int16_t>::max())
+					throw std::invalid_argument("values of feature " + name + " must be integers in the int16 range");
+				minValue = std::min(minValue, value);
+				maxValue = std::max(maxValue, value);
+			}
+			newColumns[pos].type = minValue >= std::numeric_limits<int8_t>::min() && maxValue <= std::numeric_limits<int8_t>::max() ? 'b' : 'h';
+		}
+		for (size_t c = 0; c < nCols; ++c) {
+			Column& column = newColumns[c];
+			column.resize(nRows);
+			for (size_t i = 0; i < nRows; ++i) {
+				if (column.type == 'b') column.i8[i] = (int8_t)rowsView(i, c);
+				else if (column.type == 'h') column.i16[i] = (int16_t)rowsView(i, c);
+				else column.f32[i] = (float)rowsView(i, c);
 			}
 		}
 
-		tree = new RTree();
-		for (size_t i = 0; i < data.size(); ++i) {
-			tree->Insert(
-				LeafData(i, data[i]),
-				getBound(getIndex(data[i], indexed_pos))
-			);
+		std::vector<int> indexed_pos = indexedColumns(newColumns);
+		std::vector<std::pair<LeafData, BoundingBox>> leaves;
+		leaves.reserve(nRows);
+		for (size_t i = 0; i < nRows; ++i) {
+			leaves.push_back(std::make_pair(LeafData(i), getBound(newColumns, indexed_pos, i)));
 		}
+		tree.reset(new RTree());
+		tree->BulkLoad(leaves);
+		columns.swap(newColumns);
+		buildIndexes();
 	}
 
-	std::vector<std::vector<int>> QueryMatrix(const std::string& row, const std::string& col, const std::map<std::string, std::vector<double>>& query_dict) {
-		BoundingBox bb;
-		int boundingIndex = 0;
-		std::vector<int> leafPos;
-		std::vector<std::vector<double>> leafValues;
-		int rowIndex = featureIndex[row], colIndex = featureIndex[col];
-		int rowLeafIndex, colLeafIndex;
-
-		for (std::string name: features) {
-			if (featureType[name] == "index") {
-				if (query_dict.find(name) != query_dict.end()) {
-					auto vec = query_dict.find(name)->second;
-					bb.edges[boundingIndex].first = vec[0];
-					bb.edges[boundingIndex].second = vec[1];
-					boundingIndex++;
-				} else {
-					bb.edges[boundingIndex].first = -1e6;
-					bb.edges[boundingIndex].second = 1e6;
-					boundingIndex++;
-				}
-			} else {
-				if (query_dict.find(name) != query_dict.end()) {
-					auto vec = query_dict.find(name)->second;
-					leafPos.push_back(featureIndex[name]);
-					if (name == row) {
-						rowLeafIndex = leafValues.size();
-					} else if (name == col) {
-						colLeafIndex = leafValues.size();
-					}
-					leafValues.push_back(vec);
-				}
-			}
+	// features and tree as bytes, Load restores them without rebuilding the tree
+	py::bytes Dump() {
+		checkInitialized();
+		std::ostringstream out;
+		out.write(formatMagic, sizeof(formatMagic));
+		out.write(reinterpret_cast<const char*>(&formatVersion), sizeof(formatVersion));
+		uint32_t nFeatures = features.size();
+		out.write(reinterpret_cast<const char*>(&nFeatures), sizeof(nFeatures));
+		for (auto name: features) {
+			int32_t index = featureIndex.at(name);
+			writeString(out, name);
+			writeString(out, featureType.at(name));
+			out.write(reinterpret_cast<const char*>(&index), sizeof(index));
 		}
+		uint32_t nCols = columns.size();
+		uint64_t nRows = rows.size();
+		out.write(reinterpret_cast<const char*>(&nCols), sizeof(nCols));
+		out.write(reinterpret_cast<const char*>(&nRows), sizeof(nRows));
+		for (Column& column: columns) {
+			out.write(&column.type, sizeof(column.type));
+			out.write(column.data(), column.size() * column.itemSize());
+		}
+		// bounds of the leaves are restored from the columns
+		tree->Write(out, [](std::ostream& out, const RTree::Leaf* leaf) {
+			int32_t index = leaf->leaf.index;
+			out.write(reinterpret_cast<const char*>(&index), sizeof(index));
+		});
+		return py::bytes(out.str());
+	}
 
-		// std::cout << "rowLeafIndex" << rowLeafIndex << "colLeafIndex" << colLeafIndex << std::endl;
-		auto visitor = MatrixVisitor(leafValues[rowLeafIndex].size(), leafValues[colLeafIndex].size());
+	void Load(py::buffer buffer) {
+		py::buffer_info info = buffer.request();
+		MemoryBuffer membuf(static_cast<const char*>(info.ptr), info.size * info.itemsize);
+		std::istream in(&membuf);
+		char magic[4];
+		uint32_t version, nFeatures;
+		if (!in.read(magic, sizeof(magic)) || !std::equal(magic, magic + 4, formatMagic)
+				|| !in.read(reinterpret_cast<char*>(&version), sizeof(version)) || version != formatVersion) {
+			throw std::runtime_error("tree data was written by another version of RangeTree");
+		}
+		if (!in.read(reinterpret_cast<char*>(&nFeatures), sizeof(nFeatures)))
+			throw std::runtime_error("truncated tree data");
+		features.clear();
+		featureIndex.clear();
+		featureType.clear();
+		for (uint32_t i = 0; i < nFeatures; ++i) {
+			std::string name = readString(in);
+			std::string type = readString(in);
+			int32_t index;
+			if (!in.read(reinterpret_cast<char*>(&index), sizeof(index)))
+				throw std::runtime_error("truncated tree data");
+			AddFeature(name, type, index);
+		}
+		uint32_t nCols;
+		uint64_t nRows;
+		if (!in.read(reinterpret_cast<char*>(&nCols), sizeof(nCols)) || !in.read(reinterpret_cast<char*>(&nRows), sizeof(nRows)))
+			throw std::runtime_error("truncated tree data");
+		std::vector<Column> newColumns(nCols);
+		for (Column& column: newColumns) {
+			if (!in.read(&column.type, sizeof(column.type)) || (column.type != 'f' && column.type != 'b' && column.type != 'h'))
+				throw std::runtime_error("truncated/corrupted tree data");
+			column.resize(nRows);
+			if (!in.read(column.data(), nRows * column.itemSize()))
+				throw std::runtime_error("truncated tree data");
+		}
+		std::vector<int> indexed_pos = indexedColumns(newColumns);
+		std::unique_ptr<RTree> newTree(new RTree());
+		newTree->Read(in, [&](std::istream& in, RTree::Leaf* leaf) {
+			int32_t index;
+			if (!in.read(reinterpret_cast<char*>(&index), sizeof(index)))
+				throw std::runtime_error("truncated tree data");
+			if (index < 0 || (uint64_t)index >= nRows)
+				throw std::runtime_error("truncated/corrupted tree data");
+			leaf->leaf.index = index;
+			leaf->bound = getBound(newColumns, indexed_pos, index);
+		});
+		if (newTree->GetSize() != nRows)
+			throw std::runtime_error("truncated/corrupted tree data");
+		tree.swap(newTree);
+		columns.swap(newColumns);
+		buildIndexes();
+	}
 
-		visitor.checker = [&](const LeafData& vec) -> bool {
-			for (size_t i = 0; i < leafPos.size(); ++i) {
-				bool flag = false;
-				for (double value: leafValues[i]) {
-					if (vec.data[leafPos[i]] == value) {
-						flag = true;
-						break;
-					}
-				}
-				if (!flag) return false;
-			}
-			return true;
-		};
+	py::array_t<int> QueryMatrix(const std::string& row, const std::string& col, const std::map<std::string, std::vector<double>>& query_dict) {
+		checkInitialized();
+		int rowIndex = featurePos(row), colIndex = featurePos(col);
+		// position of each value in the row and column lists
+		std::map<double, int> rowPos, colPos;
+		const std::vector<double>& rowValues = queryValues(query_dict, row);
+		const std::vector<double>& colValues = queryValues(query_dict, col);
+		for (size_t i = rowValues.size(); i-- > 0;) rowPos[rowValues[i]] = i;
+		for (size_t i = colValues.size(); i-- > 0;) colPos[colValues[i]] = i;
+
+		auto visitor = MatrixVisitor(colValues.size(), rowValues.size());
+		// the query keeps only rows whose values are in both lists
+		const Column &rowColumn = columns[rowIndex], &colColumn = columns[colIndex];
 		visitor.getter = [&](const LeafData& vec) -> std::pair<int, int> {
-			int first = 0, second = 0;
-			for (size_t i = 0; i < leafValues[rowLeafIndex].size(); ++i) {
-				if (leafValues[rowLeafIndex][i] == vec.data[rowIndex]) {
-					first = i;
-					break;
-				}
-			}
-			for (size_t i = 0; i < leafValues[colLeafIndex].size(); ++i) {
-				if (leafValues[colLeafIndex][i] == vec.data[colIndex]) {
-					second = i;
-					break;
-				}
-			}
-			return std::make_pair(first, second);
+			return std::make_pair(rowPos.find(rowColumn[vec.index])->second, colPos.find(colColumn[vec.index])->second);
 		};
-
-		visitor = tree->Query(RTree::AcceptEnclosing(bb), visitor);
-
+		{
+			py::gil_scoped_release release;
+			visitor = query(query_dict, visitor);
+		}
 		return visitor.matrix();
 	}
 
-	std::vector<int> QueryIndex(const std::map<std::string, std::vector<double>>& query_dict) {
+	// one count tensor per (name, values) group, all from one traversal of the tree.
+	// Cell [i][j][k] of a group counts the rows of the query at row value i and column value j
+	// when the query filter on name is replaced by values[k]. A group with an empty name
+	// counts the rows of the query itself, with one value: the matrix of QueryMatrix.
+	std::vector<py::array_t<int>> QueryGroupBy(const std::string& row, const std::string& col,
+		const std::vector<std::pair<std::string, std::vector<double>>>& groups,
+		const std::map<std::string, std::vector<double>>& query_dict) {
+
+		checkInitialized();
+		const Column &rowColumn = columns[featurePos(row)], &colColumn = columns[featurePos(col)];
+		std::map<double, int> rowPos, colPos;
+		const std::vector<double>& rowValues = queryValues(query_dict, row);
+		const std::vector<double>& colValues = queryValues(query_dict, col);
+		for (size_t i = rowValues.size(); i-- > 0;) rowPos[rowValues[i]] = i;
+		for (size_t i = colValues.size(); i-- > 0;) colPos[colValues[i]] = i;
+		size_t nRow = rowValues.size(), nCol = colValues.size();
+
+		// traverse the union of the groups: the filter of each grouped feature also takes its group values
+		std::map<std::string, std::vector<double>> traversal(query_dict);
+		// grouped features filtered by the query, with the values the query keeps
+		std::vector<const Column*> filteredColumns;
+		std::vector<std::set<double>> filteredValues;
+		std::map<std::string, int> filteredPos;
+		for (auto& group: groups) {
+			if (group.first.empty() || filteredPos.count(group.first)) continue;
+			auto it = traversal.find(group.first);
+			if (it == traversal.end()) continue;
+			filteredPos[group.first] = filteredColumns.size();
+			filteredColumns.push_back(&columns[featurePos(group.first)]);
+			filteredValues.push_back(std::set<double>(it->second.begin(), it->second.end()));
+		}
+		for (auto& group: groups) {
+			auto it = traversal.find(group.first);
+			if (group.first.empty() || it == traversal.end()) continue;
+			it->second.insert(it->second.end(), group.second.begin(), group.second.end());
+		}
 
-		BoundingBox bb;
-		int boundingIndex = 0;
-		std::vector<int> leafPos;
-		std::vector<std::vector<double>> leafValues;
+		std::vector<const Column*> groupColumns;
+		std::vector<int> groupFilter;
+		std::vector<std::map<double, int>> groupPos(groups.size());
+		std::vector<size_t> depths;
+		std::vector<std::vector<int>> counts(groups.size());
+		for (size_t g = 0; g < groups.size(); ++g) {
+			const std::string& name = groups[g].first;
+			groupColumns.push_back(name.empty() ? NULL : &columns[featurePos(name)]);
+			groupFilter.push_back(filteredPos.count(name) ? filteredPos.at(name) : -1);
+			for (size_t k = groups[g].second.size(); k-- > 0;) groupPos[g][groups[g].second[k]] = k;
+			depths.push_back(name.empty() ? 1 : groups[g].second.size());
+			counts[g].assign(nRow * nCol * depths[g], 0);
+		}
 
-		for (std::string name: features) {
-			if (featureType[name] == "index") {
-				if (query_dict.find(name) != query_dict.end()) {
-					auto vec = query_dict.find(name)->second;
-					bb.edges[boundingIndex].first = vec[0];
-					bb.edges[boundingIndex].second = vec[1];
-					boundingIndex++;
-				} else {
-					bb.edges[boundingIndex].first = -1e6;
-					bb.edges[boundingIndex].second = 1e6;
-					boundingIndex++;
-				}
-			} else {
-				if (query_dict.find(name) != query_dict.end()) {
-					auto vec = query_dict.find(name)->second;
-					leafPos.push_back(featureIndex[name]);
-					leafValues.push_back(vec);
+		auto visitor = GroupByVisitor(counts, [&](const LeafData& vec, std::vector<std::vector<int>>& counts) {
+			// the row matches a group if it only fails the query filter of the grouped feature
+			int nFailed = 0, failed = -1;
+			for (size_t d = 0; d < filteredColumns.size(); ++d) {
+				if (!filteredValues[d].count((*filteredColumns[d])[vec.index])) {
+					nFailed++;
+					failed = d;
 				}
 			}
-		}
-		auto visitor = IndexVisitor();
-		visitor.checker = [&](const LeafData& vec) -> bool {
-			for (size_t i = 0; i < leafPos.size(); ++i) {
-				bool flag = false;
-				for (double value: leafValues[i]) {
-					if (vec.data[leafPos[i]] == value) {
-						flag = true;
-						break;
-					}
+			if (nFailed > 1) return;
+			size_t cell = rowPos.find(rowColumn[vec.index])->second * nCol + colPos.find(colColumn[vec.index])->second;
+			for (size_t g = 0; g < groups.size(); ++g) {
+				if (groupColumns[g] == NULL) {
+					if (nFailed == 0) counts[g][cell]++;
+					continue;
 				}
-				if (!flag) return false;
+				if (nFailed == 1 && failed != groupFilter[g]) continue;
+				auto pos = groupPos[g].find((*groupColumns[g])[vec.index]);
+				if (pos != groupPos[g].end()) counts[g][cell * depths[g] + pos->second]++;
 			}
-			return true;
-		};
+		});
+		{
+			py::gil_scoped_release release;
+			visitor = query(traversal, visitor);
+		}
+
+		std::vector<py::array_t<int>> ret;
+		for (size_t g = 0; g < groups.size(); ++g) {
+			ret.push_back(toArray(std::move(visitor.counts[g]), {(py::ssize_t)nRow, (py::ssize_t)nCol, (py::ssize_t)depths[g]}));
+		}
+		return ret;
+	}
 
-		visitor = tree->Query(RTree::AcceptEnclosing(bb), visitor);
-		return visitor.index;
+	py::array_t<int> QueryIndex(const std::map<std::string, std::vector<double>>& query_dict) {
+		std::vector<int> index;
+		{
+			py::gil_scoped_release release;
+			index = query(query_dict, IndexVisitor()).index;
+		}
+		py::ssize_t size = index.size();
+		return toArray(std::move(index), {size});
 	}
 
 	std::pair<std::vector<std::pair<double, double>>, std::vector<int>> QueryDistribution(
@@ -281,32 +539,8 @@ public:
 		const std::map<std::string, std::vector<double>>& query_dict,
 		const std::map<std::string, double>& attr_dict) {
 
-		BoundingBox bb;
-		int boundingIndex = 0;
-		std::vector<int> leafPos;
-		std::vector<std::vector<double>> leafValues;
-		int keyIndex = featureIndex[key];
-
-		for (std::string name: features) {
-			if (featureType[name] == "index") {
-				if (query_dict.find(name) != query_dict.end()) {
-					auto vec = query_dict.find(name)->second;
-					bb.edges[boundingIndex].first = vec[0];
-					bb.edges[boundingIndex].second = vec[1];
-					boundingIndex++;
-				} else {
-					bb.edges[boundingIndex].first = -1e6;
-					bb.edges[boundingIndex].second = 1e6;
-					boundingIndex++;
-				}
-			} else {
-				if (query_dict.find(name) != query_dict.end()) {
-					auto vec = query_dict.find(name)->second;
-					leafPos.push_back(featureIndex[name]);
-					leafValues.push_back(vec);
-				}
-			}
-		}
+		checkInitialized();
+		const Column& keyColumn = columns[featurePos(key)];
 		auto visitor = DistributionVisitor();
 		if (attr_dict.find("min") != attr_dict.end()) {
 			visitor.minValue = attr_dict.find("min")->second;
@@ -314,26 +548,102 @@ public:
 		if (attr_dict.find("max") != attr_dict.end()) {
 			visitor.maxValue = attr_dict.find("max")->second;
 		}
+		visitor.getter = [&](const LeafData& vec) -> double {
+			return keyColumn[vec.index];
+		};
+		py::gil_scoped_release release;
+		return query(query_dict, visitor).distribution();
+	}
+
+	// QueryDistribution of each (key, query, attrs) target, all from one traversal of the union of their queries.
+	// Each target keeps its own filters, e.g. the query without the filter of its own key.
+	std::vector<std::pair<std::vector<std::pair<double, double>>, std::vector<int>>> QueryDistributions(
+		const std::vector<std::tuple<std::string, std::map<std::string, std::vector<double>>, std::map<std::string, double>>>& targets) {
+
+		checkInitialized();
+		std::vector<std::pair<std::vector<std::pair<double, double>>, std::vector<int>>> ret;
+		if (targets.empty()) return ret;
+		std::vector<DistributionTarget> filters;
+		for (auto& target: targets) {
+			DistributionTarget filter;
+			filter.column = &columns[featurePos(std::get<0>(target))];
+			const std::map<std::string, double>& attr_dict = std::get<2>(target);
+			filter.minValue = attr_dict.count("min") ? attr_dict.at("min") : 0.0;
+			filter.maxValue = attr_dict.count("max") ? attr_dict.at("max") : 1.0;
+			filters.push_back(filter);
+		}
 
-		visitor.checker = [&](const LeafData& vec) -> bool {
-			for (size_t i = 0; i < leafPos.size(); ++i) {
-				bool flag = false;
-				for (double value: leafValues[i]) {
-					if (vec.data[leafPos[i]] == value) {
-						flag = true;
-						break;
-					}
+		// the traversal takes the union of the queries: the widest range of each 'index' feature
+		// and all values of each 'other' feature, features missing from a query are not filtered
+		std::map<std::string, std::vector<double>> traversal;
+		for (std::string name: features) {
+			bool everywhere = true;
+			for (auto& target: targets) everywhere = everywhere && std::get<1>(target).count(name);
+			if (!everywhere) continue;
+			std::vector<double>& values = traversal[name];
+			for (auto& target: targets) {
+				const std::vector<double>& queried = std::get<1>(target).at(name);
+				if (featureType.at(name) != "index") {
+					values.insert(values.end(), queried.begin(), queried.end());
+				} else if (values.empty()) {
+					values = {queried[0], queried[1]};
+				} else {
+					values[0] = std::min(values[0], queried[0]);
+					values[1] = std::max(values[1], queried[1]);
 				}
-				if (!flag) return false;
 			}
-			return true;
-		};
-		visitor.getter = [&](const LeafData& vec) -> double {
-			return vec.data[keyIndex];
-		};
+		}
+		// each target checks the filters narrower than the traversal
+		for (size_t t = 0; t < targets.size(); ++t) {
+			for (auto& kv: std::get<1>(targets[t])) {
+				const Column* column = &columns[featurePos(kv.first)];
+				auto traversed = traversal.find(kv.first);
+				bool everywhere = traversed != traversal.end();
+				if (featureType.at(kv.first) == "index") {
+					if (!everywhere || toFloat32(kv.second[0]) > toFloat32(traversed->second[0]) || toFloat32(kv.second[1]) < toFloat32(traversed->second[1]))
+						filters[t].ranges.push_back(std::make_tuple(column, toFloat32(kv.second[0]), toFloat32(kv.second[1])));
+				} else {
+					std::set<double> listed(kv.second.begin(), kv.second.end());
+					if (!everywhere || listed.size() < std::set<double>(traversed->second.begin(), traversed->second.end()).size())
+						filters[t].values.push_back(std::make_pair(column, listed));
+				}
+			}
+		}
+
+		std::vector<std::vector<int>> counts(targets.size(), std::vector<int>(nBin, 0));
+		auto visitor = GroupByVisitor(counts, [&](const LeafData& vec, std::vector<std::vector<int>>& counts) {
+			for (size_t t = 0; t < filters.size(); ++t) {
+				if (!filters[t].accepts(vec.index)) continue;
+				int index = DistributionVisitor::binIndex((*filters[t].column)[vec.index], filters[t].minValue, filters[t].maxValue);
+				// far below minValue, outside every histogram
+				if (index >= 0) counts[t][index]++;
+			}
+		});
+		{
+			py::gil_scoped_release release;
+			visitor = query(traversal, visitor);
+		}
+
+		for (size_t t = 0; t < filters.size(); ++t) {
+			ret.push_back(std::make_pair(DistributionVisitor::binEdges(filters[t].minValue, filters[t].maxValue), visitor.counts[t]));
+		}
+		return ret;
+	}
+
+	// values of one feature for all rows, in row order
+	py::array_t<double> GetColumn(const std::string& name) {
+		checkInitialized();
+		const Column& column = columns[featurePos(name)];
+		py::ssize_t size = column.size();
+		std::vector<double> values(size);
+		for (py::ssize_t i = 0; i < size; ++i) values[i] = column[i];
+		return toArray(std::move(values), {size});
+	}
 
-		visitor = tree->Query(RTree::AcceptEnclosing(bb), visitor);
-		return visitor.distribution();
+	// traverse trees of at least min_rows rows with up to `threads` threads per query, 1 to disable
+	void SetThreads(int threads, size_t min_rows) {
+		this->threads = std::max(threads, 1);
+		parallelRows = min_rows;
 	}
 
 	void AddFeature(const std::string& name, const std::string& type, int index) {
@@ -351,10 +661,158 @@ public:
 		}
 	}
 private:
+	// bounds of the 'index' features in the query, unbounded if not queried
+	BoundingBox queryBound(const std::map<std::string, std::vector<double>>& query_dict) {
+		BoundingBox bb;
+		int boundingIndex = 0;
+		for (std::string name: features) {
+			if (featureType.at(name) != "index") continue;
+			auto it = query_dict.find(name);
+			if (it != query_dict.end()) {
+				bb.edges[boundingIndex].first = toFloat32(it->second[0]);
+				bb.edges[boundingIndex].second = toFloat32(it->second[1]);
+			} else {
+				bb.edges[boundingIndex].first = -1e6;
+				bb.edges[boundingIndex].second = 1e6;
+			}
+			boundingIndex++;
+		}
+		return bb;
+	}
+
+	// rows whose queried 'other' features all take one of the queried values,
+	// returns false if the query has no 'other' feature
+	bool categoricalMask(const std::map<std::string, std::vector<double>>& query_dict, Bitset& mask) {
+		size_t words = (rows.size() + 63) / 64;
+		bool filtered = false;
+		for (std::string name: features) {
+			if (featureType.at(name) == "index") continue;
+			auto it = query_dict.find(name);
+			if (it == query_dict.end()) continue;
+			const std::map<double, Bitset>& valueBits = bitmaps.at(name);
+			std::set<double> listed(it->second.begin(), it->second.end());
+			size_t nListed = 0;
+			for (auto& kv: valueBits) nListed += listed.count(kv.first);
+
+			// each row has one value, so the rows of the listed values are the complement
+			// of the rows of the other values, combine whichever has fewer bitmaps
+			bool complement = nListed * 2 > valueBits.size();
+			Bitset bits(words, 0);
+			for (auto& kv: valueBits) {
+				if (listed.count(kv.first) != (complement ? 0u : 1u)) continue;
+				for (size_t w = 0; w < words; ++w) bits[w] |= kv.second[w];
+			}
+			if (complement) {
+				for (size_t w = 0; w < words; ++w) bits[w] = ~bits[w];
+				if (rows.size() % 64 != 0) bits[words - 1] &= (uint64_t(1) << (rows.size() % 64)) - 1;
+			}
+
+			if (!filtered) {
+				mask.swap(bits);
+			} else {
+				for (size_t w = 0; w < words; ++w) mask[w] &= bits[w];
+			}
+			filtered = true;
+		}
+		return filtered;
+	}
+
+	// visits the leaves inside the bound of the 'index' features whose 'other' features match the query
+	template <typename Visitor>
+	Visitor query(const std::map<std::string, std::vector<double>>& query_dict, Visitor visitor) {
+		checkInitialized();
+		BoundingBox bb = queryBound(query_dict);
+		Bitset mask;
+		if (!categoricalMask(query_dict, mask)) {
+			return traverse(bb, visitor);
+		}
+
+		size_t selected = 0;
+		for (uint64_t bits: mask) selected += __builtin_popcountll(bits);
+		if (selected * directScanRatio < rows.size()) {
+			// few rows left, check their bound directly instead of traversing the tree
+			for (size_t w = 0; w < mask.size(); ++w) {
+				for (uint64_t bits = mask[w]; bits; bits &= bits - 1) {
+					const RTree::Leaf* leaf = rows[w * 64 + __builtin_ctzll(bits)];
+					if (bb.encloses(leaf->bound)) visitor(leaf);
+				}
+			}
+			return visitor;
+		}
+		visitor.checker = [&mask](const LeafData& vec) -> bool {
+			return (mask[vec.index >> 6] >> (vec.index & 63)) & 1;
+		};
+		return traverse(bb, visitor);
+	}
+
+	template <typename Visitor>
+	Visitor traverse(const BoundingBox& bb, Visitor visitor) {
+		if (threads > 1 && rows.size() >= parallelRows) {
+			return tree->ParallelQuery(RTree::AcceptEnclosing(bb), visitor, threads);
+		}
+		return tree->Query(RTree::AcceptEnclosing(bb), visitor);
+	}
+
+	void checkInitialized() const {
+		if (!tree)
+			throw std::runtime_error("RangeTree is empty, call Init or Load first");
+	}
+
+	// columns of the 'index' features, in the order of the dimensions of the tree
+	std::vector<int> indexedColumns(const std::vector<Column>& columns) const {
+		std::vector<int> indexed_pos;
+		for (auto name: features) {
+			if (featureType.at(name) != "index") continue;
+			int pos = featurePos(name);
+			if (pos < 0 || (size_t)pos >= columns.size())
+				throw std::invalid_argument("feature " + name + " is not a column of data");
+			indexed_pos.push_back(pos);
+		}
+		if (indexed_pos.size() > (size_t)nIndexedDims)
+			throw std::invalid_argument("too many 'index' features");
+		return indexed_pos;
+	}
+
+	int featurePos(const std::string& name) const {
+		auto it = featureIndex.find(name);
+		if (it == featureIndex.end())
+			throw std::invalid_argument("unknown feature " + name);
+		return it->second;
+	}
+
+	const std::vector<double>& queryValues(const std::map<std::string, std::vector<double>>& query_dict, const std::string& name) const {
+		auto it = query_dict.find(name);
+		if (it == query_dict.end())
+			throw std::invalid_argument("query has no values for " + name);
+		return it->second;
+	}
+
+	// leaf of each row and the bitmap of the rows of each value of the 'other' features
+	void buildIndexes() {
+		rows.assign(tree->GetSize(), NULL);
+		tree->Query(RTree::AcceptAny(), LeafCollector(&rows));
+		size_t words = (rows.size() + 63) / 64;
+		bitmaps.clear();
+		for (std::string name: features) {
+			if (featureType.at(name) == "index") continue;
+			const Column& column = columns.at(featureIndex.at(name));
+			std::map<double, Bitset>& valueBits = bitmaps[name];
+			for (size_t i = 0; i < rows.size(); ++i) {
+				Bitset& bits = valueBits[column[i]];
+				if (bits.empty()) bits.assign(words, 0);
+				bits[i >> 6] |= uint64_t(1) << (i & 63);
+			}
+		}
+	}
+
 	std::vector<std::string> features;
 	std::map<std::string, int> featureIndex;
 	std::map<std::string, std::string> featureType;
-	RTree *tree;
+	std::unique_ptr<RTree> tree;
+	std::vector<Column> columns;
+	std::vector<const RTree::Leaf*> rows;
+	std::map<std::string, std::map<double, Bitset>> bitmaps;
+	size_t threads, parallelRows;
 };
 
 PYBIND11_MODULE(RangeTree, m) {
@@ -362,9 +820,15 @@ PYBIND11_MODULE(RangeTree, m) {
     pybind11::class_<RangeTree>(m, "RangeTree")
         .def( pybind11::init<>())
         .def( "Init", &RangeTree::Init )
+        .def( "Dump", &RangeTree::Dump )
+        .def( "Load", &RangeTree::Load )
         .def( "QueryDistribution", &RangeTree::QueryDistribution )
         .def( "QueryMatrix", &RangeTree::QueryMatrix )
         .def( "QueryIndex", &RangeTree::QueryIndex )
+        .def( "QueryGroupBy", &RangeTree::QueryGroupBy )
+        .def( "QueryDistributions", &RangeTree::QueryDistributions )
+        .def( "GetColumn", &RangeTree::GetColumn )
+        .def( "SetThreads", &RangeTree::SetThreads )
         .def( "AddFeature", &RangeTree::AddFeature )
         .def( "AddFeatures", &RangeTree::AddFeatures );
 
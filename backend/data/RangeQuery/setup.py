@@ -5,8 +5,8 @@ functions_module = Extension(
     name ='RangeTree',  
     sources = ['main.cpp'],  
     include_dirs = [pybind11.get_include()],
-    extra_compile_args=["-std=c++11"],
-    extra_link_args=["-std=c++11"],
+    extra_compile_args=["-std=c++11", "-pthread"],
+    extra_link_args=["-std=c++11", "-pthread"],
     language='c++',
 )  
   
@@ -0,0 +1,155 @@
+import threading
+import time
+import numpy as np
+from data.dataCube import CUBE_BINS, distribution_bins, distribution_edges, value_positions
+
+# z of the two-sided 95% interval of the error bounds
+ERROR_Z = 1.96
+# pairs kept in every stratum with more, so that each has a variance estimate
+MIN_STRATUM_PAIRS = 30
+
+
+class StratifiedSample(object):
+    """sample of the pairs of a range tree, stratified by (type, class), answering its queries approximately
+
+    Each stratum keeps a share of its pairs proportional to its size, at least MIN_STRATUM_PAIRS, so
+    rare types and classes are still seen. Counts are scaled by stratum size / stratum sample size and
+    come with the half width of their 95% interval from the variance of the stratified estimator.
+    A tree with fewer pairs than the sample size is kept whole: its answers are exact, with 0 error.
+    """
+
+    def __init__(self, columns, strata, stratum_size, stratum_sample):
+        self.columns = columns # name => values of the sampled pairs
+        self.strata = strata # stratum of each sampled pair
+        self.stratum_size = stratum_size # pairs of each stratum in the tree
+        self.stratum_sample = stratum_sample # sampled pairs of each stratum
+
+    @classmethod
+    def from_tree(cls, tree, names, background, n_sample, seed=0):
+        """sample about n_sample pairs of tree, names are its features and background the background class"""
+        types, label, predict = tree.GetColumn('types'), tree.GetColumn('label'), tree.GetColumn('predict')
+        # the class of a pair is its label class, its predict class for background labels
+        pair_class = np.where(label == background, predict, label).astype(np.int64)
+        strata = np.unique(types.astype(np.int64) * (background + 1) + pair_class, return_inverse=True)[1].ravel()
+        stratum_size = np.bincount(strata)
+        if len(strata) <= n_sample:
+            selected = np.arange(len(strata))
+        else:
+            quota = np.minimum(stratum_size, np.maximum(MIN_STRATUM_PAIRS, np.round(stratum_size * n_sample / len(strata)).astype(np.int64)))
+            # a random permutation, then the first quota pairs of each stratum in it
+            order = np.random.default_rng(seed).permutation(len(strata))
+            order = order[np.argsort(strata[order], kind='stable')]
+            rank = np.arange(len(order)) - np.repeat(np.cumsum(stratum_size) - stratum_size, stratum_size)
+            selected = np.sort(order[rank < quota[strata[order]]])
+        strata = strata[selected]
+        columns = {name: tree.GetColumn(name)[selected] for name in names}
+        return cls(columns, strata, stratum_size, np.bincount(strata, minlength=len(stratum_size)))
+
+    @property
+    def nbytes(self):
+        return sum(values.nbytes for values in self.columns.values()) + self.strata.nbytes + \
+            self.stratum_size.nbytes + self.stratum_sample.nbytes
+
+    def __len__(self):
+        return len(self.strata)
+
+    def mask(self, query, range_features, skip=()):
+        """sampled pairs selected by the filters of the query, except those in skip"""
+        mask = np.ones(len(self), dtype=bool)
+        for name, values in query.items():
+            if name in skip:
+                continue
+            if name in range_features:
+                # bounds in float32, as in the tree
+                mask &= (self.columns[name] >= np.float32(values[0])) & (self.columns[name] <= np.float32(values[1]))
+            else:
+                mask &= np.isin(self.columns[name], values)
+        return mask
+
+    def estimate(self, selected, cells, n_cells):
+        """(estimated counts, error bounds) of the selected sampled pairs by cell"""
+        keys = self.strata[selected] * n_cells + np.asarray(cells, dtype=np.int64)
+        keys, sampled = np.unique(keys, return_counts=True)
+        strata, cells = keys // n_cells, keys % n_cells
+        size, n = self.stratum_size[strata].astype(np.float64), self.stratum_sample[strata].astype(np.float64)
+        counts = np.bincount(cells, weights=sampled * size / n, minlength=n_cells)
+        share = sampled / n
+        variance = np.bincount(cells, weights=size * size * (1 - n / size) * share * (1 - share) / np.maximum(n - 1, 1), minlength=n_cells)
+        return np.rint(counts).astype(np.int32), ERROR_Z * np.sqrt(variance)
+
+    def group_by(self, row, col, groups, query, range_features):
+        """approximate RangeTree.QueryGroupBy, as (counts, errors) of each group"""
+        grouped = [name for name, _ in groups if name and name in query]
+        base = self.mask(query, range_features, skip=grouped)
+        passes = {name: np.isin(self.columns[name], query[name]) for name in grouped}
+        rows, cols = value_positions(self.columns[row], query[row]), value_positions(self.columns[col], query[col])
+        base &= (rows >= 0) & (cols >= 0)
+        cell = rows * len(query[col]) + cols
+        ret = []
+        for name, values in groups:
+            # a pair counts for a group if it matches the query except the filter of the grouped feature
+            selected = base.copy()
+            for other, inside in passes.items():
+                if other != name:
+                    selected &= inside
+            depth = len(values) if name else 1
+            if name:
+                position = value_positions(self.columns[name], values)
+                selected &= position >= 0
+                cells = cell[selected] * depth + position[selected]
+            else:
+                cells = cell[selected]
+            counts, errors = self.estimate(selected, cells, len(query[row]) * len(query[col]) * depth)
+            shape = (len(query[row]), len(query[col]), depth)
+            ret.append((counts.reshape(shape), errors.reshape(shape)))
+        return ret
+
+    def distribution(self, key, query, attrs, range_features):
+        """approximate RangeTree.QueryDistribution, as (bins, counts, errors)"""
+        min_value, max_value = float(attrs.get('min', 0.0)), float(attrs.get('max', 1.0))
+        selected = self.mask(query, range_features)
+        bins = distribution_bins(self.columns[key][selected], min_value, max_value)
+        # far below min_value, outside the histogram
+        inside = bins >= 0
+        selected[selected] = inside
+        counts, errors = self.estimate(selected, bins[inside], CUBE_BINS)
+        return distribution_edges(min_value, max_value), counts, errors
+
+
+class SettledRunner(object):
+    """runs the last submitted job once no other job was submitted for settle seconds
+
+    Jobs replaced by a later one before settling are dropped. One daemon thread runs the jobs.
+    """
+
+    def __init__(self, settle, logger):
+        self.settle = settle
+        self.logger = logger
+        self.job = None
+        self.submitted = 0
+        self.condition = threading.Condition()
+        self.thread = None
+
+    def submit(self, job):
+        with self.condition:
+            self.job = job
+            self.submitted = time.monotonic()
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.job is None:
+                    self.condition.wait()
+                wait = self.submitted + self.settle - time.monotonic()
+                if wait > 0:
+                    self.condition.wait(wait)
+                    continue
+                job, self.job = self.job, None
+            try:
+                job()
+            except Exception:
+                self.logger.exception("settled query failed")
@@ -0,0 +1,139 @@
+import os
+import json
+import numpy as np
+
+# bump when the layout of any group changes, older buffers are then recomputed
+BUFFER_VERSION = 2
+
+
+class ColumnarBuffer(object):
+    """versioned column store in the buffer directory
+    - root/
+      - manifest.json
+      - <group>.<column>.npy
+
+    Every column is a plain .npy file and is opened with np.load(mmap_mode='r'),
+    so loading is independent of the dataset size and server processes reading
+    the same buffer share pages through the OS page cache.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.manifest_path = os.path.join(root, "manifest.json")
+        if not os.path.exists(root):
+            os.makedirs(root)
+        self.manifest = {"version": BUFFER_VERSION, "groups": {}}
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path) as f:
+                manifest = json.load(f)
+            if manifest.get("version") == BUFFER_VERSION:
+                self.manifest = manifest
+
+    def _column_path(self, group, column):
+        return os.path.join(self.root, "{}.{}.npy".format(group, column))
+
+    def _dump_manifest(self):
+        tmp_path = self.manifest_path + ".tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(self.manifest, f, indent=1)
+        os.replace(tmp_path, self.manifest_path)
+
+    def has(self, group):
+        if group not in self.manifest["groups"]:
+            return False
+        return all(os.path.exists(self._column_path(group, column)) for column in self.manifest["groups"][group]["columns"])
+
+    def meta(self, group):
+        return self.manifest["groups"][group]["meta"]
+
+    def save(self, group, columns, meta=None):
+        """write a group of columns, None columns are skipped and loaded back as None
+
+        Args:
+            columns (dict): column name => np.ndarray
+            meta (dict): json-serializable information of the group
+        """
+        info = {}
+        for column, arr in columns.items():
+            if arr is None:
+                continue
+            arr = np.ascontiguousarray(arr)
+            path = self._column_path(group, column)
+            with open(path + ".tmp", 'wb') as f:
+                np.save(f, arr)
+            os.replace(path + ".tmp", path)
+            info[column] = {"dtype": arr.dtype.str, "shape": list(arr.shape)}
+        self.manifest["groups"][group] = {"columns": info, "meta": meta if meta is not None else {}}
+        self._dump_manifest()
+
+    def load(self, group, mmap_mode='r'):
+        """return column name => read-only memory-mapped array"""
+        ret = {}
+        for column, info in self.manifest["groups"][group]["columns"].items():
+            # empty arrays cannot be memory-mapped on every numpy version
+            arr = np.load(self._column_path(group, column), mmap_mode=mmap_mode if np.prod(info["shape"]) > 0 else None)
+            assert arr.dtype.str == info["dtype"] and list(arr.shape) == info["shape"], \
+                "buffer column {}.{} does not match the manifest".format(group, column)
+            ret[column] = arr
+        return ret
+
+    def remove(self, group):
+        if group not in self.manifest["groups"]:
+            return
+        for column in self.manifest["groups"][group]["columns"]:
+            path = self._column_path(group, column)
+            if os.path.exists(path):
+                os.remove(path)
+        del self.manifest["groups"][group]
+        self._dump_manifest()
+
+
+def pack_strings(strings):
+    """pack a list of strings into one uint8 buffer and an offsets array"""
+    encoded = [s.encode('utf-8') if isinstance(s, str) else s for s in strings]
+    offsets = np.zeros(len(encoded)+1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(s) for s in encoded])
+    data = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+    return data, offsets
+
+
+def unpack_strings(data, offsets):
+    raw = np.asarray(data).tobytes()
+    return [raw[offsets[i]:offsets[i+1]].decode('utf-8') for i in range(len(offsets)-1)]
+
+
+def threshold_key(iou_thres, conf_thres):
+    return "{}_{}".format(iou_thres, conf_thres)
+
+
+def pack_threshold_map(threshold_map, names):
+    """flatten {iou: {conf: tuple of arrays}} into columns
+
+    Args:
+        names (list): column names of the arrays in each tuple, or a single name if values are arrays
+    Returns:
+        columns (dict), meta (dict)
+    """
+    columns, thresholds = {}, []
+    for iou_thres, conf_map in threshold_map.items():
+        for conf_thres, value in conf_map.items():
+            key = threshold_key(iou_thres, conf_thres)
+            thresholds.append([iou_thres, conf_thres])
+            if isinstance(names, str):
+                columns["{}_{}".format(key, names)] = value
+            else:
+                for name, arr in zip(names, value):
+                    columns["{}_{}".format(key, name)] = arr
+    return columns, {"thresholds": thresholds}
+
+
+def unpack_threshold_map(columns, meta, names):
+    threshold_map = {}
+    for iou_thres, conf_thres in meta["thresholds"]:
+        key = threshold_key(iou_thres, conf_thres)
+        if isinstance(names, str):
+            value = columns["{}_{}".format(key, names)]
+        else:
+            value = tuple(columns["{}_{}".format(key, name)] for name in names)
+        threshold_map.setdefault(iou_thres, {})[conf_thres] = value
+    return threshold_map
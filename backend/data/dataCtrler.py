@@ -7,39 +7,123 @@ import math
 import io
 from PIL import Image
 import logging
+import multiprocessing
 
 from data.grid.sampling import HierarchySampling
 from data.drawBox import Annotator
+from data.ingestion import RawDataReader, BulkAnnotationReader, find_bulk_file, file_stats, file_fingerprints, row_fingerprints, \
+    fingerprints_digest, splice_rows, pair_imageids
+from data.imageMeta import scan_image_sizes, IMAGE_FORMATS
+from data.featureStore import FeatureStore, FeatureStoreWriter, FeatureFileReader, copy_rows, find_feature_file
+from data.maskStore import RLEMaskStore
+from data.matching import match_image
+from data.iouStore import IOU_DTYPE, SparseIoUStore, sparse_iou, empty_coo
+from data.bufferStore import ColumnarBuffer, pack_strings, unpack_strings, pack_threshold_map, unpack_threshold_map
+from data.thresholdCache import ThresholdCache
+from data.queryCache import QueryCache, canonical_arg
+from data.dataCube import PrefixCube, CUBE_BINS, distribution_bins, distribution_edges, value_positions
+from data.approxQuery import StratifiedSample, SettledRunner
 
 from data.RangeQuery.RangeTree import RangeTree
 
-import pycocotools.mask as mask_util
 from tqdm import tqdm
 
 from mlxtend.frequent_patterns import apriori
 import pandas as pd
 
+# columns of each (iou_thres, conf_thres) entry in pairs_map_under_iou_thresholds
+PAIR_COLUMNS = ('pairs', 'ious', 'types')
+ASPECT_RATIO_COLUMNS = ('label_aspect_ratio', 'predict_aspect_ratio', 'label_bbox', 'predict_bbox', 'predict_true_ar', 'label_true_ar')
+
+# images per matching task
+MATCH_SHARD_SIZE = 256
+
+# pairs with IoU not above this are never matched, only those are kept in the IoU store
+BG_THRES = 0.1
+
+# rough size of the leaf, nodes and columns of one pair in a range tree, used to bound the threshold cache,
+# the label and predict bitmaps add one bit per class on top
+RANGE_TREE_BYTES_PER_PAIR = 144
+
+# (name, type, column) of the features of the range trees, 'index' features are queried by [min, max]
+RANGE_TREE_FEATURES = [
+    ('label_aspect_ratio', 'index', 0),
+    ('label_size', 'index', 1),
+    ('predict_size', 'index', 2),
+    ('predict_aspect_ratio', 'index', 3),
+    ('conf_range', 'index', 4),
+    ('predict', 'other', 5),
+    ('label', 'other', 6),
+    ('types', 'other', 7),
+    ('size_comparison', 'other', 8),
+    ('direction', 'other', 9)
+]
+RANGE_TREE_RANGES = tuple(name for name, feature_type, _ in RANGE_TREE_FEATURES if feature_type == 'index')
+
+# trees with fewer pairs are always queried by one thread, splitting them costs more than it saves
+PARALLEL_QUERY_MIN_PAIRS = 500000
+
+# step of the fingerprints of the normalized confusion matrices, see DataCtrler.leafOrder
+ORDER_QUANTUM = 0.005
+
+# idle time after an approximate query before its exact answer is computed in the background
+APPROX_SETTLE_SECONDS = 0.5
+
+# set in the parent before forking the pool workers
+_pool_ctrler, _pool_tasks = None, None
+
+def _shard_task(shard):
+    method, args, shards = _pool_tasks
+    return getattr(_pool_ctrler, method)(shards[shard], *args)
+
+def pair_values(values, idx, fill):
+    """values[idx] of the predict or label side of pairs, fill where the side is -1"""
+    ret = np.full(len(idx), fill, dtype=np.float64)
+    ret[idx != -1] = values[idx[idx != -1]]
+    return ret
+
+def empty_pairs():
+    """empty (pairs, ious, types) of an image without any pair"""
+    return -1*np.ones((0, 2), dtype=np.int32), np.zeros(0), np.zeros(0, dtype=np.int32)
+
 class DataCtrler(object):
 
     def __init__(self, data_name):
         super().__init__()
-        self.iou_thresholds = [(50 + 5 * i) / 100 for i in [0, 5]]
+        # COCO IoU sweep 0.50:0.05:0.95
+        self.iou_thresholds = [(50 + 5 * i) / 100 for i in range(10)]
         self.conf_thresholds = [0.1]
         self.classID2Idx = {}
         self.hierarchy = {}
         self.names = []
         self.data_name = data_name
+        # names => (fingerprint, order) of the hierarchy orderings of getConfusionMatrix
+        self.orderMemo = {}
 
-    def process(self, rawDataPath, bufferPath, segmentation=False):
+    def process(self, rawDataPath, bufferPath, segmentation=False, workers=None, feature_dtype='float32', threshold_cache_mb=1024,
+                query_threads=1, query_cache_mb=256, approx_sample_pairs=200000):
         """process raw data
         - rawDataPath/
           - images/
-          - labels/
-          - predicts/
+          - labels/ (or labels.json / labels.parquet in COCO format)
+          - predicts/ (or predicts.json / predicts.parquet in COCO results format)
           - meta.json
+          - pr_features/, gt_features/ (or pr_features.npy|npz|h5, gt_features.npy|npz|h5 with one row per box)
+
+        workers: processes used to parse labels/predicts and to match them, defaults to cpu count
+        feature_dtype: float32 or float16, dtype of the memory-mapped feature store
+        threshold_cache_mb: memory bound of the pairs and range trees of (iou, conf) settings computed on demand
+        query_threads: threads traversing one range tree query of a large tree, 1 to traverse serially
+        query_cache_mb: memory bound of the cached range tree query results
+        approx_sample_pairs: pairs of the stratified sample answering the queries with "approximate" set
         """        
         # init paths
         self.segmentation = segmentation
+        self.workers = workers
+        self.threshold_cache_bytes = threshold_cache_mb * 1024 * 1024
+        self.query_threads = query_threads
+        self.query_cache_bytes = query_cache_mb * 1024 * 1024
+        self.approx_sample_pairs = approx_sample_pairs
         self.root_path = rawDataPath
         self.images_path = os.path.join(self.root_path, "images")
         self.labels_path = os.path.join(self.root_path, "labels")
@@ -63,115 +147,11 @@ class DataCtrler(object):
         self.directions_path = os.path.join(bufferPath, "{}_directions.pkl".format(setting_name))
         
         
+        self.buffer = ColumnarBuffer(os.path.join(bufferPath, "{}_columns".format(setting_name)))
+        
         self.logger = logging.getLogger('dataCtrler')
+        self.exactQueries = SettledRunner(APPROX_SETTLE_SECONDS, self.logger)
 
-        # read raw data
-        if not self.segmentation:
-            # for detection task
-            if os.path.exists(self.raw_data_path):
-                with open(self.raw_data_path, 'rb') as f:
-                    self.image2index, self.raw_labels, self.raw_label2imageid, self.imageid2raw_label, self.raw_predicts, self.raw_predict2imageid, self.imageid2raw_predict = pickle.load(f)
-            else:
-                self.image2index = {}
-                id=0
-                for name in os.listdir(self.images_path):
-                    self.image2index[name.split('.')[0]]=id
-                    id += 1
-                # read raw labels
-                # format: label, box(cx, cy, w, h), isCrowd(0/1), area
-                self.raw_labels = np.zeros((0,7), dtype=np.float32)
-                self.raw_label2imageid = np.zeros(0, dtype=np.int32)
-                self.imageid2raw_label = np.zeros((id, 2), dtype=np.int32)
-                for imageName in tqdm(os.listdir(self.labels_path)):
-                    label_path = os.path.join(self.labels_path, imageName)
-                    imageid = self.image2index[imageName.split('.')[0]]
-                    with open(label_path) as f:
-                        lb = [x.split() for x in f.read().strip().splitlines() if len(x)]
-                        lb = np.array(lb, dtype=np.float32)
-                        self.imageid2raw_label[imageid][0] = len(self.raw_labels)
-                        self.imageid2raw_label[imageid][1] = len(self.raw_labels)+len(lb)
-                        if len(lb)>0:
-                            self.raw_labels = np.concatenate((self.raw_labels, lb), axis=0)
-                            self.raw_label2imageid = np.concatenate((self.raw_label2imageid, np.ones(len(lb), dtype=np.int32)*imageid))
-
-                # read raw predicts
-                # format: predict, confidence, box(cx, cy, w, h)
-                self.raw_predicts = np.zeros((0,6), dtype=np.float32)
-                self.raw_predict2imageid = np.zeros(0, dtype=np.int32)
-                self.imageid2raw_predict = np.zeros((id, 2), dtype=np.int32)
-                for imageName in tqdm(os.listdir(self.predicts_path)):
-                    predict_path = os.path.join(self.predicts_path, imageName)
-                    imageid = self.image2index[imageName.split('.')[0]]
-                    with open(predict_path) as f:
-                        lb = [x.split() for x in f.read().strip().splitlines() if len(x)]
-                        lb = np.array(lb, dtype=np.float32)
-                        self.imageid2raw_predict[imageid][0] = len(self.raw_predicts)
-                        self.imageid2raw_predict[imageid][1] = len(self.raw_predicts)+len(lb)
-                        if len(lb)>0:
-                            self.raw_predicts = np.concatenate((self.raw_predicts, lb), axis=0)
-                            self.raw_predict2imageid = np.concatenate((self.raw_predict2imageid, np.ones(len(lb), dtype=np.int32)*imageid))
-                with open(self.raw_data_path, 'wb') as f:
-                    pickle.dump((self.image2index, self.raw_labels, self.raw_label2imageid, self.imageid2raw_label, self.raw_predicts, self.raw_predict2imageid, self.imageid2raw_predict), f)
-        else:
-            # for instance segmentation task
-            if os.path.exists(self.raw_data_path):
-                with open(self.raw_data_path, 'rb') as f:
-                    self.image2index, self.raw_labels, self.raw_label2imageid, self.imageid2raw_label, \
-                        self.raw_predicts, self.raw_predict2imageid, self.imageid2raw_predict, self.label_masks, self.predict_masks = pickle.load(f)
-            else:
-                self.image2index = {}
-                id=0
-                for name in os.listdir(self.images_path):
-                    self.image2index[name.split('.')[0]]=id
-                    id += 1
-                # read raw labels
-                # format: label, isCrowd(0/1), im_w, im_h, mask_rle
-                self.raw_labels = np.zeros((0,4), dtype=np.float32)
-                self.raw_label2imageid = np.zeros(0, dtype=np.int32)
-                self.imageid2raw_label = np.zeros((id, 2), dtype=np.int32)
-                self.label_masks = []
-                for imageName in tqdm(os.listdir(self.labels_path)):
-                    label_path = os.path.join(self.labels_path, imageName)
-                    imageid = self.image2index[imageName.split('.')[0]]
-                    with open(label_path) as f:
-                        lb = [x.split() for x in f.read().strip().splitlines() if len(x)]
-                        assert np.all([len(i) == 5 for i in lb]), lb
-                        mask_rle = [i[4] for i in lb]
-                        label_info = np.array([i[:4] for i in lb], dtype=np.float32)
-                        self.imageid2raw_label[imageid][0] = len(self.raw_labels)
-                        self.imageid2raw_label[imageid][1] = len(self.raw_labels)+len(label_info)
-                        if len(lb)>0:
-                            self.raw_labels = np.concatenate((self.raw_labels, label_info), axis=0)
-                            self.raw_label2imageid = np.concatenate((self.raw_label2imageid, np.ones(len(label_info), dtype=np.int32)*imageid))
-                            self.label_masks += mask_rle
-
-                # read raw predicts
-                # format: predict, confidence, im_w, im_h, mask_rle
-                self.raw_predicts = np.zeros((0,4), dtype=np.float32)
-                self.raw_predict2imageid = np.zeros(0, dtype=np.int32)
-                self.imageid2raw_predict = np.zeros((id, 2), dtype=np.int32)
-                self.predict_masks = []
-                for imageName in tqdm(os.listdir(self.predicts_path)):
-                    predict_path = os.path.join(self.predicts_path, imageName)
-                    imageid = self.image2index[imageName.split('.')[0]]
-                    with open(predict_path) as f:
-                        lb = [x.split() for x in f.read().strip().splitlines() if len(x)]
-                        assert np.all([len(i) == 5 for i in lb]), lb
-                        mask_rle = [i[4] for i in lb]
-                        predict_info = np.array([i[:4] for i in lb], dtype=np.float32)
-                        self.imageid2raw_predict[imageid][0] = len(self.raw_predicts)
-                        self.imageid2raw_predict[imageid][1] = len(self.raw_predicts)+len(predict_info)
-                        if len(lb)>0:
-                            self.raw_predicts = np.concatenate((self.raw_predicts, predict_info), axis=0)
-                            self.raw_predict2imageid = np.concatenate((self.raw_predict2imageid, np.ones(len(predict_info), dtype=np.int32)*imageid))
-                            self.predict_masks += mask_rle
-                with open(self.raw_data_path, 'wb') as f:
-                    pickle.dump((self.image2index, self.raw_labels, self.raw_label2imageid, self.imageid2raw_label, 
-                        self.raw_predicts, self.raw_predict2imageid, self.imageid2raw_predict, self.label_masks, self.predict_masks), f)
-        self.index2image = ['']*len(self.image2index)
-        for image, index in self.image2index.items():
-            self.index2image[index] = image
-        
         # init meta data
         # suitable for two-level hierarchy
         with open(self.meta_path) as f:
@@ -199,16 +179,73 @@ class DataCtrler(object):
         for i in range(len(self.names)):
             self.name2idx[self.names[i]]=i
 
+        # read raw data
+        # images whose labels/predicts changed since the buffer was written are re-read and spliced in,
+        # self.raw_changes then tells the downstream caches what to update
+        self.raw_changes = None
+        self.raw_migrated = False
+        # image sizes, read from the file headers when first needed
+        self.image_width = None
+        image_names = sorted(name.split('.')[0] for name in os.listdir(self.images_path))
+        if self.buffer.has('raw') and self.buffer.has('fingerprints') and self.buffer.meta('raw')['segmentation'] == self.segmentation \
+                and self.buffer.meta('raw')['digest'] == self.buffer.meta('fingerprints')['digest']:
+            self.loadRawData()
+            self.raw_digest = self.buffer.meta('raw')['digest']
+            if sorted(self.image2index) == image_names:
+                self.updateRawData(workers)
+            else:
+                # the image set changed, re-read everything
+                self.readRawData(workers)
+                self.dumpRawData()
+        elif os.path.exists(self.raw_data_path):
+            # pickle buffer of older versions, converted to the columnar buffer once
+            with open(self.raw_data_path, 'rb') as f:
+                if not self.segmentation:
+                    self.image2index, self.raw_labels, self.raw_label2imageid, self.imageid2raw_label, self.raw_predicts, self.raw_predict2imageid, self.imageid2raw_predict = pickle.load(f)
+                else:
+                    self.image2index, self.raw_labels, self.raw_label2imageid, self.imageid2raw_label, \
+                        self.raw_predicts, self.raw_predict2imageid, self.imageid2raw_predict, label_masks, predict_masks = pickle.load(f)
+                    self.label_masks = RLEMaskStore.from_strings(label_masks, self.raw_labels[:, 2:4])
+                    self.predict_masks = RLEMaskStore.from_strings(predict_masks, self.raw_predicts[:, 2:4])
+            self.raw_migrated = True
+            self.fingerprintRawData(workers)
+            self.dumpRawData()
+        else:
+            self.readRawData(workers)
+            self.dumpRawData()
+        self.index2image = ['']*len(self.image2index)
+        for image, index in self.image2index.items():
+            self.index2image[index] = image
+
+        # image sizes, read from file headers only, unless already needed by the annotation files
+        self.imageSizes()
+        
+        # IoU of the overlapping (predict, label) pairs of each image, matching under any threshold reads them
+        self.loadIoUStore()
+
         # compute (prediction, label) pair
         # creates a map, with different IoU threshold (0.5~0.95 0.05) as key and (predict_label_pairs, iou) as value
         # do not store the unmatched gt here, because different confidence thershold may result in different "Missed Error"
-        if os.path.exists(self.label_predict_iou_path):
-            with open(self.label_predict_iou_path, 'rb') as f:
-                self.pairs_map_under_iou_thresholds = pickle.load(f)
+        # buffered pairs are reused only if they cover every threshold setting
+        pairs_state = self.bufferState('pairs')
+        if pairs_state is not None:
+            buffered_pairs = unpack_threshold_map(self.buffer.load('pairs'), self.buffer.meta('pairs'), PAIR_COLUMNS)
+            if not self.coversThresholds(buffered_pairs):
+                pairs_state = None
+        pairs_reused = pairs_state == 'fresh'
+        if pairs_reused:
+            self.pairs_map_under_iou_thresholds = buffered_pairs
         else:
-            self.pairs_map_under_iou_thresholds = self.compute_label_predict_pair()
-            with open(self.label_predict_iou_path, 'wb') as f:
-                pickle.dump(self.pairs_map_under_iou_thresholds, f)
+            if pairs_state == 'previous':
+                self.pairs_map_under_iou_thresholds = self.splicePairs(buffered_pairs)
+            else:
+                if self.raw_migrated and os.path.exists(self.label_predict_iou_path):
+                    with open(self.label_predict_iou_path, 'rb') as f:
+                        self.pairs_map_under_iou_thresholds = pickle.load(f)
+                    pairs_reused = self.coversThresholds(self.pairs_map_under_iou_thresholds)
+                if not pairs_reused:
+                    self.pairs_map_under_iou_thresholds = self.compute_label_predict_pair()
+            self.dumpThresholdMap('pairs', self.pairs_map_under_iou_thresholds, PAIR_COLUMNS)
 
         # init size and area
         if not self.segmentation:
@@ -216,122 +253,86 @@ class DataCtrler(object):
             self.predict_size = self.raw_predicts[:,4]*self.raw_predicts[:,5]
             self.label_area = self.raw_labels[:, 6]
         else:
-            self.label_size = mask_util.area([{'size': list(im_size), 'counts': rle} for rle, im_size in zip(self.label_masks, self.raw_labels[:, 2:])]) / (self.raw_labels[:, 2] * self.raw_labels[:, 3])
-            self.predict_size = mask_util.area([{'size': list(im_size), 'counts': rle} for rle, im_size in zip(self.predict_masks, self.raw_predicts[:, 2:])]) / (self.raw_predicts[:, 2] * self.raw_predicts[:, 3])
-            self.label_area = mask_util.area([{'size': list(im_size), 'counts': rle} for rle, im_size in zip(self.label_masks, self.raw_labels[:, 2:])])
+            self.label_size = self.label_masks.area() / (self.raw_labels[:, 2] * self.raw_labels[:, 3])
+            self.predict_size = self.predict_masks.area() / (self.raw_predicts[:, 2] * self.raw_predicts[:, 3])
+            self.label_area = self.label_masks.area()
 
         # init aspect ratio
-        if os.path.exists(self.aspect_ratio_path):
+        if self.bufferState('aspect_ratio') == 'fresh':
+            columns = self.buffer.load('aspect_ratio')
+            self.label_aspect_ratio, self.predict_aspect_ratio, self.label_bbox, self.predict_bbox, self.predict_true_ar, self.label_true_ar = \
+                [columns.get(name) for name in ASPECT_RATIO_COLUMNS]
+        elif self.raw_migrated and os.path.exists(self.aspect_ratio_path):
             with open(self.aspect_ratio_path, 'rb') as f:
                 self.label_aspect_ratio, self.predict_aspect_ratio, self.label_bbox, self.predict_bbox, self.predict_true_ar, self.label_true_ar = pickle.load(f)
+            self.dumpAspectRatio()
         else:
-            if not self.segmentation:
-                self.label_aspect_ratio = self.raw_labels[:,3]/self.raw_labels[:,4]
-                self.predict_aspect_ratio = self.raw_predicts[:,4]/self.raw_predicts[:,5]
-                self.label_bbox = None
-                self.predict_bbox = None
-            else:
-                # x, y, w, h
-                self.label_bbox = mask_util.toBbox([{'size': list(im_size), 'counts': rle} for rle, im_size in zip(self.label_masks, self.raw_labels[:, 2:])])
-                self.predict_bbox = mask_util.toBbox([{'size': list(im_size), 'counts': rle} for rle, im_size in zip(self.predict_masks, self.raw_predicts[:, 2:])])
-                # cx, cy, w, h
-                self.label_bbox[:, :2] += self.label_bbox[:, 2:] / 2
-                self.predict_bbox[:, :2] += self.predict_bbox[:, 2:] / 2
-                # normalize
-                self.label_bbox[:, [0, 2]] /= self.raw_labels[:, 3].reshape(-1, 1)
-                self.label_bbox[:, [1, 3]] /= self.raw_labels[:, 2].reshape(-1, 1)
-                self.predict_bbox[:, [0, 2]] /= self.raw_predicts[:, 3].reshape(-1, 1)
-                self.predict_bbox[:, [1, 3]] /= self.raw_predicts[:, 2].reshape(-1, 1)
-                assert np.all(self.label_bbox <= 1), 'check why bbox > 1?'
-                self.label_aspect_ratio = self.label_bbox[:, 2] / self.label_bbox[:, 3]
-                self.predict_aspect_ratio = self.predict_bbox[:, 2] / (self.predict_bbox[:, 3] + 1e-5)
-            # get image aspect ratio
-            image_aspect_ratio = np.ones(len(self.index2image))
-            print('Loading images aspect ratio...')
-            img_format = os.listdir(self.images_path)[0].split('.')[-1]
-            for idx in tqdm(range(len(self.index2image))):
-                img = Image.open(os.path.join(self.images_path, self.index2image[idx]+f'.{img_format}'))
-                image_aspect_ratio[idx] = img.width / img.height
-            self.predict_true_ar = self.predict_aspect_ratio * image_aspect_ratio[self.raw_predict2imageid]
-            self.label_true_ar = self.label_aspect_ratio * image_aspect_ratio[self.raw_label2imageid]
-            # convert ratio above 1 to below 1
-            self.predict_true_ar[self.predict_true_ar > 1] = 1 / self.predict_true_ar[self.predict_true_ar > 1]
-            self.label_true_ar[self.label_true_ar > 1] = 1 / self.label_true_ar[self.label_true_ar > 1]
-            with open(self.aspect_ratio_path, 'wb') as f:
-                pickle.dump((self.label_aspect_ratio, self.predict_aspect_ratio, self.label_bbox, self.predict_bbox, self.predict_true_ar, self.label_true_ar), f)
+            self.computeAspectRatio()
+            self.dumpAspectRatio()
 
         # direction map, also use IoU threshold as key because different match results in different directions
-        if os.path.exists(self.directions_path):
-            with open(self.directions_path, 'rb') as f:
-                self.directions_map = pickle.load(f)
+        directions_map = None
+        if pairs_reused and self.bufferState('directions') == 'fresh':
+            directions_map = unpack_threshold_map(self.buffer.load('directions'), self.buffer.meta('directions'), 'directions')
+        if directions_map is not None and self.coversThresholds(directions_map):
+            self.directions_map = directions_map
         else:
-            self.directions_map = {}
-            for iou_thres in self.iou_thresholds:
-                self.directions_map[iou_thres] = {}
-                for conf_thres in self.conf_thresholds:
-                    predict_label_pairs, _, predict_types = self.pairs_map_under_iou_thresholds[iou_thres][conf_thres]
-                    directionIdxes = np.where(np.logical_and(predict_label_pairs[:,0]>-1, predict_label_pairs[:,1]>-1))[0]
-                    if not self.segmentation:
-                        directionVectors = self.raw_predicts[predict_label_pairs[directionIdxes,0]][:,[2,3]] - self.raw_labels[predict_label_pairs[directionIdxes,1]][:,[1,2]]
-                    else:
-                        directionVectors = self.predict_bbox[predict_label_pairs[directionIdxes,0]][:, [0, 1]] - self.label_bbox[predict_label_pairs[directionIdxes,1]][:, [0, 1]]
-                    directionNorm = np.sqrt(np.power(directionVectors[:,0], 2)+ np.power(directionVectors[:,1], 2))
-                    directionCos = directionVectors[:,0]/(directionNorm + 1e-5)
-                    directions = np.zeros(directionCos.shape[0], dtype=np.int32)
-                    directionSplits = np.array([math.cos(angle/180*math.pi) for angle in [180, 157.5, 112.5, 67.5, 22.5, 0]])
-                    for i in range(2,len(directionSplits)):
-                        directions[np.logical_and(directionCos>directionSplits[i-1], directionCos<=directionSplits[i])] = i-1
-                    # starts from <-: 0, and clock-wise to 7, middle point as 8
-                    # if directionVectors[:,1]>0, means direction downward, as the y coordinate is downward!!!
-                    negaYs = np.logical_and(directionVectors[:,1]>0, directions!=0)
-                    directions[negaYs] = 8-directions[negaYs]
-                    self.directions_map[iou_thres][conf_thres] = -1*np.ones(predict_label_pairs.shape[0], dtype=np.int32)
-                    self.directions_map[iou_thres][conf_thres][directionIdxes] = directions
-                    # assign predicts with no Loc error under this iou_thres to 8
-                    self.directions_map[iou_thres][conf_thres][np.isin(predict_types, [1, 2, 5])] = 8
-            with open(self.directions_path, 'wb') as f:
-                pickle.dump(self.directions_map, f)
+            if pairs_reused and self.raw_migrated and os.path.exists(self.directions_path):
+                with open(self.directions_path, 'rb') as f:
+                    directions_map = pickle.load(f)
+            if directions_map is not None and self.coversThresholds(directions_map):
+                self.directions_map = directions_map
+            else:
+                self.directions_map = self.computeDirections()
+            self.dumpThresholdMap('directions', self.directions_map, 'directions')
         
         # read feature data
-        if os.path.exists(self.all_features_path):
-            self.all_features = np.load(self.all_features_path)
-            self.pr_features = self.all_features[:len(self.raw_predicts)]
-            self.gt_features = self.all_features[len(self.raw_predicts):]
+        # predict features followed by label features, written once into a memory-mapped store
+        # from pr_features.npy|npz|h5 and gt_features.npy|npz|h5 if exist, else from pr_features/<image>.npy and gt_features/<image>.npy
+        feature_files = [find_feature_file(self.root_path, "pr_features"), find_feature_file(self.root_path, "gt_features")]
+        feature_sources = [None if path is None else [os.path.basename(path), os.stat(path).st_size, os.stat(path).st_mtime_ns] for path in feature_files]
+        features_state = self.bufferState('features')
+        if features_state is not None and self.buffer.meta('features').get('sources') != feature_sources:
+            features_state = None
+        if features_state == 'fresh' and os.path.exists(self.all_features_path) \
+                and self.buffer.meta('features').get('dtype') == np.dtype(feature_dtype).name:
+            self.features = FeatureStore(self.all_features_path, len(self.raw_predicts))
+            missing = self.buffer.meta('features').get('missing', [0, 0])
         else:
-            if len(os.listdir(self.features_path)) > 0: pr_feature_dim = np.load(os.path.join(self.features_path, os.listdir(self.features_path)[0])).shape[1]
-            else: pr_feature_dim = 256
-            self.pr_features = np.zeros((self.raw_predicts.shape[0], pr_feature_dim))
-            for name in os.listdir(self.labels_path):
-                feature_path = os.path.join(self.features_path, name.split('.')[0]+'.npy')
-                imageid = self.image2index[name.split('.')[0]]
-                boxCount = self.imageid2raw_predict[imageid][1]-self.imageid2raw_predict[imageid][0]
-                if not os.path.exists(feature_path):
-                    # WARNING
-                    self.logger.warning("can't find feature: %s" % feature_path)
-                    self.pr_features[self.imageid2raw_predict[imageid][0]:self.imageid2raw_predict[imageid][1]] = np.random.rand(boxCount, pr_feature_dim)
-                else:
-                    if np.load(feature_path).shape[0]==0: 
-                        continue # image without prediction
-                    self.pr_features[self.imageid2raw_predict[imageid][0]:self.imageid2raw_predict[imageid][1]] = np.load(feature_path)
-            
-            if len(os.listdir(self.gt_features_path)) > 0: gt_feature_dim = np.load(os.path.join(self.gt_features_path, os.listdir(self.gt_features_path)[0])).shape[1]
-            else: gt_feature_dim = 256
-            self.gt_features = np.zeros((self.raw_labels.shape[0], gt_feature_dim))
-            for name in os.listdir(self.predicts_path):
-                feature_path = os.path.join(self.gt_features_path, name.split('.')[0]+'.npy')
-                imageid = self.image2index[name.split('.')[0]]
-                boxCount = self.imageid2raw_label[imageid][1]-self.imageid2raw_label[imageid][0]
-                if not os.path.exists(feature_path):
-                    # WARNING
-                    self.logger.warning("can't find feature: %s" % feature_path)
-                    self.gt_features[self.imageid2raw_label[imageid][0]:self.imageid2raw_label[imageid][1]] = np.random.rand(boxCount, gt_feature_dim)
+            old_features, feature_imageids = None, range(len(self.index2image))
+            if os.path.exists(self.all_features_path) and (features_state is not None or self.raw_migrated):
+                old_features = np.load(self.all_features_path, mmap_mode='r')
+                if features_state == 'previous':
+                    # keep features of unchanged boxes, read only the changed images
+                    label_map, predict_map = self.raw_changes['label_map'], self.raw_changes['predict_map']
+                    feature_imageids = self.raw_changes['images']
                 else:
-                    self.gt_features[self.imageid2raw_label[imageid][0]:self.imageid2raw_label[imageid][1]] = np.load(feature_path)
-            self.all_features = np.concatenate((self.pr_features, self.gt_features))
-            np.save(self.all_features_path, self.all_features)
+                    # only the dtype changes
+                    label_map, predict_map = np.arange(len(self.raw_labels)), np.arange(len(self.raw_predicts))
+                    feature_imageids = []
+            dim = old_features.shape[1] if old_features is not None else self.featureDim(feature_files)
+            writer = FeatureStoreWriter(self.all_features_path, len(self.raw_predicts), len(self.raw_labels), dim, feature_dtype)
+            missing = [0, 0]
+            if old_features is not None:
+                copy_rows(writer.pr_features, old_features[:len(predict_map)], predict_map)
+                copy_rows(writer.gt_features, old_features[len(predict_map):], label_map)
+                missing = self.buffer.meta('features').get('missing', missing)
+                del old_features
+            if len(feature_imageids) > 0:
+                missing = [
+                    self.readFeatures('predict', self.features_path, feature_files[0], self.imageid2raw_predict, writer.pr_features, feature_imageids),
+                    self.readFeatures('label', self.gt_features_path, feature_files[1], self.imageid2raw_label, writer.gt_features, feature_imageids),
+                ]
+            self.features = writer.close()
+            self.buffer.save('features', {}, {'digest': self.raw_digest, 'dtype': self.features.dtype.name, 
+                'sources': feature_sources, 'missing': missing})
+        if missing[0] > 0 or missing[1] > 0:
+            self.logger.warning("no features for %d of %d predicts and %d of %d labels, filled with zeros" % 
+                (missing[0], len(self.raw_predicts), missing[1], len(self.raw_labels)))
+        self.all_features, self.pr_features, self.gt_features = self.features.all, self.features.pr_features, self.features.gt_features
         
         self.sampler = HierarchySampling()
-        if os.path.exists(self.main_hierarchy_sample_path):
+        if os.path.exists(self.main_hierarchy_sample_path) and (self.bufferState('sampler') == 'fresh' or self.raw_migrated):
             self.sampler.load(self.main_hierarchy_sample_path)
         else:
             # fit all features (predict & gt) to sampler
@@ -339,8 +340,370 @@ class DataCtrler(object):
             val_features = self.all_features
             self.sampler.fit(val_features, val_labels, val_features, val_labels, 225)
             self.sampler.dump(self.main_hierarchy_sample_path)
+            # samples of the context data were fitted on the old features
+            if os.path.exists(self.context_hierarchy_sample_path):
+                os.remove(self.context_hierarchy_sample_path)
+        self.buffer.save('sampler', {}, {'digest': self.raw_digest})
         
-        self.constructRangeTree()
+        # buffered trees were built on the buffered pairs
+        self.constructRangeTree(reuse=pairs_reused)
+
+    def readRawSource(self, side, bulk_reader, workers=None, names=None):
+        """read labels or predicts (side: 'label' or 'predict') from the consolidated file if exists,
+        else from the per-image text files, only the files in names if given
+
+        Returns:
+            raw, raw2imageid, imageid2raw, masks, and the content fingerprint of each image
+        """
+        bulk_file = find_bulk_file(self.root_path, side + "s")
+        if bulk_file is not None:
+            raw, raw2imageid, imageid2raw, masks = bulk_reader.read(bulk_file, predict=side=='predict')
+            return raw, raw2imageid, imageid2raw, masks, row_fingerprints(raw, imageid2raw, masks)
+        n_cols = 4 if self.segmentation else {'label': 7, 'predict': 6}[side]
+        reader = RawDataReader(self.image2index, n_cols, self.segmentation, workers)
+        raw, raw2imageid, imageid2raw, masks = reader.read(os.path.join(self.root_path, side + "s"), names)
+        return raw, raw2imageid, imageid2raw, masks, reader.hashes
+
+    def sourceStats(self, side):
+        if find_bulk_file(self.root_path, side + "s") is not None:
+            return np.zeros((len(self.image2index), 2), dtype=np.int64)
+        return file_stats(os.path.join(self.root_path, side + "s"), self.image2index)[0]
+
+    def readRawData(self, workers=None):
+        """read labels and predicts from one consolidated file (labels.json/.parquet, predicts.json/.parquet)
+        if exists, else from the per-image text files in labels/ and predicts/
+        """
+        self.image2index = {}
+        id=0
+        for name in os.listdir(self.images_path):
+            self.image2index[name.split('.')[0]]=id
+            id += 1
+        bulk_reader = BulkAnnotationReader(self.image2index, self.classID2Idx, segmentation=self.segmentation,
+            image_sizes=self.imageSizes)
+        # read raw labels
+        # format for detection: label, box(cx, cy, w, h), isCrowd(0/1), area
+        # format for segmentation: label, isCrowd(0/1), im_h, im_w, mask_rle
+        self.raw_labels, self.raw_label2imageid, self.imageid2raw_label, label_masks, label_hashes = \
+            self.readRawSource('label', bulk_reader, workers)
+        # read raw predicts
+        # format for detection: predict, confidence, box(cx, cy, w, h)
+        # format for segmentation: predict, confidence, im_h, im_w, mask_rle
+        self.raw_predicts, self.raw_predict2imageid, self.imageid2raw_predict, predict_masks, predict_hashes = \
+            self.readRawSource('predict', bulk_reader, workers)
+        if self.segmentation:
+            self.label_masks = RLEMaskStore.from_strings(label_masks, self.raw_labels[:, 2:4])
+            self.predict_masks = RLEMaskStore.from_strings(predict_masks, self.raw_predicts[:, 2:4])
+        self.fingerprints = {
+            'label_hash': label_hashes,
+            'label_stat': self.sourceStats('label'),
+            'predict_hash': predict_hashes,
+            'predict_stat': self.sourceStats('predict'),
+        }
+        self.raw_digest = fingerprints_digest(label_hashes, predict_hashes, self.segmentation)
+
+    def fingerprintRawData(self, workers=None):
+        """fingerprints of raw data loaded from an old buffer, assumed to match the current files"""
+        self.fingerprints = {}
+        for side in ['label', 'predict']:
+            if find_bulk_file(self.root_path, side + "s") is not None:
+                self.fingerprints[side + '_hash'] = row_fingerprints(getattr(self, 'raw_{}s'.format(side)), 
+                    getattr(self, 'imageid2raw_{}'.format(side)), getattr(self, '{}_masks'.format(side), None))
+                self.fingerprints[side + '_stat'] = np.zeros((len(self.image2index), 2), dtype=np.int64)
+            else:
+                self.fingerprints[side + '_hash'], self.fingerprints[side + '_stat'], _ = \
+                    file_fingerprints(os.path.join(self.root_path, side + "s"), self.image2index, workers=workers)
+        self.raw_digest = fingerprints_digest(self.fingerprints['label_hash'], self.fingerprints['predict_hash'], self.segmentation)
+
+    def updateRawData(self, workers=None):
+        """re-read labels/predicts of the images whose content fingerprints changed since the buffer
+        was written, and splice them into the buffered raw data
+        """
+        old_fingerprints = self.buffer.load('fingerprints')
+        bulk_reader = BulkAnnotationReader(self.image2index, self.classID2Idx, segmentation=self.segmentation,
+            image_sizes=self.imageSizes)
+        self.fingerprints = {}
+        old_raw2imageid, row_maps, changed_images = {}, {}, []
+        for side in ['label', 'predict']:
+            if find_bulk_file(self.root_path, side + "s") is not None:
+                new_data = self.readRawSource(side, bulk_reader)
+                hashes, stats = new_data[4], np.zeros((len(self.image2index), 2), dtype=np.int64)
+                changed = np.where(hashes != old_fingerprints[side + '_hash'])[0]
+            else:
+                hashes, stats, names = file_fingerprints(os.path.join(self.root_path, side + "s"), self.image2index, 
+                    old_fingerprints[side + '_hash'], old_fingerprints[side + '_stat'], workers)
+                changed = np.where(hashes != old_fingerprints[side + '_hash'])[0]
+                if len(changed) > 0:
+                    new_data = self.readRawSource(side, bulk_reader, workers, [names[i] for i in changed if i in names])
+            self.fingerprints[side + '_hash'], self.fingerprints[side + '_stat'] = hashes, stats
+            old_raw2imageid[side] = getattr(self, 'raw_{}2imageid'.format(side))
+            if len(changed) == 0:
+                row_maps[side] = np.arange(len(old_raw2imageid[side]))
+                continue
+            raw, raw2imageid, imageid2raw, masks, row_maps[side] = splice_rows(getattr(self, 'raw_{}s'.format(side)), 
+                getattr(self, 'imageid2raw_{}'.format(side)), new_data[0], new_data[2], changed,
+                getattr(self, '{}_masks'.format(side), None), new_data[3])
+            setattr(self, 'raw_{}s'.format(side), raw)
+            setattr(self, 'raw_{}2imageid'.format(side), raw2imageid)
+            setattr(self, 'imageid2raw_{}'.format(side), imageid2raw)
+            if self.segmentation:
+                setattr(self, '{}_masks'.format(side), RLEMaskStore.from_strings(masks, raw[:, 2:4]))
+            changed_images.append(changed)
+
+        if len(changed_images) == 0:
+            if any(not np.array_equal(self.fingerprints[k], old_fingerprints[k]) for k in self.fingerprints):
+                self.dumpFingerprints()
+            return
+        changed_images = np.unique(np.concatenate(changed_images))
+        self.logger.info("%d images changed since the buffer was written, updating incrementally" % len(changed_images))
+        self.raw_changes = {
+            'digest': self.raw_digest,
+            'images': changed_images,
+            'label_map': row_maps['label'],
+            'predict_map': row_maps['predict'],
+            'label2imageid': old_raw2imageid['label'],
+            'predict2imageid': old_raw2imageid['predict'],
+        }
+        self.raw_digest = fingerprints_digest(self.fingerprints['label_hash'], self.fingerprints['predict_hash'], self.segmentation)
+        self.dumpRawData()
+
+    def dumpFingerprints(self):
+        self.buffer.save('fingerprints', self.fingerprints, {'digest': self.raw_digest})
+
+    def dumpRawData(self):
+        columns = {
+            'index2image': np.array(sorted(self.image2index, key=self.image2index.get)),
+            'raw_labels': self.raw_labels,
+            'raw_label2imageid': self.raw_label2imageid,
+            'imageid2raw_label': self.imageid2raw_label,
+            'raw_predicts': self.raw_predicts,
+            'raw_predict2imageid': self.raw_predict2imageid,
+            'imageid2raw_predict': self.imageid2raw_predict,
+        }
+        if self.segmentation:
+            columns.update(self.label_masks.columns('label_masks'))
+            columns.update(self.predict_masks.columns('predict_masks'))
+        self.buffer.save('raw', columns, {'segmentation': self.segmentation, 'digest': self.raw_digest})
+        self.dumpFingerprints()
+
+    def loadRawData(self):
+        columns = self.buffer.load('raw')
+        self.image2index = {name: idx for idx, name in enumerate(columns['index2image'].tolist())}
+        self.raw_labels, self.raw_label2imageid, self.imageid2raw_label = \
+            columns['raw_labels'], columns['raw_label2imageid'], columns['imageid2raw_label']
+        self.raw_predicts, self.raw_predict2imageid, self.imageid2raw_predict = \
+            columns['raw_predicts'], columns['raw_predict2imageid'], columns['imageid2raw_predict']
+        if self.segmentation:
+            self.label_masks = RLEMaskStore.from_columns(columns, 'label_masks')
+            self.predict_masks = RLEMaskStore.from_columns(columns, 'predict_masks')
+
+    def bufferState(self, group):
+        """'fresh' if the buffered group was computed from the current raw data, 'previous' if it was computed
+        from the raw data before the incremental update of this run, None otherwise
+        """
+        if not self.buffer.has(group):
+            return None
+        digest = self.buffer.meta(group).get('digest')
+        if digest == self.raw_digest:
+            return 'fresh'
+        if self.raw_changes is not None and digest == self.raw_changes['digest']:
+            return 'previous'
+        return None
+
+    def coversThresholds(self, threshold_map):
+        """whether threshold_map has an entry for every (iou_thres, conf_thres) setting"""
+        return all(conf_thres in threshold_map.get(iou_thres, {}) for iou_thres in self.iou_thresholds for conf_thres in self.conf_thresholds)
+
+    def dumpThresholdMap(self, group, threshold_map, names):
+        columns, meta = pack_threshold_map(threshold_map, names)
+        meta['digest'] = self.raw_digest
+        self.buffer.save(group, columns, meta)
+
+    def dumpAspectRatio(self):
+        columns = dict(zip(ASPECT_RATIO_COLUMNS, [self.label_aspect_ratio, self.predict_aspect_ratio,
+            self.label_bbox, self.predict_bbox, self.predict_true_ar, self.label_true_ar]))
+        self.buffer.save('aspect_ratio', columns, {'digest': self.raw_digest})
+
+    def computeAspectRatio(self):
+        if not self.segmentation:
+            self.label_aspect_ratio = self.raw_labels[:,3]/self.raw_labels[:,4]
+            self.predict_aspect_ratio = self.raw_predicts[:,4]/self.raw_predicts[:,5]
+            self.label_bbox = None
+            self.predict_bbox = None
+        else:
+            # x, y, w, h
+            self.label_bbox = np.array(self.label_masks.bbox(), dtype=np.float64)
+            self.predict_bbox = np.array(self.predict_masks.bbox(), dtype=np.float64)
+            # cx, cy, w, h
+            self.label_bbox[:, :2] += self.label_bbox[:, 2:] / 2
+            self.predict_bbox[:, :2] += self.predict_bbox[:, 2:] / 2
+            # normalize
+            self.label_bbox[:, [0, 2]] /= self.raw_labels[:, 3].reshape(-1, 1)
+            self.label_bbox[:, [1, 3]] /= self.raw_labels[:, 2].reshape(-1, 1)
+            self.predict_bbox[:, [0, 2]] /= self.raw_predicts[:, 3].reshape(-1, 1)
+            self.predict_bbox[:, [1, 3]] /= self.raw_predicts[:, 2].reshape(-1, 1)
+            assert np.all(self.label_bbox <= 1), 'check why bbox > 1?'
+            self.label_aspect_ratio = self.label_bbox[:, 2] / self.label_bbox[:, 3]
+            self.predict_aspect_ratio = self.predict_bbox[:, 2] / (self.predict_bbox[:, 3] + 1e-5)
+        # get image aspect ratio
+        self.image_aspect_ratio = self.image_width / self.image_height
+        self.predict_true_ar = self.predict_aspect_ratio * self.image_aspect_ratio[self.raw_predict2imageid]
+        self.label_true_ar = self.label_aspect_ratio * self.image_aspect_ratio[self.raw_label2imageid]
+        # convert ratio above 1 to below 1
+        self.predict_true_ar[self.predict_true_ar > 1] = 1 / self.predict_true_ar[self.predict_true_ar > 1]
+        self.label_true_ar[self.label_true_ar > 1] = 1 / self.label_true_ar[self.label_true_ar > 1]
+
+    def imageSizes(self):
+        """(width, height) of each image, loaded by loadImageMeta on first use"""
+        if self.image_width is None:
+            self.loadImageMeta()
+        return self.image_width, self.image_height
+
+    def loadImageMeta(self, threads=32):
+        """(width, height, format) of each image, images whose file name, size and mtime are unchanged
+        keep the buffered entry, the others are read from the file headers with a thread pool
+        """
+        stats, names = file_stats(self.images_path, self.image2index)
+        self.image_files = [names[idx] for idx in range(len(self.image2index))]
+        width = np.zeros(len(self.image2index), dtype=np.int32)
+        height = np.zeros(len(self.image2index), dtype=np.int32)
+        fmt = np.zeros(len(self.image2index), dtype=np.uint8)
+        scan = np.ones(len(self.image2index), dtype=bool)
+        if self.buffer.has('image_meta'):
+            columns = self.buffer.load('image_meta')
+            old_files = unpack_strings(columns['file_data'], columns['file_offsets'])
+            if len(old_files) == len(self.image_files):
+                scan = (np.array(old_files) != np.array(self.image_files)) | np.any(columns['stat'] != stats, axis=1)
+                width[~scan], height[~scan], fmt[~scan] = columns['width'][~scan], columns['height'][~scan], columns['format'][~scan]
+        if np.any(scan):
+            scan_ids = np.where(scan)[0]
+            self.logger.info("reading size of %d images" % len(scan_ids))
+            width[scan_ids], height[scan_ids], fmt[scan_ids] = scan_image_sizes(
+                [os.path.join(self.images_path, self.image_files[idx]) for idx in scan_ids], threads)
+            file_data, file_offsets = pack_strings(self.image_files)
+            self.buffer.save('image_meta', {'width': width, 'height': height, 'format': fmt, 'stat': stats,
+                'file_data': file_data, 'file_offsets': file_offsets}, {'formats': list(IMAGE_FORMATS)})
+        self.image_width, self.image_height, self.image_format = width, height, fmt
+
+    def computeDirections(self):
+        directions_map = {}
+        for iou_thres in self.iou_thresholds:
+            directions_map[iou_thres] = {}
+            for conf_thres in self.conf_thresholds:
+                predict_label_pairs, _, predict_types = self.pairs_map_under_iou_thresholds[iou_thres][conf_thres]
+                directions_map[iou_thres][conf_thres] = self.pairDirections(predict_label_pairs, predict_types)
+        return directions_map
+
+    def pairDirections(self, predict_label_pairs, predict_types):
+        """direction (0-8) of each (predict, label) pair, -1 for pairs without both sides"""
+        directionIdxes = np.where(np.logical_and(predict_label_pairs[:,0]>-1, predict_label_pairs[:,1]>-1))[0]
+        if not self.segmentation:
+            directionVectors = self.raw_predicts[predict_label_pairs[directionIdxes,0]][:,[2,3]] - self.raw_labels[predict_label_pairs[directionIdxes,1]][:,[1,2]]
+        else:
+            directionVectors = self.predict_bbox[predict_label_pairs[directionIdxes,0]][:, [0, 1]] - self.label_bbox[predict_label_pairs[directionIdxes,1]][:, [0, 1]]
+        directionNorm = np.sqrt(np.power(directionVectors[:,0], 2)+ np.power(directionVectors[:,1], 2))
+        directionCos = directionVectors[:,0]/(directionNorm + 1e-5)
+        directions = np.zeros(directionCos.shape[0], dtype=np.int32)
+        directionSplits = np.array([math.cos(angle/180*math.pi) for angle in [180, 157.5, 112.5, 67.5, 22.5, 0]])
+        for i in range(2,len(directionSplits)):
+            directions[np.logical_and(directionCos>directionSplits[i-1], directionCos<=directionSplits[i])] = i-1
+        # starts from <-: 0, and clock-wise to 7, middle point as 8
+        # if directionVectors[:,1]>0, means direction downward, as the y coordinate is downward!!!
+        negaYs = np.logical_and(directionVectors[:,1]>0, directions!=0)
+        directions[negaYs] = 8-directions[negaYs]
+        pair_directions = -1*np.ones(predict_label_pairs.shape[0], dtype=np.int32)
+        pair_directions[directionIdxes] = directions
+        # assign predicts with no Loc error under this iou_thres to 8
+        pair_directions[np.isin(predict_types, [1, 2, 5])] = 8
+        return pair_directions
+
+    def featureDim(self, feature_files):
+        for path in feature_files:
+            if path is not None:
+                return FeatureFileReader(path).shape[1]
+        for feature_dir in [self.features_path, self.gt_features_path]:
+            for name in os.listdir(feature_dir):
+                return np.load(os.path.join(feature_dir, name), mmap_mode='r').shape[1]
+        return 256
+
+    def readFeatures(self, side, feature_dir, feature_file, imageid2raw, features, imageids):
+        """fill features of the given images (side: 'label' or 'predict'), from the consolidated feature file
+        if exists (always read entirely), else from feature_dir/<image>.npy
+
+        Returns:
+            number of boxes of the given images left without features (zeros)
+        """
+        if feature_file is None:
+            return self.readFeatureRows(feature_dir, imageid2raw, features, imageids)
+        reader = FeatureFileReader(feature_file)
+        annotation_images = None
+        bulk_file = find_bulk_file(self.root_path, side + "s")
+        if reader.images is None and bulk_file is not None:
+            # rows follow the annotations of the consolidated file, in file order
+            bulk_reader = BulkAnnotationReader(self.image2index, self.classID2Idx, segmentation=self.segmentation)
+            if side == 'predict':
+                # image file names of COCO results come from the labels file
+                label_file = find_bulk_file(self.root_path, "labels")
+                if label_file is not None:
+                    bulk_reader.annotation_images(label_file)
+            annotation_images = bulk_reader.annotation_images(bulk_file)
+        row_map, extra = reader.row_map(self.image2index, imageid2raw, annotation_images)
+        if extra > 0:
+            self.logger.warning("%d rows of %s do not match any box" % (extra, feature_file))
+        filled = np.zeros(len(features), dtype=bool)
+        for start, chunk in tqdm(reader.chunks(), total=math.ceil(reader.shape[0] / 65536), desc=os.path.basename(feature_file)):
+            rows = row_map[start:start+len(chunk)]
+            valid = rows >= 0
+            features[rows[valid]] = chunk[valid]
+            filled[rows[valid]] = True
+        return int(np.sum(~filled))
+
+    def readFeatureRows(self, feature_dir, imageid2raw, features, imageids):
+        """fill the rows of the given images from feature_dir/<image>.npy"""
+        missing = 0
+        for imageid in imageids:
+            start, end = imageid2raw[imageid]
+            if end == start:
+                continue # image without boxes
+            feature_path = os.path.join(feature_dir, self.index2image[imageid]+'.npy')
+            if not os.path.exists(feature_path):
+                missing += end - start
+                continue
+            feature = np.load(feature_path)
+            if feature.shape[0] != end - start:
+                self.logger.warning("%s has %d rows for %d boxes" % (feature_path, feature.shape[0], end - start))
+                missing += end - start
+                continue
+            features[start:end] = feature
+        return missing
+
+    def splicePairs(self, pairs_map):
+        """update pairs of the buffer with the images changed in this run, pairs of other images
+        are kept and re-indexed to the spliced raw data
+        """
+        changes = self.raw_changes
+        is_changed = np.zeros(len(self.image2index), dtype=bool)
+        is_changed[changes['images']] = True
+        changed_pairs_map = self.compute_label_predict_pair(changes['images'])
+        new_pairs_map = {}
+        for iou_thres in pairs_map:
+            new_pairs_map[iou_thres] = {}
+            for conf_thres in pairs_map[iou_thres]:
+                pairs, ious, types = pairs_map[iou_thres][conf_thres]
+                keep = ~is_changed[pair_imageids(pairs, changes['predict2imageid'], changes['label2imageid'])]
+                kept_pairs = np.array(pairs[keep])
+                has_pr, has_gt = kept_pairs[:, 0] > -1, kept_pairs[:, 1] > -1
+                kept_pairs[has_pr, 0] = changes['predict_map'][kept_pairs[has_pr, 0]]
+                kept_pairs[has_gt, 1] = changes['label_map'][kept_pairs[has_gt, 1]]
+                if iou_thres not in changed_pairs_map or conf_thres not in changed_pairs_map[iou_thres]:
+                    continue
+                new_pairs, new_ious, new_types = changed_pairs_map[iou_thres][conf_thres]
+                pairs = np.concatenate((kept_pairs, new_pairs)).astype(pairs.dtype)
+                ious = np.concatenate((ious[keep], new_ious))
+                types = np.concatenate((types[keep], new_types)).astype(types.dtype)
+                # pairs are ordered by image
+                order = np.argsort(pair_imageids(pairs, self.raw_predict2imageid, self.raw_label2imageid), kind='stable')
+                new_pairs_map[iou_thres][conf_thres] = (pairs[order], ious[order], types[order])
+        return new_pairs_map
 
     def getMetaData(self):
         return {
@@ -358,252 +721,459 @@ class DataCtrler(object):
             conf_thres = query["conf_thres"]
         return iou_thres, conf_thres
 
-    def compute_label_predict_pair(self):
+    def compute_label_predict_pair(self, imageids=None, settings=None, workers=None):
+        """match predicts and labels of all images, or only the given images, under each (iou, conf) threshold
 
-        def compute_per_image(detections, labels, pos_thres, conf_thres, bg_thres=0.1, max_det=100):
-            if not self.segmentation:
-                pr_bbox = detections[:, 2:6]
-                pr_cat = detections[:, 0].astype(np.int32)
-                pr_conf = detections[:, 1]
-                gt_bbox = labels[:, 1:5]
-                gt_iscrowd = labels[:,5].astype(np.int32)
-                gt_cat = labels[:,0].astype(np.int32)
-                iou_pair = cal_iou(pr_bbox, gt_bbox, gt_iscrowd)
-            else:
-                pr_cat = detections[0][:, 0].astype(np.int32)
-                pr_conf = detections[0][:, 1]
-                gt_iscrowd = labels[0][:,1].astype(np.int32)
-                gt_cat = labels[0][:,0].astype(np.int32)
-                iou_pair = mask_util.iou([{'size': list(im_size), 'counts': rle} for rle, im_size in zip(detections[1], detections[0][:, 2:].astype(np.int32))],
-                                         [{'size': list(im_size), 'counts': rle} for rle, im_size in zip(labels[1], labels[0][:, 2:].astype(np.int32))], gt_iscrowd)
-
-            ret_ious = np.zeros(0)
-            ret_match = -1*np.ones((0, 2), dtype=np.int32)
-            # define type here
-            # -1 for ignored, 0 for abandoned;
-            # 1~4 for TP, Cls(confusion), Loc, and Cls+Loc
-            # 5~8 for Dup, Cls+Dup, Loc+Dup, and Cls+Loc+Dup
-            # 9 for Bkgd, 10 for Miss
-            # 11 for Cls+Dup (only one for each gt), 12 Cls+Loc+Dup (only one for each gt)
-            ret_type = np.zeros(0, dtype=np.int32)
-            pr_idx = np.where(pr_conf > conf_thres)[0]
-            pr_idx = pr_idx[np.argsort(-pr_conf[pr_idx])]
-            gt_match_cnt = np.zeros_like(gt_cat)
-            gt_find_tp = np.zeros_like(gt_cat)
-            cat_match_cnt = [0 for _ in range(len(self.names))]
-            for _pr_idx in pr_idx:
-                cat_match_cnt[pr_cat[_pr_idx]] += 1
-                if cat_match_cnt[pr_cat[_pr_idx]] > max_det:
-                    continue
-                possible_match_gt = np.where(iou_pair[_pr_idx, :]>bg_thres)[0]
-                if len(possible_match_gt) == 0:
-                    ret_ious = np.concatenate((ret_ious, [0]))
-                    ret_match = np.concatenate((ret_match, np.array([[_pr_idx, -1]])))
-                    ret_type = np.concatenate((ret_type, [9])) # Bkgd
-                    continue
-                same_cat_gt = possible_match_gt[gt_cat[possible_match_gt]==pr_cat[_pr_idx]]
-                find_TP_match = False
-                if len(same_cat_gt) > 0:
-                    same_cat_gt = same_cat_gt[np.argsort(-iou_pair[_pr_idx, same_cat_gt])]
-                    not_is_crowd_match = same_cat_gt[gt_iscrowd[same_cat_gt]==0]
-                    is_crowd_match = same_cat_gt[gt_iscrowd[same_cat_gt]==1]
-                    # first try match with not iscrowd gt
-                    if len(not_is_crowd_match) > 0:
-                        # select gt with largest IoU
-                        for _gt in not_is_crowd_match:
-                            if iou_pair[_pr_idx, _gt] >= pos_thres:
-                                if gt_find_tp[_gt] == 0:
-                                    find_TP_match = True
-                                    best_match = _gt
-                                    gt_find_tp[_gt] = 1
-                                    break
-                            else:
-                                break
-                        if not find_TP_match:
-                            best_match = not_is_crowd_match[np.argmax(
-                                iou_pair[_pr_idx, not_is_crowd_match] + np.exp(-gt_match_cnt[not_is_crowd_match])
-                            )]
-                    # if cannot match with not iscrowd gt, try if can match with iscrowd gt
-                    if not find_TP_match and len(is_crowd_match) > 0:
-                        # if cannot find TP match and can match with iscrowd object, ignore
-                        if iou_pair[_pr_idx, is_crowd_match[0]] >= pos_thres:
-                            continue
-                    if len(not_is_crowd_match) > 0:
-                        gt_match_cnt[best_match] += 1
-                        ret_ious = np.concatenate((ret_ious, [iou_pair[_pr_idx, best_match]]))
-                        ret_match = np.concatenate((ret_match, np.array([[_pr_idx, best_match]])))
-                        if iou_pair[_pr_idx, best_match] >= pos_thres:
-                            # mark as Dup here, will edit the one with largest confidence to TP
-                            ret_type = np.concatenate((ret_type, [5]))
-                        else:
-                            ret_type = np.concatenate((ret_type, [7])) # Loc
-                        continue # if found TP match, do not match Cls error
-                diff_cat_gt = possible_match_gt[gt_cat[possible_match_gt]!=pr_cat[_pr_idx]]
-                diff_cat_gt = diff_cat_gt[gt_iscrowd[diff_cat_gt]==0]
-                if len(diff_cat_gt) > 0:
-                    # match only one Cls error
-                    best_match = diff_cat_gt[np.argmax(
-                        iou_pair[_pr_idx, diff_cat_gt] + np.exp(-gt_match_cnt[diff_cat_gt])
-                    )]
-                    gt_match_cnt[best_match] += 1
-                    ret_ious = np.concatenate((ret_ious, [iou_pair[_pr_idx, best_match]]))
-                    ret_match = np.concatenate((ret_match, np.array([[_pr_idx, best_match]])))
-                    if iou_pair[_pr_idx, best_match] >= pos_thres:
-                        ret_type = np.concatenate((ret_type, [6])) # Cls
-                    else:
-                        ret_type = np.concatenate((ret_type, [8])) # Cls+Loc
-                    continue
-                # some pr may be matched with iscrowd gt, but did not reach a large enough iou, cannot be processed above
-                ret_ious = np.concatenate((ret_ious, [0]))
-                ret_match = np.concatenate((ret_match, np.array([[_pr_idx, -1]])))
-                ret_type = np.concatenate((ret_type, [9])) # Bkgd
-
-            for _gt_idx in np.where(gt_iscrowd==0)[0]:
-                # if not matched as TP, Loc or Cls, consider as Miss (even if matched as Cls+Loc)
-                if _gt_idx not in ret_match[ret_type!=8,1]:
-                    ret_ious = np.concatenate((ret_ious, [0]))
-                    ret_match = np.concatenate((ret_match, np.array([[-1, _gt_idx]])))
-                    ret_type = np.concatenate((ret_type, [10])) # Miss
-                gtm_pr_list = (ret_match[:, 1]==_gt_idx) & (ret_match[:, 0]!=-1)
-                # select only one Non-Dup pair for each gt
-                # in the order [TP, Loc, Cls, Loc+Cls]
-                for rt in [5, 7, 6, 8]:
-                    match_prs = ret_match[np.logical_and(gtm_pr_list, ret_type==rt), 0]
-                    if len(match_prs) > 0:
-                        best_match = match_prs[np.argsort(-pr_conf[match_prs])[0]]
-                        # edit type of best_match to non-dup type by minus 4
-                        ret_type[np.logical_and(ret_match[:,0]==best_match, gtm_pr_list)] = rt - 4
-                        break
-
-                # select one non-dup pair for each pr cat
-                if len(pr_cat) == 0:
-                    continue
-                ret_pr_cat = pr_cat[ret_match[:, 0]]
-                gtm_pr_cat = np.unique(ret_pr_cat[gtm_pr_list])
-                for _cat in gtm_pr_cat:
-                    if _cat == gt_cat[_gt_idx]:
-                        continue
-                    # if has been matched in a non-dup pair, continue
-                    if np.any(ret_type[gtm_pr_list & (ret_pr_cat==_cat)]<=4):
-                        continue
-                    match_prs = ret_match[gtm_pr_list & (ret_type==6) & (ret_pr_cat==_cat), 0]
-                    if len(match_prs) > 0:
-                        best_match = match_prs[np.argsort(-pr_conf[match_prs])[0]]
-                        # edit type of best_match to cls
-                        ret_type[np.logical_and(ret_match[:,0]==best_match, gtm_pr_list)] = 11
-                    else:
-                        match_prs = ret_match[gtm_pr_list & (ret_type==8) & (ret_pr_cat==_cat), 0]
-                        if len(match_prs) > 0:
-                            best_match = match_prs[np.argsort(-pr_conf[match_prs])[0]]
-                            # edit type of best_match to cls+loc
-                            ret_type[np.logical_and(ret_match[:,0]==best_match, gtm_pr_list)] = 12
-
-            return ret_match, ret_ious, ret_type
-
-        self.pairs_map_under_iou_thresholds = {}
-        bg_thres = 0.1 # minimum overlap
-        for pos_thres in self.iou_thresholds:
-            self.pairs_map_under_iou_thresholds[pos_thres] = {}
-            for conf_thres in self.conf_thresholds:
-                # only contains matched gt and pr
-                predict_label_pairs = -1*np.ones((0, 2), dtype=np.int32)
-                predict_label_ious = np.zeros(0)
-                predict_type = np.zeros(0, dtype=np.int32)
-                for imageidx in tqdm(range(len(self.image2index))):
-                    if not self.segmentation:
-                        matches, ious, types = compute_per_image(self.raw_predicts[self.imageid2raw_predict[imageidx][0]:self.imageid2raw_predict[imageidx][1]],
-                                                    self.raw_labels[self.imageid2raw_label[imageidx][0]:self.imageid2raw_label[imageidx][1]], pos_thres, conf_thres, bg_thres)
-                    else:
-                        matches, ious, types = compute_per_image((self.raw_predicts[self.imageid2raw_predict[imageidx][0]:self.imageid2raw_predict[imageidx][1]],
-                                                                self.predict_masks[self.imageid2raw_predict[imageidx][0]:self.imageid2raw_predict[imageidx][1]]),
-                                                                (self.raw_labels[self.imageid2raw_label[imageidx][0]:self.imageid2raw_label[imageidx][1]],
-                                                                self.label_masks[self.imageid2raw_label[imageidx][0]:self.imageid2raw_label[imageidx][1]]), 
-                                                                pos_thres, conf_thres, bg_thres)
-                    if len(matches)>0:
-                        matches[matches[:,1]!=-1,1]+=self.imageid2raw_label[imageidx][0]
-                        matches[matches[:,0]!=-1,0]+=self.imageid2raw_predict[imageidx][0]
-                        predict_label_pairs = np.concatenate((predict_label_pairs, matches))
-                        predict_label_ious = np.concatenate((predict_label_ious, ious))
-                        predict_type = np.concatenate((predict_type, types))
-                self.pairs_map_under_iou_thresholds[pos_thres][conf_thres] = (predict_label_pairs, predict_label_ious, predict_type)
-        return self.pairs_map_under_iou_thresholds
+        The IoU matrix of each image is read from the IoU store and matched under every threshold setting.
+
+        Args:
+            settings: list of (iou_thres, conf_thres), defaults to self.iou_thresholds x self.conf_thresholds
+            workers: defaults to self.workers
+        """
+        if imageids is None:
+            imageids = np.arange(len(self.image2index))
+        if settings is None:
+            settings = [(pos_thres, conf_thres) for pos_thres in self.iou_thresholds for conf_thres in self.conf_thresholds]
+        results = self.mapShards('matchImages', imageids, (settings,), workers, 'matching')
+
+        # merge shards in image order, indexes are already global
+        pairs_map = {}
+        for setting, (pos_thres, conf_thres) in enumerate(settings):
+            pairs_map.setdefault(pos_thres, {})[conf_thres] = tuple(
+                np.concatenate([empty] + [r[setting][i] for r in results]) for i, empty in enumerate(empty_pairs()))
+        return pairs_map
+
+    def mapShards(self, method, imageids, args=(), workers=None, desc=None):
+        """[self.<method>(shard, *args) for each shard of imageids], in shard order
+
+        Shards run in a process pool when workers > 1. Workers are forked and read the raw data
+        of this object without copying it.
+        """
+        shards = [imageids[start:start+MATCH_SHARD_SIZE] for start in range(0, len(imageids), MATCH_SHARD_SIZE)]
+        if workers is None:
+            workers = self.workers if self.workers is not None else os.cpu_count()
+        if workers > 1 and len(shards) > 1 and 'fork' in multiprocessing.get_all_start_methods():
+            global _pool_ctrler, _pool_tasks
+            _pool_ctrler, _pool_tasks = self, (method, args, shards)
+            try:
+                with multiprocessing.get_context('fork').Pool(min(workers, len(shards))) as pool:
+                    return list(tqdm(pool.imap(_shard_task, range(len(shards))), total=len(shards), desc=desc))
+            finally:
+                _pool_ctrler, _pool_tasks = None, None
+        return [getattr(self, method)(shard, *args) for shard in tqdm(shards, desc=desc)]
+
+    def loadIoUStore(self):
+        """IoU store of the buffer if computed from the current raw data, updated with the changed
+        images after an incremental update, else computed for all images
+        """
+        state = self.bufferState('ious')
+        if state is not None and (self.buffer.meta('ious').get('bg_thres') != BG_THRES or
+                self.buffer.meta('ious').get('dtype') != np.dtype(IOU_DTYPE).name):
+            state = None
+        if state == 'fresh':
+            self.ious = SparseIoUStore.from_columns(self.buffer.load('ious'), BG_THRES)
+            return
+        if state == 'previous':
+            # keep the rows of unchanged images, re-indexed to the spliced predicts
+            changes = self.raw_changes
+            is_changed = np.zeros(len(self.image2index), dtype=bool)
+            is_changed[changes['images']] = True
+            rows, cols, values = SparseIoUStore.from_columns(self.buffer.load('ious'), BG_THRES).coo()
+            keep = ~is_changed[changes['predict2imageid'][rows]]
+            new_rows, new_cols, new_values = self.computeIoU(changes['images'])
+            self.ious = SparseIoUStore.from_coo(len(self.raw_predicts), np.concatenate((changes['predict_map'][rows[keep]], new_rows)),
+                np.concatenate((cols[keep], new_cols)), np.concatenate((values[keep], new_values)), BG_THRES)
+        else:
+            self.ious = SparseIoUStore.from_coo(len(self.raw_predicts), *self.computeIoU(), bg_thres=BG_THRES)
+        self.buffer.save('ious', self.ious.columns(), {'digest': self.raw_digest, 'bg_thres': BG_THRES,
+            'dtype': np.dtype(IOU_DTYPE).name})
+
+    def computeIoU(self, imageids=None):
+        """(predict, local label index, IoU) of the pairs above BG_THRES in all images, or only the given images"""
+        if imageids is None:
+            imageids = np.arange(len(self.image2index))
+        results = self.mapShards('iouImages', imageids, desc='computing IoU')
+        return tuple(np.concatenate([empty] + [r[i] for r in results]) for i, empty in enumerate(empty_coo()))
+
+    def iouImages(self, imageids):
+        rows, cols, values = [], [], []
+        for imageidx in imageids:
+            pr_start = self.imageid2raw_predict[imageidx][0]
+            r, c, v = sparse_iou(self.imageIoU(imageidx), BG_THRES)
+            rows.append(r + pr_start)
+            cols.append(c)
+            values.append(v)
+        return tuple(np.concatenate([empty] + arrs) for empty, arrs in zip(empty_coo(), (rows, cols, values)))
+
+    def imageIoU(self, imageidx):
+        """n_pr * n_gt IoU matrix of the predicts and labels of an image"""
+        pr_start, pr_end = self.imageid2raw_predict[imageidx]
+        gt_start, gt_end = self.imageid2raw_label[imageidx]
+        if pr_end == pr_start or gt_end == gt_start:
+            return np.zeros((pr_end - pr_start, gt_end - gt_start))
+        if not self.segmentation:
+            return cal_iou(self.raw_predicts[pr_start:pr_end, 2:6], self.raw_labels[gt_start:gt_end, 1:5], self.raw_labels[gt_start:gt_end, 5].astype(np.int32))
+        # exact mask IoU only for the pairs whose boxes and areas allow an IoU above BG_THRES
+        return self.predict_masks[pr_start:pr_end].iou(self.label_masks[gt_start:gt_end], self.raw_labels[gt_start:gt_end, 1].astype(np.int32), BG_THRES)
+
+    def matchImages(self, imageids, settings, bg_thres=BG_THRES, max_det=100):
+        """(predict, label) pairs of the given images under each (iou, conf) setting, with global indexes
+
+        Returns:
+            list of (pairs, ious, types), one for each setting
+        """
+        assert bg_thres >= self.ious.bg_thres, "the IoU store only has pairs above {}".format(self.ious.bg_thres)
+        results = [([], [], []) for _ in settings]
+        for imageidx in imageids:
+            pr_start, pr_end = self.imageid2raw_predict[imageidx]
+            gt_start, gt_end = self.imageid2raw_label[imageidx]
+            detections, labels = self.raw_predicts[pr_start:pr_end], self.raw_labels[gt_start:gt_end]
+            pr_cat = detections[:, 0].astype(np.int32)
+            pr_conf = detections[:, 1]
+            gt_cat = labels[:,0].astype(np.int32)
+            gt_iscrowd = labels[:,5 if not self.segmentation else 1].astype(np.int32)
+            iou_pair = self.ious.dense(pr_start, pr_end, gt_end - gt_start)
+            for (pos_thres, conf_thres), (predict_label_pairs, predict_label_ious, predict_type) in zip(settings, results):
+                matches, ious, types = match_image(pr_cat, pr_conf, gt_cat, gt_iscrowd, iou_pair, pos_thres, conf_thres, bg_thres, max_det)
+                if len(matches)>0:
+                    matches[matches[:,1]!=-1,1]+=gt_start
+                    matches[matches[:,0]!=-1,0]+=pr_start
+                    predict_label_pairs.append(matches)
+                    predict_label_ious.append(ious)
+                    predict_type.append(types)
+        return [tuple(np.concatenate([empty] + arrs) for empty, arrs in zip(empty_pairs(), result)) for result in results]
     
-    def constructRangeTree(self):
-        self.rangeTrees = {}
+    def constructRangeTree(self, reuse=False):
+        """range trees of the precomputed settings, pinned in the threshold cache
+
+        With reuse, trees dumped to the buffer from the current raw data are loaded instead of built.
+        """
+        self.thresholdCache = ThresholdCache(self.threshold_cache_bytes)
+        self.queryCache = QueryCache(self.query_cache_bytes)
+        buffered_trees = {}
+        if reuse and self.bufferState('range_trees') == 'fresh':
+            buffered_trees = unpack_threshold_map(self.buffer.load('range_trees'), self.buffer.meta('range_trees'), 'tree')
+        trees, built = {}, False
         for iou_thres in self.iou_thresholds:
-            self.rangeTrees[iou_thres] = {}
             for conf_thres in self.conf_thresholds:
                 pairs, ious, types = self.pairs_map_under_iou_thresholds[iou_thres][conf_thres]
                 directions = self.directions_map[iou_thres][conf_thres]
+                tree = None
+                if conf_thres in buffered_trees.get(iou_thres, {}):
+                    tree = RangeTree()
+                    try:
+                        tree.Load(buffered_trees[iou_thres][conf_thres])
+                    except RuntimeError:
+                        # dumped by another version of the extension
+                        tree = None
+                if tree is None:
+                    tree = self.buildRangeTree(iou_thres, pairs, ious, types, directions)
+                    built = True
+                else:
+                    tree.SetThreads(self.query_threads, PARALLEL_QUERY_MIN_PAIRS)
+                trees.setdefault(iou_thres, {})[conf_thres] = tree
+                self.thresholdCache.pin(self.thresholdKey(iou_thres, conf_thres), {
+                    'pairs': (pairs, ious, types),
+                    'directions': directions,
+                    'tree': tree,
+                })
+        if built:
+            self.dumpThresholdMap('range_trees', {iou_thres: {conf_thres: np.frombuffer(tree.Dump(), dtype=np.uint8) 
+                for conf_thres, tree in conf_map.items()} for iou_thres, conf_map in trees.items()}, 'tree')
+
+    def buildRangeTree(self, iou_thres, pairs, ious, types, directions):
+        pr, gt = pairs[:, 0], pairs[:, 1]
+        has_pr, has_gt = pr != -1, gt != -1
+        # gt class, size, ar; background class and zeros for unmatched predicts
+        pair_gt_cat = pair_values(self.raw_labels[:, 0], gt, len(self.names)-1)
+        pair_gt_size = pair_values(np.minimum(1, self.label_size), gt, 0)
+        pair_gt_ar = pair_values(self.label_true_ar, gt, 0)
+        # pr class, size, ar, conf; background class and zeros for missed labels
+        pair_pr_cat = pair_values(self.raw_predicts[:, 0], pr, len(self.names)-1)
+        pair_pr_size = pair_values(self.predict_size, pr, 0)
+        pair_pr_ar = pair_values(self.predict_true_ar, pr, 0)
+        pair_pr_conf = pair_values(self.raw_predicts[:, 1], pr, 0)
+        # 1 if predict larger than label, 2 otherwise, 0 above the IoU threshold or without both sides
+        pair_size_cmp = np.zeros(len(pairs))
+        compared = has_pr & has_gt & ~(ious > iou_thres)
+        pair_size_cmp[compared] = np.where(self.predict_size[pr[compared]] > self.label_size[gt[compared]], 1, 2)
+        tree = RangeTree()
+        tree.AddFeatures(RANGE_TREE_FEATURES)
+        tmp_directions = directions.copy()
+        tmp_directions[tmp_directions==-1] = 8
+        data = np.stack([pair_gt_ar, pair_gt_size, pair_pr_size, pair_pr_ar,
+                         pair_pr_conf, pair_pr_cat, pair_gt_cat, types, pair_size_cmp, tmp_directions], axis=1).astype(np.float64)
+        tree.Init(data)
+        tree.SetThreads(self.query_threads, PARALLEL_QUERY_MIN_PAIRS)
+        return tree
+
+    def thresholdKey(self, iou_thres, conf_thres):
+        """canonical (iou_thres, conf_thres), thresholds of requests may differ from the precomputed ones in the last bits"""
+        return round(float(iou_thres), 4), round(float(conf_thres), 4)
+
+    def thresholdResult(self, iou_thres, conf_thres):
+        """pairs, directions and range tree of one setting, computed on demand if not precomputed"""
+        key = self.thresholdKey(iou_thres, conf_thres)
+        return self.thresholdCache.get(key, lambda: self.computeThresholdResult(*key))
+
+    def computeThresholdResult(self, iou_thres, conf_thres):
+        self.logger.info("match under iou_thres %s, conf_thres %s" % (iou_thres, conf_thres))
+        # forking the pool from a request thread of the threaded server is not safe, match serially
+        pairs, ious, types = self.compute_label_predict_pair(settings=[(iou_thres, conf_thres)], workers=1)[iou_thres][conf_thres]
+        directions = self.pairDirections(pairs, types)
+        result = {
+            'pairs': (pairs, ious, types),
+            'directions': directions,
+            'tree': self.buildRangeTree(iou_thres, pairs, ious, types, directions),
+        }
+        # results of an evicted tree of this setting are not reused for the new one
+        self.queryCache.invalidate(self.thresholdKey(iou_thres, conf_thres))
+        nbytes = pairs.nbytes + ious.nbytes + types.nbytes + directions.nbytes + len(pairs) * (RANGE_TREE_BYTES_PER_PAIR + len(self.names) // 4)
+        return result, nbytes
+
+    def getPairs(self, iou_thres, conf_thres):
+        return self.thresholdResult(iou_thres, conf_thres)['pairs']
+
+    def getDirections(self, iou_thres, conf_thres):
+        return self.thresholdResult(iou_thres, conf_thres)['directions']
+
+    def getRangeTree(self, iou_thres, conf_thres):
+        return self.thresholdResult(iou_thres, conf_thres)['tree']
+
+    def queryRangeTree(self, iou_thres, conf_thres, method, *args):
+        """tree.<method>(*args) on the range tree of (iou_thres, conf_thres), through the query cache
+
+        Results are shared between requests and read-only: arrays are not writeable and lists are tuples.
+        """
+        return self.queryCache.get(self.queryKey(iou_thres, conf_thres, method, args),
+                                   lambda: self.computeQuery(iou_thres, conf_thres, method, args))
+
+    def queryKey(self, iou_thres, conf_thres, method, args):
+        # rows and columns of a matrix follow the order of the values of its two features
+        ordered = args[:2] if method in ('QueryMatrix', 'QueryGroupBy') else ()
+        return (self.thresholdKey(iou_thres, conf_thres), method) + tuple(canonical_arg(arg, RANGE_TREE_RANGES, ordered) for arg in args)
+
+    def computeQuery(self, iou_thres, conf_thres, method, args):
+        result = self.cubeResult(iou_thres, conf_thres, method, args)
+        if result is None:
+            result = getattr(self.getRangeTree(iou_thres, conf_thres), method)(*args)
+        return result
+
+    def queryDistributions(self, iou_thres, conf_thres, targets):
+        """QueryDistribution of each (key, query, attrs) target, through the query cache
+
+        Targets that are not cached and not answered by an already built cube share one traversal of
+        RangeTree.QueryDistributions, each result is cached as the QueryDistribution of its target.
+        """
+        keys = [self.queryKey(iou_thres, conf_thres, 'QueryDistribution', target) for target in targets]
+        computed = {}
+        for i, key in enumerate(keys):
+            if key not in self.queryCache:
+                computed[i] = self.cubeResult(iou_thres, conf_thres, 'QueryDistribution', targets[i], build=False)
+        traversed = [i for i, result in computed.items() if result is None]
+        if len(traversed) > 0:
+            tree = self.getRangeTree(iou_thres, conf_thres)
+            computed.update(zip(traversed, tree.QueryDistributions([targets[i] for i in traversed])))
+
+        def compute(i):
+            # evicted since checked, computed alone
+            if computed.get(i) is None:
+                return self.computeQuery(iou_thres, conf_thres, 'QueryDistribution', targets[i])
+            return computed[i]
+        return [self.queryCache.get(key, lambda i=i: compute(i)) for i, key in enumerate(keys)]
+
+    def rangeBounds(self, iou_thres, conf_thres):
+        """float32 (min, max) of each continuous feature of the range tree"""
+        def compute():
+            tree = self.getRangeTree(iou_thres, conf_thres)
+            bounds = {}
+            for name in RANGE_TREE_RANGES:
+                values = tree.GetColumn(name).astype(np.float32)
+                bounds[name] = (values.min(), values.max()) if len(values) > 0 else (np.float32(0), np.float32(0))
+            return bounds
+        return self.queryCache.get((self.thresholdKey(iou_thres, conf_thres), 'bounds'), compute)
+
+    def cubeResult(self, iou_thres, conf_thres, method, args, build=True):
+        """result of QueryGroupBy or QueryDistribution from a prefix cube, None if the query does not fit one
+
+        A cube counts the pairs matching the 'other' features of the query by bin of one continuous
+        feature. It answers the queries restricting that feature only, the others covering all pairs,
+        and is kept in the query cache for the next queries that only move the range of the feature.
+        It is built on the second query missing it, or never without build, None until then.
+        """
+        if method == 'QueryGroupBy':
+            row, col, groups, query = args
+            target, signature = None, (row, col, canonical_arg(groups, RANGE_TREE_RANGES))
+        elif method == 'QueryDistribution':
+            target, query, attrs = args
+            min_value, max_value = float(attrs.get('min', 0.0)), float(attrs.get('max', 1.0))
+            signature = (target, min_value, max_value)
+        else:
+            return None
+        bounds = self.rangeBounds(iou_thres, conf_thres)
+        ranges = {name: query.get(name, [-np.inf, np.inf]) for name in RANGE_TREE_RANGES}
+        restricted = [name for name in RANGE_TREE_RANGES if not (np.float32(ranges[name][0]) <= bounds[name][0] and
+                                                                   np.float32(ranges[name][1]) >= bounds[name][1])]
+        if len(restricted) > 1:
+            return None
+        feature = restricted[0] if restricted else (target or RANGE_TREE_RANGES[-1])
+        if target is not None and max(np.float32(ranges[target][0]), bounds[target][0]) < np.float32(min_value):
+            # pairs below the histogram, answered by the tree as before
+            return None
+        categorical = {name: values for name, values in query.items() if name not in RANGE_TREE_RANGES}
+        ordered = (row, col) if target is None else ()
+        if target is None:
+            depths = [len(values) if name else 1 for name, values in groups]
+            n_cells = len(query[row]) * len(query[col]) * sum(depths)
+        else:
+            n_cells = CUBE_BINS
+        if (CUBE_BINS + 2) * n_cells * 4 > self.query_cache_bytes // 4:
+            return None
+        key = (self.thresholdKey(iou_thres, conf_thres), 'cube', method, feature, signature,
+               canonical_arg(categorical, RANGE_TREE_RANGES, ordered))
+        if key not in self.queryCache:
+            if not build:
+                return None
+            # a cube costs more than several tree queries, built on the second miss of the same
+            # (feature, filter), the first one is answered by the tree
+            missed = key[:1] + ('cube miss',) + key[2:]
+            if missed not in self.queryCache:
+                self.queryCache.get(missed, lambda: True)
+                return None
+        cube = self.queryCache.get(key, lambda: (self.buildGroupByCube(iou_thres, conf_thres, feature, row, col, groups, categorical)
+            if target is None else self.buildDistributionCube(iou_thres, conf_thres, feature, target, min_value, max_value, categorical)))
+
+        # exact counts: the cube up to the bin edges, the range tree for the rest of the range
+        counts, rest = cube.between(*ranges[feature])
+        tree = self.getRangeTree(iou_thres, conf_thres)
+        for sign, rest_range in rest:
+            if feature == target:
+                # the cube leaves out the pairs below min_value, in float32 as the bounds of the tree
+                rest_range = [max(rest_range[0], float(np.float32(min_value))), rest_range[1]]
+                if rest_range[0] > rest_range[1]:
+                    continue
+            rest_query = {**query, feature: rest_range}
+            if target is None:
+                sub = tree.QueryGroupBy(row, col, groups, rest_query)
+                counts += sign * np.concatenate(sub, axis=2).ravel()
+            else:
+                counts += sign * np.asarray(tree.QueryDistribution(target, rest_query, attrs)[1])
+        if target is not None:
+            return distribution_edges(min_value, max_value), counts.tolist()
+        tensor = counts.reshape(len(query[row]), len(query[col]), sum(depths)).astype(np.int32)
+        return [np.ascontiguousarray(part) for part in np.split(tensor, np.cumsum(depths)[:-1], axis=2)]
 
-                pair_pr_size, pair_pr_cat, pair_pr_ar, pair_gt_size, pair_gt_cat, pair_gt_ar, pair_pr_conf = [],[],[],[],[],[],[]
-                pair_size_cmp = []
-                for p, i, t, d in tqdm(zip(pairs, ious, types, directions)):
-                    pr, gt = p[0], p[1]
-                    # gt class, size, ar
-                    if gt == -1:
-                        pair_gt_cat.append(len(self.names)-1)
-                        pair_gt_size.append(0)
-                        pair_gt_ar.append(0)
-                        pair_size_cmp.append(0)
-                    else:
-                        pair_gt_cat.append(self.raw_labels[gt, 0])
-                        pair_gt_size.append(min(1,self.label_size[gt]))
-                        pair_gt_ar.append(self.label_true_ar[gt])
-                        if pr == -1:
-                            pair_size_cmp.append(0)
-                        else:
-                            if i > iou_thres:
-                                pair_size_cmp.append(0)
-                            else:
-                                if self.predict_size[pr] > self.label_size[gt]:
-                                    pair_size_cmp.append(1)
-                                else:
-                                    pair_size_cmp.append(2)
-                    # pr class, size, ar, conf
-                    if pr == -1:
-                        pair_pr_cat.append(len(self.names)-1)
-                        pair_pr_size.append(0)
-                        pair_pr_ar.append(0)
-                        pair_pr_conf.append(0)
-                    else:
-                        pair_pr_cat.append(self.raw_predicts[pr, 0])
-                        pair_pr_size.append(self.predict_size[pr])
-                        pair_pr_ar.append(self.predict_true_ar[pr])
-                        pair_pr_conf.append(self.raw_predicts[pr, 1])
-
-                pair_pr_cat, pair_gt_cat = np.array(pair_pr_cat), np.array(pair_gt_cat)
-                pair_size_cmp = np.array(pair_size_cmp)
-                pair_pr_conf, pair_pr_size, pair_pr_ar, pair_gt_size, pair_gt_ar = \
-                    np.array(pair_pr_conf), np.array(pair_pr_size), np.array(pair_pr_ar), np.array(pair_gt_size), np.array(pair_gt_ar)
-                tree = RangeTree()
-                tree.AddFeatures([
-                    ('label_aspect_ratio', 'index', 0),
-                    ('label_size', 'index', 1),
-                    ('predict_size', 'index', 2),
-                    ('predict_aspect_ratio', 'index', 3),
-                    ('conf_range', 'index', 4),
-                    ('predict', 'other', 5),
-                    ('label', 'other', 6),
-                    ('types', 'other', 7),
-                    ('size_comparison', 'other', 8),
-                    ('direction', 'other', 9)
-                ])
-                tmp_directions = directions.copy()
-                tmp_directions[tmp_directions==-1] = 8
-                data = np.concatenate([[pair_gt_ar], [pair_gt_size], [pair_pr_size], [pair_pr_ar], 
-                                       [pair_pr_conf], [pair_pr_cat], [pair_gt_cat], [types], [pair_size_cmp], [tmp_directions]]).T
-                tree.Init(data)
-                self.rangeTrees[iou_thres][conf_thres] = tree
+    def categoricalMasks(self, tree, categorical, grouped=()):
+        """pairs matching the 'other' features of the query except grouped, and per grouped feature"""
+        n = len(tree.GetColumn(RANGE_TREE_RANGES[0]))
+        base, passes = np.ones(n, dtype=bool), {}
+        for name, values in categorical.items():
+            inside = np.isin(tree.GetColumn(name), values)
+            if name in grouped:
+                passes[name] = inside
+            else:
+                base &= inside
+        return base, passes
+
+    def buildGroupByCube(self, iou_thres, conf_thres, feature, row, col, groups, categorical):
+        """cube of QueryGroupBy(row, col, groups, query), cells are row * col * group value"""
+        tree = self.getRangeTree(iou_thres, conf_thres)
+        grouped = [name for name, _ in groups if name]
+        base, passes = self.categoricalMasks(tree, categorical, grouped)
+        n_col = len(categorical[col])
+        depth = sum(len(values) if name else 1 for name, values in groups)
+        cell = (value_positions(tree.GetColumn(row), categorical[row]) * n_col + value_positions(tree.GetColumn(col), categorical[col])) * depth
+        feature_values = tree.GetColumn(feature)
+        # a pair counts for a group if it matches the query except the filter of the grouped feature
+        values, cells, offset = [], [], 0
+        for name, group_values in groups:
+            selected = base.copy()
+            for other, inside in passes.items():
+                if other != name:
+                    selected &= inside
+            if name:
+                position = value_positions(tree.GetColumn(name), group_values)
+                selected &= position >= 0
+                cells.append(cell[selected] + offset + position[selected])
+                offset += len(group_values)
+            else:
+                cells.append(cell[selected] + offset)
+                offset += 1
+            values.append(feature_values[selected])
+        n_cells = len(categorical[row]) * n_col * depth
+        return PrefixCube(np.concatenate(values), np.concatenate(cells), n_cells, *self.rangeBounds(iou_thres, conf_thres)[feature])
+
+    def buildDistributionCube(self, iou_thres, conf_thres, feature, target, min_value, max_value, categorical):
+        """cube of QueryDistribution(target, query, {min, max}), cells are the histogram bins"""
+        tree = self.getRangeTree(iou_thres, conf_thres)
+        base, _ = self.categoricalMasks(tree, categorical)
+        # pairs below min_value are outside every range answered from the cube
+        base &= tree.GetColumn(target) >= np.float32(min_value)
+        cells = distribution_bins(tree.GetColumn(target)[base], min_value, max_value)
+        return PrefixCube(tree.GetColumn(feature)[base], cells, CUBE_BINS, *self.rangeBounds(iou_thres, conf_thres)[feature])
+
+    def queryMask(self, tree, query):
+        """pairs selected by a range tree query, from the columns of the tree"""
+        mask = np.ones(len(tree.GetColumn(RANGE_TREE_RANGES[0])), dtype=bool)
+        for name, values in query.items():
+            column = tree.GetColumn(name)
+            if name in RANGE_TREE_RANGES:
+                # bounds in float32, as in the tree
+                mask &= (column >= np.float32(values[0])) & (column <= np.float32(values[1]))
+            else:
+                mask &= np.isin(column, values)
+        return mask
+
+    def baselineDistribution(self, iou_thres, conf_thres, target_attr, attr_range):
+        """distribution of target_attr over attr_range under the default query
+
+        The sorted values of target_attr of the pairs in its unfiltered histograms are computed once per
+        threshold and kept in the query cache, each histogram is then a slice of them.
+        """
+        _, query, _ = self.distributionTarget(self.getQuery(None), target_attr, attr_range)
+
+        def compute():
+            tree = self.getRangeTree(iou_thres, conf_thres)
+            others = {name: values for name, values in query.items() if name != target_attr}
+            return np.sort(tree.GetColumn(target_attr)[self.queryMask(tree, others)].astype(np.float32))
+        values = self.queryCache.get((self.thresholdKey(iou_thres, conf_thres), 'baseline', target_attr), compute)
+        start = np.searchsorted(values, np.float32(query[target_attr][0]), side='left')
+        end = np.searchsorted(values, np.float32(query[target_attr][1]), side='right')
+        bins = distribution_bins(values[start:end], attr_range[0], attr_range[1])
+        return np.bincount(bins, minlength=CUBE_BINS).tolist()
+
+    def approximateSample(self, iou_thres, conf_thres):
+        """stratified sample of the pairs of the range tree, once per threshold"""
+        def compute():
+            tree = self.getRangeTree(iou_thres, conf_thres)
+            return StratifiedSample.from_tree(tree, [name for name, _, _ in RANGE_TREE_FEATURES], len(self.names)-1, self.approx_sample_pairs)
+        return self.queryCache.get((self.thresholdKey(iou_thres, conf_thres), 'sample'), compute)
+
+    def isApproximate(self, query):
+        """requests answered from the stratified sample, their exact answers follow once they settle"""
+        return query is not None and bool(query.get('approximate', False))
+
+    def approximateDistributions(self, iou_thres, conf_thres, targets):
+        """(counts, errors) of QueryDistribution of each target from the sample
+
+        The exact distributions are computed in the background once no approximate query came for
+        APPROX_SETTLE_SECONDS, the next exact request finds them in the query cache.
+        """
+        sample = self.approximateSample(iou_thres, conf_thres)
+        dists = [sample.distribution(*target, RANGE_TREE_RANGES) for target in targets]
+        self.exactQueries.submit(lambda: self.queryDistributions(iou_thres, conf_thres, targets))
+        return [counts.tolist() for _, counts, _ in dists], [np.round(errors, 2).tolist() for _, _, errors in dists]
+
+    def getQueryCacheStats(self):
+        return self.queryCache.stats()
 
     def filterSamples(self, query = None):
         """
-            return index of pairs in predict_label_pairs
+            return index of pairs in predict_label_pairs, as a read-only int32 array
         """
         iou_thres, conf_thres = self.getThresholds(query)
-        tree = self.rangeTrees[iou_thres][conf_thres]
         query = self.getQuery(query)
-        sample_idx = tree.QueryIndex(query)
+        sample_idx = self.queryRangeTree(iou_thres, conf_thres, 'QueryIndex', query)
         return sample_idx
 
     def getQuery(self, query):
@@ -629,22 +1199,37 @@ class DataCtrler(object):
 
     def hoverMatrixCell(self, query, targets):
         iou_thres, conf_thres = self.getThresholds(query)
-        tree = self.rangeTrees[iou_thres][conf_thres]
         ret_dict = {}
+        approximate = self.isApproximate(query)
         query = self.getQuery(query)
-        for tar, ran in targets.items():
-            if tar.startswith('conf') or tar.startswith('pr'):
-                query_types = [1, 2, 3, 4, 5, 6, 7, 8, 9, 11, 12]
-            else:
-                query_types = [1, 2, 3, 4, 10]
-            dist = tree.QueryDistribution(tar, {
-                **query,
-                tar: [max(ran[0], query[tar][0]), min(ran[1], query[tar][1])],
-                "types": query_types,
-            }, {'min': ran[0], 'max': ran[1]})[1]
+        dist_targets = [self.distributionTarget(query, tar, ran) for tar, ran in targets.items()]
+        if approximate:
+            dists, errors = self.approximateDistributions(iou_thres, conf_thres, dist_targets)
+            ret_dict['approximate'] = True
+            ret_dict['error'] = dict(zip(targets.keys(), errors))
+        else:
+            # histograms of all targets from one traversal
+            dists = [dist[1] for dist in self.queryDistributions(iou_thres, conf_thres, dist_targets)]
+        for tar, dist in zip(targets.keys(), dists):
             ret_dict[tar] = dist
         return ret_dict
 
+    def distributionTarget(self, query, target_attr, attr_range):
+        """(key, query, attrs) of QueryDistribution for the histogram of target_attr over attr_range
+
+        The range of target_attr in the query is clipped to attr_range and the types are those of
+        the side of target_attr.
+        """
+        if target_attr.startswith('conf') or target_attr.startswith('pr'):
+            query_types = [1, 2, 3, 4, 5, 6, 7, 8, 9, 11, 12]
+        else:
+            query_types = [1, 2, 3, 4, 10]
+        return target_attr, {
+            **query,
+            target_attr: [max(attr_range[0], query[target_attr][0]), min(attr_range[1], query[target_attr][1])],
+            "types": query_types,
+        }, {'min': attr_range[0], 'max': attr_range[1]}
+
     def getConfusionMatrix(self, query = None):
         """filtered confusion matrix
 
@@ -656,6 +1241,7 @@ class DataCtrler(object):
         if query is not None and "return" in query:
             statistics_modes = query['return']
         iou_thres, conf_thres = self.getThresholds(query)
+        approximate = self.isApproximate(query)
         tar_label, tar_predict = None, None
         if 'label' in query:
             tar_label = query['label']
@@ -663,49 +1249,56 @@ class DataCtrler(object):
             tar_predict = query['predict']
         query["label"] = np.arange(len(self.classID2Idx)).tolist()
         query["predict"] = np.arange(len(self.classID2Idx)).tolist()
-        tree = self.rangeTrees[iou_thres][conf_thres]
         ret_matrices = []
         query = self.getQuery(query)
         # print(query)
         count_mat = None
+        # (feature, values) grouped by each mode, the matrices of all modes come from one traversal
+        mode_groups = {
+            'count': ('', []),
+            'direction': ('direction', list(range(9))),
+            'size_comparison': ('size_comparison', [1, 2]),
+        }
+        modes = [mode for mode in statistics_modes if mode in mode_groups]
+        groups = [mode_groups[mode] for mode in modes]
+        errors = {}
+        if approximate:
+            estimates = self.approximateSample(iou_thres, conf_thres).group_by('label', 'predict', groups, query, RANGE_TREE_RANGES)
+            tensors = {mode: counts for mode, (counts, _) in zip(modes, estimates)}
+            errors = {mode: error for mode, (_, error) in zip(modes, estimates)}
+            # the exact matrices once the interaction settles, cached for the next exact request
+            self.exactQueries.submit(lambda: self.queryRangeTree(iou_thres, conf_thres, 'QueryGroupBy', 'label', 'predict', groups, query))
+        else:
+            tensors = self.queryRangeTree(iou_thres, conf_thres, 'QueryGroupBy', 'label', 'predict', groups, query)
+            tensors = {mode: tensor.copy() for mode, tensor in zip(modes, tensors)}
+        if tar_label is not None:
+            # keep the cells of the target labels and predicts only
+            n = len(self.classID2Idx)
+            outside = ~(np.isin(np.arange(n), tar_label)[:, None] & np.isin(np.arange(n), tar_predict)[None])
+            for tensor in list(tensors.values()) + list(errors.values()):
+                tensor[outside] = 0
+        ret_errors = []
         for statistics_mode in statistics_modes:
-            mat = []
+            mat, error = tensors.get(statistics_mode), errors.get(statistics_mode)
             if statistics_mode == 'count':
-                mat = tree.QueryMatrix('label', 'predict', query)
-                count_mat = mat
-            elif statistics_mode == 'direction':
-                for i in range(9):
-                    mat.append(tree.QueryMatrix('label', 'predict', {**query, 'direction': [i]}))
-                mat = np.concatenate([np.array(mm).reshape(np.array(mm).shape+(1,)) for mm in mat], axis=2).tolist()
-            elif statistics_mode =='size_comparison':
-                for i in range(1, 3):
-                    mat.append(tree.QueryMatrix('label', 'predict', {**query, 'size_comparison': [i]}))
-                mat = np.concatenate([np.array(mm).reshape(np.array(mm).shape+(1,)) for mm in mat], axis=2).tolist()
-            ret_matrices.append(mat)
-        if tar_label is not None:
-            for mat in ret_matrices:
-                for i in range(len(mat)):
-                    for j in range(len(mat[0])):
-                        if i in tar_label and j in tar_predict:
-                            continue
-                        if type(mat[i][j]) == list:
-                            mat[i][j] = [0] * len(mat[i][j])
-                        else:
-                            mat[i][j] = 0
+                count_mat = mat[:, :, 0]
+                mat = count_mat
+                error = error[:, :, 0] if error is not None else None
+            ret_matrices.append(mat.tolist() if mat is not None else [])
+            ret_errors.append(np.round(error, 2).tolist() if error is not None else [])
         # print(ret_matrices)
-        # reorder after normalization by row
+        # reorder after normalization by row, on a copy: self.hierarchy keeps its order
+        reorder_hierarchy = [{**node, "children": list(node["children"])} for node in self.hierarchy]
         if count_mat is not None:
-            from scipy.cluster import hierarchy
             count_mat = np.array(count_mat, dtype=np.float64)
-            reorder_hierarchy = self.hierarchy.copy()
-            top_level_mat = np.zeros((len(reorder_hierarchy), len(reorder_hierarchy)), dtype=np.float64)
-            for i in range(len(reorder_hierarchy)):
-                for j in range(len(reorder_hierarchy)):
-                    row_ids = [self.name2idx[name] for name in reorder_hierarchy[i]["children"]]
-                    col_ids = [self.name2idx[name] for name in reorder_hierarchy[j]["children"]]
-                    top_level_mat[i][j] = np.sum(count_mat[row_ids][:, col_ids])
+            # top_level_mat = members @ count_mat @ members.T, members[i][c] is 1 if class c is a child of i
+            members = np.zeros((len(reorder_hierarchy), len(count_mat)), dtype=np.float64)
+            sizes = [len(node["children"]) for node in reorder_hierarchy]
+            np.add.at(members, (np.repeat(np.arange(len(reorder_hierarchy)), sizes),
+                                [self.name2idx[name] for node in reorder_hierarchy for name in node["children"]]), 1)
+            top_level_mat = members @ count_mat @ members.T
             top_level_mat /= (top_level_mat.sum(axis=1)+1).astype(np.float64) # normalize by row
-            top_order = hierarchy.leaves_list(hierarchy.optimal_leaf_ordering(hierarchy.linkage(top_level_mat, 'ward'), top_level_mat))
+            top_order = self.leafOrder(tuple(node["name"] for node in reorder_hierarchy), top_level_mat)
             reorder_hierarchy = [reorder_hierarchy[i] for i in top_order]
             count_mat /= (count_mat.sum(axis=1)+1).astype(np.float64)
             for i in range(len(reorder_hierarchy)):
@@ -713,26 +1306,39 @@ class DataCtrler(object):
                     continue
                 cld_ids = [self.name2idx[name] for name in reorder_hierarchy[i]["children"]]
                 cld_mat = count_mat[cld_ids][:, cld_ids]
-                cld_order = hierarchy.leaves_list(hierarchy.optimal_leaf_ordering(hierarchy.linkage(cld_mat, 'ward'), cld_mat))
+                cld_order = self.leafOrder((reorder_hierarchy[i]["name"],) + tuple(reorder_hierarchy[i]["children"]), cld_mat)
                 reorder_hierarchy[i]["children"] = [reorder_hierarchy[i]["children"][j] for j in cld_order]
-            # print(reorder_hierarchy)
-            
-        return {
+
+        ret = {
             'matrix': ret_matrices,
             'hierarchy': reorder_hierarchy,
         }
+        if approximate:
+            ret['approximate'] = True
+            ret['error'] = ret_errors
+        return ret
+
+    def leafOrder(self, names, mat):
+        """optimal leaf ordering of the rows of a normalized matrix over names, memoized by names
+
+        The ordering is kept with the fingerprint of the matrix, its entries rounded to multiples of
+        ORDER_QUANTUM, and reused while no entry of the fingerprint moves by more than one step:
+        it is only recomputed when the matrix changes materially.
+        """
+        if len(mat) < 2:
+            return np.arange(len(mat))
+        fingerprint = np.round(mat / ORDER_QUANTUM).astype(np.int32)
+        memo = self.orderMemo.get(names)
+        if memo is not None and memo[0].shape == fingerprint.shape and np.abs(memo[0] - fingerprint).max() <= 1:
+            return memo[1]
+        from scipy.cluster import hierarchy
+        order = hierarchy.leaves_list(hierarchy.optimal_leaf_ordering(hierarchy.linkage(mat, 'ward'), mat))
+        self.orderMemo[names] = (fingerprint, order)
+        return order
 
     def getDistributionByAttrName(self, query, target_attr, attr_range=[0, 1]):
         iou_thres, conf_thres = self.getThresholds(query)
-        tree = self.rangeTrees[iou_thres][conf_thres]
-        query = self.getQuery(query)
-        query[target_attr] = [max(attr_range[0], query[target_attr][0]), min(attr_range[1], query[target_attr][1])]
-        if target_attr.startswith('conf') or target_attr.startswith('pr'):
-            query_types = [1, 2, 3, 4, 5, 6, 7, 8, 9, 11, 12]
-        else:
-            query_types = [1, 2, 3, 4, 10]
-        query["types"] = query_types
-        dist = tree.QueryDistribution(target_attr, query, {'min': attr_range[0], 'max': attr_range[1]})[1]
+        dist = self.queryRangeTree(iou_thres, conf_thres, 'QueryDistribution', *self.distributionTarget(self.getQuery(query), target_attr, attr_range))[1]
         return dist
 
     def getZoomInDistribution(self, query):
@@ -741,13 +1347,19 @@ class DataCtrler(object):
         target_range = query["range"]
         K = 50
         split_pos = np.array([target_range[0]+i*(target_range[1]-target_range[0])/K for i in range(K+1)])
-        all_dist = self.getDistributionByAttrName({}, target, target_range)
-        select_dist = self.getDistributionByAttrName(query, target, target_range)
-        return {
+        # the unfiltered histogram under the thresholds of the query, from its precomputed baseline
+        iou_thres, conf_thres = self.getThresholds(query)
+        all_dist = self.baselineDistribution(iou_thres, conf_thres, target, target_range)
+        ret = {
             'allDist': all_dist,
-            'selectDist': select_dist,
             'split': split_pos.tolist()
         }
+        if self.isApproximate(query):
+            dists, errors = self.approximateDistributions(iou_thres, conf_thres, [self.distributionTarget(self.getQuery(query), target, target_range)])
+            ret['selectDist'], ret['selectError'], ret['approximate'] = dists[0], errors[0], True
+        else:
+            ret['selectDist'] = self.getDistributionByAttrName(query, target, target_range)
+        return ret
 
     def transformBottomLabelToTop(self, topLabels):
         topLabelChildren = {}
@@ -782,13 +1394,13 @@ class DataCtrler(object):
   
     def pairIDtoImageID(self, boxID, iou_thres, conf_thres):
         # boxId here is pair id
-        pairs, _, _ = self.pairs_map_under_iou_thresholds[iou_thres][conf_thres]
+        pairs, _, _ = self.getPairs(iou_thres, conf_thres)
         if pairs[boxID, 1] == -1:
             return self.raw_predict2imageid[pairs[boxID, 0]]
         return self.raw_label2imageid[pairs[boxID, 1]]
     
     def _getBoxesByImgId(self, img_id: int, iou_thres: float, conf_thres: float):
-        predict_label_pairs, _, _ = self.pairs_map_under_iou_thresholds[iou_thres][conf_thres]
+        predict_label_pairs, _, _ = self.getPairs(iou_thres, conf_thres)
         # as 1 gt may occur in many pairs, so pr_boxes will only contain predict indexes, and so as gt_boxes
         pr_boxes = predict_label_pairs[np.logical_and(predict_label_pairs[:, 0]>=self.imageid2raw_predict[img_id][0],
                                                       predict_label_pairs[:, 0]< self.imageid2raw_predict[img_id][1]), 0]
@@ -796,7 +1408,7 @@ class DataCtrler(object):
         return pr_boxes.tolist(), gt_boxes.tolist()
 
     def _getBoxByBoxId(self, box_id: int, iou_thres: float, conf_thres: float):
-        predict_label_pairs, _, _ = self.pairs_map_under_iou_thresholds[iou_thres][conf_thres]
+        predict_label_pairs, _, _ = self.getPairs(iou_thres, conf_thres)
         pr, gt = predict_label_pairs[box_id]
         pr_box, gt_box = [], []
         if pr > -1:
@@ -812,11 +1424,9 @@ class DataCtrler(object):
         
     def getImagebox(self, boxID: int, showall: str, iou_thres: float, conf_thres: float):
         finalBoxes = []
-        img_format = os.listdir(self.images_path)[0].split('.')[-1]
-        img = Image.open(os.path.join(self.images_path, self.index2image[self.pairIDtoImageID(boxID, iou_thres, conf_thres)]+f'.{img_format}'))
-        amp = [img.width,img.height]
+        imgID = self.pairIDtoImageID(boxID, iou_thres, conf_thres)
+        amp = [int(self.image_width[imgID]), int(self.image_height[imgID])]
         if showall == 'all':
-            imgID = self.pairIDtoImageID(boxID, iou_thres, conf_thres)
             pr_boxes, gt_boxes = self._getBoxesByImgId(imgID, iou_thres, conf_thres)
         elif showall == 'single':
             pr_boxes, gt_boxes = self._getBoxByBoxId(boxID, iou_thres, conf_thres)
@@ -841,8 +1451,7 @@ class DataCtrler(object):
                 })
         else:
             for box in pr_boxes:
-                polygon = mask_to_polygons(mask_util.decode({'counts': self.predict_masks[box].encode('utf-8'), 
-                                                                    'size': self.raw_predicts[box, 2:4].astype(np.int32)}))[0]
+                polygon = mask_to_polygons(self.predict_masks.decode(box))[0]
                 polygon = [poly.reshape(-1, 2).tolist() for poly in polygon]
                 finalBoxes.append({
                     "poly": polygon,
@@ -853,8 +1462,7 @@ class DataCtrler(object):
                     "score": float(self.raw_predicts[box, 1])
                 })
             for box in gt_boxes:
-                polygon = mask_to_polygons(mask_util.decode({'counts': self.label_masks[box], 
-                                                                    'size': self.raw_labels[box, 2:4].astype(np.int32)}))[0]
+                polygon = mask_to_polygons(self.label_masks.decode(box))[0]
                 polygon = [poly.reshape(-1, 2).tolist() for poly in polygon]
                 finalBoxes.append({
                     "poly": polygon,
@@ -874,9 +1482,9 @@ class DataCtrler(object):
                  gt_color = 'rgb(27, 251, 254)', pr_color = 'rgb(253, 6, 253)'):
         # gt_color = (27, 251, 254)
         # pr_color = (253, 6, 253)
-        img_format = os.listdir(self.images_path)[0].split('.')[-1]
-        img = Image.open(os.path.join(self.images_path, self.index2image[self.pairIDtoImageID(boxID, iou_thres, conf_thres)]+f'.{img_format}'))
-        amp = np.array([img.width,img.height,img.width,img.height])
+        imgID = self.pairIDtoImageID(boxID, iou_thres, conf_thres)
+        img = Image.open(os.path.join(self.images_path, self.image_files[imgID]))
+        amp = np.array([self.image_width[imgID], self.image_height[imgID], self.image_width[imgID], self.image_height[imgID]])
         if show=='box':
             # first get box position and crop
             predictXYXY_arr, labelXYXY_arr = [], []
@@ -904,8 +1512,7 @@ class DataCtrler(object):
                 predictXYXY[1] -= cropbox[1]
                 predictXYXY[3] -= cropbox[1]
                 if self.segmentation:
-                    predict_polys = mask_to_polygons(mask_util.decode({'counts': self.predict_masks[predictBox].encode('utf-8'), 
-                                                                    'size': self.raw_predicts[predictBox, 2:4].astype(np.int32)}))[0]
+                    predict_polys = mask_to_polygons(self.predict_masks.decode(predictBox))[0]
                     predict_polys = [poly.reshape(-1, 2) for poly in predict_polys]
                     predict_polys = [poly - cropbox[:2] for poly in predict_polys]
                     predict_polys_arr += predict_polys
@@ -915,8 +1522,7 @@ class DataCtrler(object):
                 labelXYXY[1] -= cropbox[1]
                 labelXYXY[3] -= cropbox[1]
                 if self.segmentation:
-                    label_polys = mask_to_polygons(mask_util.decode({'counts': self.label_masks[labelBox].encode('utf-8'), 
-                                                                    'size': self.raw_labels[labelBox, 2:4].astype(np.int32)}))[0]
+                    label_polys = mask_to_polygons(self.label_masks.decode(labelBox))[0]
                     label_polys = [poly.reshape(-1, 2) for poly in label_polys]
                     label_polys = [poly - cropbox[:2] for poly in label_polys]
                     label_polys_arr += label_polys
@@ -947,8 +1553,7 @@ class DataCtrler(object):
                     predictXYXY = xywh2xyxy(self.raw_predicts[box, 2:6]*amp).tolist()
                     anno.box_label(predictXYXY, color=pr_color)
                 else:
-                    predict_polys = mask_to_polygons(mask_util.decode({'counts': self.predict_masks[box].encode('utf-8'), 
-                                                                    'size': self.raw_predicts[box, 2:4].astype(np.int32)}))[0]
+                    predict_polys = mask_to_polygons(self.predict_masks.decode(box))[0]
                     for poly in predict_polys:
                         anno.polygon(poly.tolist(), outline_color=pr_color)
             for box in gt_boxes:
@@ -956,8 +1561,7 @@ class DataCtrler(object):
                     labelXYXY = xywh2xyxy(self.raw_labels[box, 1:5]*amp).tolist()
                     anno.box_label(labelXYXY, color=gt_color)
                 else:
-                    label_polys = mask_to_polygons(mask_util.decode({'counts': self.label_masks[box].encode('utf-8'), 
-                                                                    'size': self.raw_labels[box, 2:4].astype(np.int32)}))[0]
+                    label_polys = mask_to_polygons(self.label_masks.decode(box))[0]
                     for poly in label_polys:
                         anno.polygon(poly.tolist(), outline_color=gt_color)
         output = io.BytesIO()
@@ -1013,7 +1617,7 @@ class DataCtrler(object):
         query["label"] = list(labelSet)
         query["predict"] = list(predSet)
         sample_idx = self.filterSamples(query)
-        return sample_idx
+        return sample_idx.tolist()
 
     def getClassStatistics(self, query = None):
         """
@@ -1029,8 +1633,8 @@ class DataCtrler(object):
             query = {**default_query, **query}
         query["types"] = [i for i in range(1, 13)]
         iou_thres, conf_thres = self.getThresholds(query)
-        pairs, _, types = self.pairs_map_under_iou_thresholds[iou_thres][conf_thres]
-        all_pair_ids = np.array(self.filterSamples(query))
+        pairs, _, types = self.getPairs(iou_thres, conf_thres)
+        all_pair_ids = self.filterSamples(query)
         pairs, types = pairs[all_pair_ids], types[all_pair_ids]
         ap = query['ap']
         ret_arr = []
@@ -1076,8 +1680,8 @@ class DataCtrler(object):
 
     def getSlices(self, query):
         iou_thres, conf_thres = self.getThresholds(query)
-        pairs, ious, types = self.pairs_map_under_iou_thresholds[iou_thres][conf_thres]
-        directions = self.directions_map[iou_thres][conf_thres]
+        pairs, ious, types = self.getPairs(iou_thres, conf_thres)
+        directions = self.getDirections(iou_thres, conf_thres)
 
         pair_pr_size, pair_pr_cat, pair_pr_ar, pair_gt_size, pair_gt_cat, pair_gt_ar, pair_pr_conf = [],[],[],[],[],[],[]
         for p, i, t, d in tqdm(zip(pairs, ious, types, directions)):
@@ -0,0 +1,79 @@
+import numpy as np
+
+CUBE_BINS = 50
+# float32 edges of the bins of the continuous features, the values of the range trees are float32 in [0, 1]
+CUBE_EDGES = np.linspace(0, 1, CUBE_BINS+1).astype(np.float32)
+
+
+def next_float32(x):
+    return float(np.nextafter(np.float32(x), np.float32(np.inf)))
+
+
+def prev_float32(x):
+    return float(np.nextafter(np.float32(x), np.float32(-np.inf)))
+
+
+def distribution_bins(values, min_value, max_value, n_bin=CUBE_BINS):
+    """bin of each value in the histograms of RangeTree.QueryDistribution, same arithmetic"""
+    index = np.trunc((np.asarray(values, dtype=np.float64) - min_value) * n_bin / (max_value - min_value)).astype(np.int64)
+    return np.minimum(index, n_bin - 1)
+
+
+def distribution_edges(min_value, max_value, n_bin=CUBE_BINS):
+    return [(min_value + (max_value - min_value) / n_bin * i, min_value + (max_value - min_value) / n_bin * (i + 1)) for i in range(n_bin)]
+
+
+def value_positions(values, listed):
+    """position of each value in the list listed (first occurrence), -1 if not listed"""
+    values = np.asarray(values).astype(np.int64)
+    listed = np.asarray(listed, dtype=np.int64)
+    if len(values) == 0 or len(listed) == 0:
+        return -np.ones(len(values), dtype=np.int64)
+    offset = min(values.min(), listed.min())
+    lookup = -np.ones(max(values.max(), listed.max()) - offset + 1, dtype=np.int64)
+    lookup[listed[::-1] - offset] = np.arange(len(listed))[::-1]
+    return lookup[values - offset]
+
+
+class PrefixCube(object):
+    """counts of the pairs by bin of one continuous feature and by cell, as prefix sums over the bins
+
+    prefix[j] counts the pairs of each cell with a value below CUBE_EDGES[j], the last row all pairs.
+    below(x) answers "value < x" from the prefix at the largest edge not above x and returns the range
+    between that edge and x, whose pairs the caller adds from the range tree: the answer stays exact
+    for edges that are not aligned to the bins, the range tree only walks the pairs of one bin.
+    """
+
+    def __init__(self, values, cells, n_cells, vmin, vmax):
+        values = np.asarray(values, dtype=np.float32)
+        k = np.searchsorted(CUBE_EDGES, values, side='right')
+        hist = np.bincount(k * n_cells + np.asarray(cells, dtype=np.int64), minlength=(len(CUBE_EDGES)+1) * n_cells)
+        self.prefix = np.cumsum(hist.reshape(len(CUBE_EDGES)+1, n_cells), axis=0).astype(np.int32)
+        self.prefix.flags.writeable = False
+        self.vmin, self.vmax = vmin, vmax
+
+    @property
+    def nbytes(self):
+        return self.prefix.nbytes
+
+    def below(self, x):
+        """(cube counts of the pairs with value < x, [lo, hi] range still to add or None)"""
+        x = np.float32(x)
+        if x <= self.vmin:
+            return np.zeros(self.prefix.shape[1], dtype=np.int64), None
+        if x > self.vmax:
+            return self.prefix[-1].astype(np.int64), None
+        j = int(np.searchsorted(CUBE_EDGES, x, side='right'))
+        if j == 0:
+            return np.zeros(self.prefix.shape[1], dtype=np.int64), [float(self.vmin), prev_float32(x)]
+        edge = CUBE_EDGES[j-1]
+        return self.prefix[j-1].astype(np.int64), None if edge == x else [float(edge), prev_float32(x)]
+
+    def between(self, lo, hi):
+        """(cube counts of the pairs with lo <= value <= hi, [(sign, [lo, hi])] ranges still to add)"""
+        if np.float32(lo) > np.float32(hi):
+            return np.zeros(self.prefix.shape[1], dtype=np.int64), []
+        upper, upper_rest = self.below(next_float32(hi))
+        lower, lower_rest = self.below(lo)
+        rest = [(sign, r) for sign, r in ((1, upper_rest), (-1, lower_rest)) if r is not None]
+        return upper - lower, rest
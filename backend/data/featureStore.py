@@ -0,0 +1,172 @@
+import os
+import zipfile
+from contextlib import contextmanager
+import numpy as np
+
+FEATURE_DTYPES = ('float32', 'float16')
+
+
+class FeatureStore(object):
+    """features of all predicts followed by all labels in one .npy file
+
+    The file is memory-mapped read-only, pr_features, gt_features and all are views into it.
+    """
+
+    def __init__(self, path, n_predicts):
+        self.path = path
+        self.all = np.load(path, mmap_mode='r')
+        self.pr_features = self.all[:n_predicts]
+        self.gt_features = self.all[n_predicts:]
+
+    @property
+    def dtype(self):
+        return self.all.dtype
+
+
+class FeatureStoreWriter(object):
+    """preallocates the store file and fills it in place, the file replaces path on close()"""
+
+    def __init__(self, path, n_predicts, n_labels, dim, dtype='float32'):
+        assert np.dtype(dtype).name in FEATURE_DTYPES, "unsupported feature dtype {}".format(dtype)
+        self.path = path
+        self.n_predicts = n_predicts
+        self.tmp_path = path + ".tmp"
+        self.all = np.lib.format.open_memmap(self.tmp_path, mode='w+', dtype=dtype, shape=(n_predicts + n_labels, dim))
+        self.pr_features = self.all[:n_predicts]
+        self.gt_features = self.all[n_predicts:]
+
+    def close(self):
+        self.all.flush()
+        del self.all, self.pr_features, self.gt_features
+        os.replace(self.tmp_path, self.path)
+        return FeatureStore(self.path, self.n_predicts)
+
+
+def copy_rows(dst, src, row_map, chunk_size=65536):
+    """dst[row_map[i]] = src[i] for row_map[i] >= 0, in chunks to bound the memory of the copy"""
+    for start in range(0, len(src), chunk_size):
+        rows = row_map[start:start+chunk_size]
+        valid = rows >= 0
+        dst[rows[valid]] = src[start:start+chunk_size][valid]
+
+
+def find_feature_file(root_path, name):
+    """return rawDataPath/<name>.npy|.npz|.h5|.hdf5 if exists, else None"""
+    for ext in ['npy', 'npz', 'h5', 'hdf5']:
+        path = os.path.join(root_path, "{}.{}".format(name, ext))
+        if os.path.exists(path):
+            return path
+    return None
+
+
+class FeatureFileReader(object):
+    """chunked reader of one consolidated feature matrix per split
+
+    - .npy: the matrix only, memory-mapped
+    - .npz / .h5: 'features' (n * d) and optional 'images' (n image names)
+
+    Without 'images', the rows follow the annotations: with labels.json/predicts.json (or .parquet),
+    one row per annotation in the order of the file; with labels/ and predicts/ text files, one row
+    per line, the files taken in sorted image name order.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.ext = os.path.splitext(path)[1]
+        self.images = None
+        if self.ext == '.npy':
+            self.shape = np.load(path, mmap_mode='r').shape
+        elif self.ext == '.npz':
+            with np.load(path) as npz:
+                if 'images' in npz.files:
+                    self.images = [str(name) for name in npz['images']]
+            with self._open_npz_member() as (f, shape, dtype, fortran):
+                self.shape = shape
+        else:
+            import h5py
+            with h5py.File(path, 'r') as f:
+                self.shape = f['features'].shape
+                if 'images' in f:
+                    self.images = [name.decode('utf-8') if isinstance(name, bytes) else str(name) for name in f['images'][()]]
+        if self.images is not None and len(self.images) != self.shape[0]:
+            raise ValueError("{} has {} rows but {} image names".format(path, self.shape[0], len(self.images)))
+
+    @contextmanager
+    def _open_npz_member(self):
+        # read the header of features.npy inside the archive, the data follows it
+        with zipfile.ZipFile(self.path) as archive, archive.open('features.npy') as f:
+            if np.lib.format.read_magic(f) == (1, 0):
+                shape, fortran, dtype = np.lib.format.read_array_header_1_0(f)
+            else:
+                shape, fortran, dtype = np.lib.format.read_array_header_2_0(f)
+            yield f, shape, dtype, fortran
+
+    def chunks(self, chunk_size=65536):
+        """yield (start row, rows) of at most chunk_size rows, only one chunk is in memory at a time"""
+        n = self.shape[0]
+        if self.ext == '.npy':
+            arr = np.load(self.path, mmap_mode='r')
+            for start in range(0, n, chunk_size):
+                yield start, np.asarray(arr[start:start+chunk_size])
+        elif self.ext == '.npz':
+            with self._open_npz_member() as (f, shape, dtype, fortran):
+                assert not fortran, "features.npy in {} must be C-ordered".format(self.path)
+                row_bytes = dtype.itemsize * int(np.prod(shape[1:]))
+                for start in range(0, n, chunk_size):
+                    count = min(chunk_size, n - start)
+                    data = f.read(count * row_bytes)
+                    yield start, np.frombuffer(data, dtype=dtype).reshape((count,) + tuple(shape[1:]))
+        else:
+            import h5py
+            with h5py.File(self.path, 'r') as f:
+                dataset = f['features']
+                for start in range(0, n, chunk_size):
+                    yield start, dataset[start:start+chunk_size]
+
+    def row_map(self, image2index, imageid2raw, annotation_images=None):
+        """destination row of each row in the file, -1 for rows without a matching box
+
+        annotation_images: image index of each annotation of the consolidated annotation file, in file
+        order, if the boxes were read from one; the rows of a file without 'images' follow them.
+
+        Returns:
+            row_map (np.ndarray): n int64
+            extra (int): rows of the file not matched to any box
+        """
+        if self.images is not None:
+            imageids = np.array([image2index.get(name.split('.')[0], -1) for name in self.images], dtype=np.int64)
+        elif annotation_images is not None:
+            imageids = np.asarray(annotation_images, dtype=np.int64)
+            if len(imageids) != self.shape[0]:
+                raise ValueError("{} has {} rows but the annotation file has {} annotations, "
+                                 "add 'images' to align the rows".format(self.path, self.shape[0], len(imageids)))
+        else:
+            order = np.array([image2index[name] for name in sorted(image2index)], dtype=np.int64)
+            row_map = np.concatenate([np.arange(imageid2raw[idx][0], imageid2raw[idx][1], dtype=np.int64) for idx in order]) \
+                if len(order) > 0 else np.zeros(0, dtype=np.int64)
+            if len(row_map) != self.shape[0]:
+                raise ValueError("{} has {} rows but there are {} boxes in the text files, taken in sorted image name order, "
+                                 "add 'images' to align the rows".format(self.path, self.shape[0], len(row_map)))
+            return row_map, 0
+        return rows_by_image(imageids, imageid2raw)
+
+
+def rows_by_image(imageids, imageid2raw):
+    """destination row of rows given by their image index (-1 unknown), the k-th row of an image in
+    file order goes to the k-th box of the image, -1 beyond its boxes
+
+    Returns:
+        row_map (np.ndarray): n int64
+        extra (int): rows not matched to any box
+    """
+    counts = (imageid2raw[:, 1] - imageid2raw[:, 0]).astype(np.int64)
+    row_map = -1 * np.ones(len(imageids), dtype=np.int64)
+    known = np.where(imageids >= 0)[0]
+    # rank of each row among the rows of its image, in file order
+    order = known[np.argsort(imageids[known], kind='stable')]
+    sorted_ids = imageids[order]
+    group_start = np.searchsorted(sorted_ids, sorted_ids, side='left')
+    ranks = np.arange(len(order)) - group_start
+    matched = ranks < counts[sorted_ids]
+    row_map[order[matched]] = imageid2raw[sorted_ids[matched], 0] + ranks[matched]
+    return row_map, int(np.sum(row_map < 0))
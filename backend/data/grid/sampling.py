@@ -47,7 +47,7 @@ class DensityBiasedSampling():
     
     def sample(self, data, sample_num, prob_ext = None):
         k = 50
-        X = np.array(data.tolist(), dtype=np.float64)
+        X = np.asarray(data, dtype=np.float64)
         n, d = X.shape
         m = sample_num
         if k + 1 > n:
@@ -73,7 +73,7 @@ class OutlierBiasedBlueNoiseSamplingFAISS():
         self.fail_rate = fail_rate
 
     def fit(self, data, category):
-        data = np.array(data.tolist(), dtype=np.float32)
+        data = np.ascontiguousarray(data, dtype=np.float32)
         n, d = data.shape
         
         allIndexer = faiss.IndexFlatL2(d)
@@ -132,7 +132,7 @@ def Knn(X, N, D, n_neighbors, forest_size, subdivide_variance_size, leaf_number)
     return indices, distances
 
 def get_default_outlier_scores(data, category, k=50, dataIndexer = None):
-    X = np.array(data.tolist(), dtype=np.float64)
+    X = np.asarray(data, dtype=np.float64)
     n, d = X.shape
     if k + 1 > n:
         k = int((n - 1) / 2)
@@ -153,8 +153,10 @@ class HierarchySampling(object):
         self.neighbors = None
         
     def fit(self, val_data, val_category, train_data, train_category, top_nodes_count):
-        train_data = np.array(train_data.tolist(), dtype=np.float32)
-        val_data = np.array(val_data.tolist(), dtype=np.float32)
+        # features may be a read-only float32/float16 memory map, faiss needs contiguous float32
+        same_data = val_data is train_data
+        train_data = np.ascontiguousarray(train_data, dtype=np.float32)
+        val_data = train_data if same_data else np.ascontiguousarray(val_data, dtype=np.float32)
         # get faiss index
         n, d = train_data.shape
         nlist = 50  # how many cells
@@ -0,0 +1,103 @@
+import os
+import struct
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+# format codes of the image metadata table
+IMAGE_FORMATS = ('UNKNOWN', 'JPEG', 'PNG', 'GIF', 'BMP', 'WEBP')
+
+# enough for the header of png/gif/bmp/webp, jpeg is scanned further if needed
+HEADER_BYTES = 64
+
+
+def _jpeg_size(f):
+    """scan jpeg markers until the SOFn segment, which holds the frame size"""
+    f.seek(2)
+    while True:
+        marker = f.read(2)
+        while len(marker) == 2 and marker[0] == 0xFF and marker[1] == 0xFF:
+            # fill bytes before a marker
+            marker = marker[1:] + f.read(1)
+        if len(marker) < 2 or marker[0] != 0xFF:
+            return None
+        code = marker[1]
+        if code == 0xD8 or 0xD0 <= code <= 0xD7 or code == 0x01:
+            # markers without a length field
+            continue
+        length = f.read(2)
+        if len(length) < 2:
+            return None
+        length = struct.unpack('>H', length)[0]
+        if code in (0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF):
+            data = f.read(5)
+            if len(data) < 5:
+                return None
+            height, width = struct.unpack('>HH', data[1:5])
+            return width, height
+        f.seek(length - 2, os.SEEK_CUR)
+
+
+def _header_size(f, head):
+    """(width, height, format) from the file header, None if the format is not recognized"""
+    if head[:8] == b'\x89PNG\r\n\x1a\n' and head[12:16] == b'IHDR':
+        width, height = struct.unpack('>II', head[16:24])
+        return width, height, 'PNG'
+    if head[:6] in (b'GIF87a', b'GIF89a'):
+        width, height = struct.unpack('<HH', head[6:10])
+        return width, height, 'GIF'
+    if head[:2] == b'BM' and len(head) >= 26:
+        width, height = struct.unpack('<ii', head[18:26])
+        # negative height for top-down bitmaps
+        return width, abs(height), 'BMP'
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        chunk = head[12:16]
+        if chunk == b'VP8 ' and head[23:26] == b'\x9d\x01\x2a':
+            width, height = struct.unpack('<HH', head[26:30])
+            return width & 0x3FFF, height & 0x3FFF, 'WEBP'
+        if chunk == b'VP8L' and head[20] == 0x2F:
+            bits = struct.unpack('<I', head[21:25])[0]
+            return (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1, 'WEBP'
+        if chunk == b'VP8X':
+            width = int.from_bytes(head[24:27], 'little') + 1
+            height = int.from_bytes(head[27:30], 'little') + 1
+            return width, height, 'WEBP'
+        return None
+    if head[:2] == b'\xff\xd8':
+        size = _jpeg_size(f)
+        if size is not None:
+            return size[0], size[1], 'JPEG'
+    return None
+
+
+def read_image_size(path):
+    """width, height and format of an image, read from the file header only
+
+    Falls back to PIL, which opens the image lazily and does not decode the pixels either.
+    """
+    with open(path, 'rb') as f:
+        head = f.read(HEADER_BYTES)
+        size = _header_size(f, head)
+    if size is not None:
+        return size
+    from PIL import Image
+    with Image.open(path) as img:
+        return img.width, img.height, img.format
+
+
+def scan_image_sizes(paths, threads=32):
+    """read the size of many images with a thread pool, the scan is bound by file system latency
+
+    Returns:
+        widths (np.ndarray), heights (np.ndarray): int32
+        formats (np.ndarray): uint8 index into IMAGE_FORMATS
+    """
+    widths = np.zeros(len(paths), dtype=np.int32)
+    heights = np.zeros(len(paths), dtype=np.int32)
+    formats = np.zeros(len(paths), dtype=np.uint8)
+    if len(paths) == 0:
+        return widths, heights, formats
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        for i, (width, height, fmt) in enumerate(executor.map(read_image_size, paths)):
+            widths[i], heights[i] = width, height
+            formats[i] = IMAGE_FORMATS.index(fmt) if fmt in IMAGE_FORMATS else 0
+    return widths, heights, formats
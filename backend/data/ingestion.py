@@ -0,0 +1,410 @@
+import os
+import json
+import hashlib
+import logging
+import numpy as np
+from multiprocessing import Pool, shared_memory
+from tqdm import tqdm
+
+
+def fingerprint(data):
+    """64-bit content hash, 0 is reserved for missing files"""
+    return max(1, int.from_bytes(hashlib.blake2b(data, digest_size=8).digest(), 'little'))
+
+
+def scan_file(path):
+    """number of non-empty lines and content fingerprint of a label/predict file"""
+    with open(path, 'rb') as f:
+        data = f.read()
+    return sum(1 for x in data.decode().strip().splitlines() if len(x)), fingerprint(data)
+
+
+def file_fingerprint(path):
+    with open(path, 'rb') as f:
+        return fingerprint(f.read())
+
+
+def parse_rows(path, segmentation=False):
+    """parse one label/predict file
+
+    Returns:
+        rows (np.ndarray): n * d float32 array
+        masks (list): rle strings of each row, None for detection task
+    """
+    with open(path) as f:
+        lb = [x.split() for x in f.read().strip().splitlines() if len(x)]
+    if not segmentation:
+        return np.array(lb, dtype=np.float32), None
+    assert np.all([len(i) == 5 for i in lb]), lb
+    return np.array([i[:4] for i in lb], dtype=np.float32), [i[4] for i in lb]
+
+
+def _parse_into_buffer(args):
+    # worker of the second pass, writes rows of one file into its slice of the shared buffer
+    path, buffer_name, shape, start, segmentation = args
+    rows, masks = parse_rows(path, segmentation)
+    buffer = shared_memory.SharedMemory(name=buffer_name)
+    try:
+        out = np.ndarray(shape, dtype=np.float32, buffer=buffer.buf)
+        if len(rows) > 0:
+            out[start:start+len(rows)] = rows
+        del out
+    finally:
+        buffer.close()
+    return len(rows), masks
+
+
+class RawDataReader(object):
+    """two-pass reader of the per-image text files in `labels/` or `predicts/`
+
+    The first pass counts the rows of each file so that the output arrays are
+    allocated once. The second pass parses the files in a process pool, each
+    worker writing its rows directly into the shared output buffer.
+    """
+
+    def __init__(self, image2index, n_cols, segmentation=False, workers=None, chunksize=64):
+        self.image2index = image2index
+        self.n_cols = n_cols
+        self.segmentation = segmentation
+        self.workers = workers if workers is not None else os.cpu_count()
+        self.chunksize = chunksize
+
+    def _map(self, func, tasks, desc):
+        if self.workers is None or self.workers <= 1 or len(tasks) < 2 * self.chunksize:
+            return [func(task) for task in tqdm(tasks, desc=desc)]
+        with Pool(self.workers) as pool:
+            return list(tqdm(pool.imap(func, tasks, chunksize=self.chunksize), total=len(tasks), desc=desc))
+
+    def read(self, dir_path, names=None):
+        """read all files in dir_path, or only the given file names
+
+        Returns:
+            raw (np.ndarray): rows of all files, ordered as os.listdir(dir_path)
+            raw2imageid (np.ndarray): image id of each row
+            imageid2raw (np.ndarray): [start, end) of rows of each image
+            masks (list): rle strings of each row, None for detection task
+        the content fingerprint of each image's file is kept in self.hashes
+        """
+        if names is None:
+            names = os.listdir(dir_path)
+        paths = [os.path.join(dir_path, name) for name in names]
+        imageids = np.array([self.image2index[name.split('.')[0]] for name in names], dtype=np.int32)
+
+        # first pass: count rows and allocate
+        scans = self._map(scan_file, paths, 'counting rows')
+        counts = np.array([scan[0] for scan in scans], dtype=np.int64)
+        self.hashes = np.zeros(len(self.image2index), dtype=np.uint64)
+        self.hashes[imageids] = np.array([scan[1] for scan in scans], dtype=np.uint64)
+        ends = np.cumsum(counts)
+        starts = ends - counts
+        total = int(ends[-1]) if len(ends) > 0 else 0
+        imageid2raw = np.zeros((len(self.image2index), 2), dtype=np.int32)
+        imageid2raw[imageids, 0] = starts
+        imageid2raw[imageids, 1] = ends
+        raw2imageid = np.repeat(imageids, counts).astype(np.int32)
+
+        # second pass: parse and write in place
+        shape = (total, self.n_cols)
+        buffer = shared_memory.SharedMemory(create=True, size=max(1, total * self.n_cols * 4))
+        try:
+            tasks = [(path, buffer.name, shape, int(start), self.segmentation) for path, start in zip(paths, starts)]
+            results = self._map(_parse_into_buffer, tasks, 'parsing ' + os.path.basename(os.path.normpath(dir_path)))
+            raw = np.ndarray(shape, dtype=np.float32, buffer=buffer.buf).copy()
+        finally:
+            buffer.close()
+            buffer.unlink()
+
+        masks = [] if self.segmentation else None
+        for path, count, (n, file_masks) in zip(paths, counts, results):
+            if n != count:
+                raise ValueError("file changed while reading: {}".format(path))
+            if self.segmentation:
+                masks += file_masks
+        return raw, raw2imageid, imageid2raw, masks
+
+
+def file_stats(dir_path, image2index):
+    """size and mtime_ns of each image's file in dir_path, and image id => file name"""
+    stats = np.zeros((len(image2index), 2), dtype=np.int64)
+    names = {}
+    for name in os.listdir(dir_path):
+        imageid = image2index[name.split('.')[0]]
+        st = os.stat(os.path.join(dir_path, name))
+        names[imageid] = name
+        stats[imageid] = (st.st_size, st.st_mtime_ns)
+    return stats, names
+
+
+def file_fingerprints(dir_path, image2index, old_hashes=None, old_stats=None, workers=None):
+    """per-image content fingerprints of the files in dir_path
+
+    Files whose size and modification time match old_stats keep their old hash and are not read.
+
+    Returns:
+        hashes (np.ndarray): uint64 fingerprint of each image's file, 0 if the image has no file
+        stats (np.ndarray): n * 2 int64 size and mtime_ns of each image's file
+        names (dict): image id => file name
+    """
+    hashes = np.zeros(len(image2index), dtype=np.uint64)
+    stats, names = file_stats(dir_path, image2index)
+    imageids = np.array(sorted(names.keys()), dtype=np.int64)
+    if old_hashes is not None and old_stats is not None:
+        same = np.all(stats[imageids] == old_stats[imageids], axis=1) & (old_hashes[imageids] != 0)
+        hashes[imageids[same]] = old_hashes[imageids[same]]
+        imageids = imageids[~same]
+    paths = [os.path.join(dir_path, names[i]) for i in imageids]
+    if workers is not None and workers > 1 and len(paths) > 256:
+        with Pool(workers) as pool:
+            hashes[imageids] = np.array(pool.map(file_fingerprint, paths, chunksize=64), dtype=np.uint64)
+    else:
+        hashes[imageids] = np.array([file_fingerprint(path) for path in paths], dtype=np.uint64)
+    return hashes, stats, names
+
+
+def row_fingerprints(raw, imageid2raw, masks=None):
+    """per-image fingerprints of parsed rows, used for consolidated input files"""
+    hashes = np.zeros(len(imageid2raw), dtype=np.uint64)
+    raw = np.ascontiguousarray(raw)
+    for imageid, (start, end) in enumerate(imageid2raw):
+        if end == start:
+            continue
+        data = raw[start:end].tobytes()
+        if masks is not None:
+            data += '\n'.join(masks[start:end]).encode('utf-8')
+        hashes[imageid] = fingerprint(data)
+    return hashes
+
+
+def fingerprints_digest(label_hashes, predict_hashes, segmentation):
+    """digest of all per-image fingerprints, identifies one version of the raw data"""
+    h = hashlib.blake2b(digest_size=16)
+    h.update(b'seg' if segmentation else b'det')
+    h.update(np.ascontiguousarray(label_hashes, dtype=np.uint64).tobytes())
+    h.update(np.ascontiguousarray(predict_hashes, dtype=np.uint64).tobytes())
+    return h.hexdigest()
+
+
+def pair_imageids(pairs, predict2imageid, label2imageid):
+    """image id of each (predict, label) pair"""
+    ret = np.zeros(len(pairs), dtype=np.int64)
+    has_pr = pairs[:, 0] > -1
+    ret[has_pr] = predict2imageid[pairs[has_pr, 0]]
+    ret[~has_pr] = label2imageid[pairs[~has_pr, 1]]
+    return ret
+
+
+def splice_rows(old_raw, old_imageid2raw, new_raw, new_imageid2raw, changed, old_masks=None, new_masks=None):
+    """replace the rows of changed images with new rows, keep rows of the other images
+
+    new_imageid2raw only has to be valid for changed images.
+
+    Returns:
+        raw, raw2imageid, imageid2raw, masks: the spliced data, rows ordered by image id
+        row_map (np.ndarray): new row index of each old row, -1 for rows of changed images
+    """
+    n_images = len(old_imageid2raw)
+    is_changed = np.zeros(n_images, dtype=bool)
+    is_changed[changed] = True
+    old_imageid2raw = np.asarray(old_imageid2raw, dtype=np.int64)
+    new_imageid2raw = np.asarray(new_imageid2raw, dtype=np.int64)
+    src_start = np.where(is_changed, new_imageid2raw[:, 0], old_imageid2raw[:, 0])
+    counts = np.where(is_changed, new_imageid2raw[:, 1] - new_imageid2raw[:, 0], old_imageid2raw[:, 1] - old_imageid2raw[:, 0])
+    imageid2raw = np.zeros((n_images, 2), dtype=np.int32)
+    imageid2raw[:, 1] = np.cumsum(counts)
+    imageid2raw[:, 0] = imageid2raw[:, 1] - counts
+
+    raw2imageid = np.repeat(np.arange(n_images), counts)
+    row_src = src_start[raw2imageid] + np.arange(len(raw2imageid)) - imageid2raw[raw2imageid, 0]
+    from_new = is_changed[raw2imageid]
+    raw = np.empty((len(raw2imageid),) + old_raw.shape[1:], dtype=old_raw.dtype)
+    raw[~from_new] = old_raw[row_src[~from_new]]
+    raw[from_new] = new_raw[row_src[from_new]]
+
+    row_map = -np.ones(len(old_raw), dtype=np.int64)
+    row_map[row_src[~from_new]] = np.where(~from_new)[0]
+
+    masks = None
+    if old_masks is not None:
+        masks = [new_masks[src] if fn else old_masks[src] for src, fn in zip(row_src.tolist(), from_new.tolist())]
+    return raw, raw2imageid.astype(np.int32), imageid2raw, masks, row_map
+
+
+def find_bulk_file(root_path, name):
+    """return rawDataPath/<name>.json|.parquet|.arrow|.feather if exists, else None"""
+    for ext in ['json', 'parquet', 'arrow', 'feather']:
+        path = os.path.join(root_path, "{}.{}".format(name, ext))
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def _rle_counts(segm, height, width):
+    # convert polygon / uncompressed rle / compressed rle to a compressed rle counts string
+    import pycocotools.mask as mask_util
+    if isinstance(segm, str):
+        return segm
+    if isinstance(segm, list):
+        rle = mask_util.merge(mask_util.frPyObjects(segm, height, width))
+    elif isinstance(segm['counts'], list):
+        rle = mask_util.frPyObjects(segm, height, width)
+    else:
+        rle = segm
+    counts = rle['counts']
+    return counts.decode('utf-8') if isinstance(counts, bytes) else counts
+
+
+class BulkAnnotationReader(object):
+    """reader of one consolidated annotation / result file instead of one text file per image
+
+    Supported inputs:
+    - COCO json, either an instances file (images, annotations) or a results list
+    - parquet / arrow table with the same columns: image_id, category_id, bbox ([x, y, w, h] in pixels),
+      score, iscrowd, area, segmentation, and optionally file_name, width, height of the image
+
+    Image file names and sizes are collected from `images` of COCO files and from the table columns,
+    so read the labels file before the predicts file. Images without a size there, as in a results list
+    next to per-image label files, take the size of the image file from image_sizes, called without
+    arguments for the (width, height) arrays of the images by index.
+    """
+
+    def __init__(self, image2index, classID2Idx, segmentation=False, image_sizes=None):
+        self.image2index = image2index
+        self.segmentation = segmentation
+        self.image_sizes = image_sizes
+        self.logger = logging.getLogger('ingestion')
+        category_ids = np.array(sorted(k for k in classID2Idx.keys() if k != -1))
+        self.category_ids = category_ids
+        self.category_idxs = np.array([classID2Idx[k] for k in category_ids], dtype=np.float32)
+        # image id => (name, width, height)
+        self.images = {}
+
+    def _load_table(self, path):
+        if path.endswith('.json'):
+            with open(path) as f:
+                obj = json.load(f)
+            if isinstance(obj, dict):
+                for img in obj.get('images', []):
+                    self.images[img['id']] = (os.path.splitext(img['file_name'])[0], img['width'], img['height'])
+                anns = obj['annotations']
+            else:
+                anns = obj
+            table = {
+                'image_id': np.array([a['image_id'] for a in anns]),
+                'category_id': np.array([a['category_id'] for a in anns]),
+                'iscrowd': np.array([a.get('iscrowd', 0) for a in anns], dtype=np.float32),
+                'score': np.array([a.get('score', 1) for a in anns], dtype=np.float32),
+            }
+            if self.segmentation:
+                table['segmentation'] = [a['segmentation'] for a in anns]
+            else:
+                table['bbox'] = np.array([a['bbox'] for a in anns], dtype=np.float64).reshape(-1, 4)
+                table['area'] = np.array([a.get('area', a['bbox'][2] * a['bbox'][3]) for a in anns], dtype=np.float32)
+            return table
+        import pandas as pd
+        if path.endswith('.parquet'):
+            df = pd.read_parquet(path)
+        else:
+            df = pd.read_feather(path)
+        if 'file_name' in df.columns and 'width' in df.columns and 'height' in df.columns:
+            image_df = df[['image_id', 'file_name', 'width', 'height']].drop_duplicates('image_id')
+            for image_id, file_name, width, height in image_df.itertuples(index=False):
+                self.images[image_id] = (os.path.splitext(file_name)[0], width, height)
+        n = len(df)
+        table = {
+            'image_id': df['image_id'].to_numpy(),
+            'category_id': df['category_id'].to_numpy(),
+            'iscrowd': df['iscrowd'].to_numpy(dtype=np.float32) if 'iscrowd' in df.columns else np.zeros(n, dtype=np.float32),
+            'score': df['score'].to_numpy(dtype=np.float32) if 'score' in df.columns else np.ones(n, dtype=np.float32),
+        }
+        if self.segmentation:
+            table['segmentation'] = df['segmentation'].tolist()
+        else:
+            table['bbox'] = np.stack(df['bbox'].to_numpy()).astype(np.float64).reshape(-1, 4)
+            table['area'] = df['area'].to_numpy(dtype=np.float32) if 'area' in df.columns else \
+                (table['bbox'][:, 2] * table['bbox'][:, 3]).astype(np.float32)
+        return table
+
+    def _image_index(self, image_ids):
+        image_lookup = {image_id: self.image2index.get(info[0], -1) for image_id, info in self.images.items()}
+        return np.array([image_lookup.get(i, self.image2index.get(str(i), -1)) for i in image_ids], dtype=np.int64)
+
+    def _sizes(self, path, image_ids, imageidx):
+        """(width, height) of the image of each annotation, from the annotation files, else from image_sizes"""
+        sizes = np.array([self.images[i][1:] if i in self.images else (0, 0) for i in image_ids], dtype=np.float64).reshape(-1, 2)
+        unknown = np.any(sizes == 0, axis=1)
+        if np.any(unknown) and self.image_sizes is not None:
+            width, height = self.image_sizes()
+            sizes[unknown, 0], sizes[unknown, 1] = width[imageidx[unknown]], height[imageidx[unknown]]
+        if np.any(sizes == 0):
+            raise ValueError("image sizes of {} are unknown, add width/height columns, read the COCO labels file first "
+                             "or check the image files".format(path))
+        return sizes
+
+    def annotation_images(self, path):
+        """image index of each annotation of path in file order, -1 for annotations of unknown images"""
+        table = self._load_table(path)
+        return self._image_index(table['image_id'])
+
+    def read(self, path, predict=False):
+        """read all annotations of path
+
+        Returns:
+            the same (raw, raw2imageid, imageid2raw, masks) as RawDataReader.read,
+            rows are ordered by image id and keep the file order inside each image
+        """
+        table = self._load_table(path)
+        image_ids = table['image_id']
+
+        # map to image index, drop annotations of images not in images/
+        imageidx = self._image_index(image_ids)
+        keep = imageidx >= 0
+        if not np.all(keep):
+            self.logger.warning("%d annotations in %s belong to unknown images, ignored" % (np.count_nonzero(~keep), path))
+        order = np.where(keep)[0]
+        order = order[np.argsort(imageidx[order], kind='stable')]
+        imageidx = imageidx[order]
+
+        # map category id to class index
+        category_id = table['category_id'][order]
+        pos = np.searchsorted(self.category_ids, category_id)
+        pos[pos >= len(self.category_ids)] = 0
+        if len(category_id) > 0 and not np.all(self.category_ids[pos] == category_id):
+            raise ValueError("unknown category ids in {}: {}".format(path, np.unique(category_id[self.category_ids[pos] != category_id])))
+        category = self.category_idxs[pos]
+        second = table['score'][order] if predict else table['iscrowd'][order]
+
+        masks = None
+        if not self.segmentation:
+            sizes = self._sizes(path, image_ids[order], imageidx)
+            bbox = table['bbox'][order]
+            # to normalized cx, cy, w, h
+            bbox[:, :2] += bbox[:, 2:] / 2
+            bbox[:, [0, 2]] /= sizes[:, :1]
+            bbox[:, [1, 3]] /= sizes[:, 1:]
+            if predict:
+                # format: predict, confidence, box(cx, cy, w, h)
+                raw = np.column_stack((category, second, bbox)).astype(np.float32)
+            else:
+                # format: label, box(cx, cy, w, h), isCrowd(0/1), area
+                raw = np.column_stack((category, bbox, second, table['area'][order])).astype(np.float32)
+        else:
+            segms = [table['segmentation'][i] for i in order]
+            hw = np.zeros((len(order), 2), dtype=np.float32)
+            # rles carry their size, polygons take the size of their image
+            polygon = np.array([not (isinstance(segm, dict) and 'size' in segm) for segm in segms], dtype=bool)
+            if np.any(polygon):
+                hw[polygon] = self._sizes(path, image_ids[order][polygon], imageidx[polygon])[:, ::-1]
+            masks = []
+            for k, segm in enumerate(segms):
+                if not polygon[k]:
+                    hw[k] = segm['size']
+                height, width = int(hw[k, 0]), int(hw[k, 1])
+                masks.append(_rle_counts(segm, height, width))
+            # format: label/predict, isCrowd/confidence, im_h, im_w, mask_rle
+            raw = np.column_stack((category, second, hw)).astype(np.float32).reshape(-1, 4)
+
+        counts = np.bincount(imageidx, minlength=len(self.image2index))
+        imageid2raw = np.zeros((len(self.image2index), 2), dtype=np.int32)
+        imageid2raw[:, 1] = np.cumsum(counts)
+        imageid2raw[:, 0] = imageid2raw[:, 1] - counts
+        return raw, imageidx.astype(np.int32), imageid2raw, masks
@@ -35,7 +35,7 @@ class GridInteraction(object):
         mainData = self.mainData
         contextData = self.contextData
         
-        predict_label_pairs, _, predict_type = mainData.pairs_map_under_iou_thresholds[iou_thres][conf_thres]
+        predict_label_pairs, _, predict_type = mainData.getPairs(iou_thres, conf_thres)
 
         def getFeatureIdsFromNodes(nds):
             # TODO: sometimes can use gt features?
@@ -124,7 +124,7 @@ class GridInteraction(object):
                     zoomin_cat = mainData.raw_predicts[feature_ids[0], 0]
             # zoomin returns id of train gt
             neighbor_train_gt = self.contextSampler.zoomin(feature_ids, targetGrids - val_show, contextData.gt_features, contextData.raw_labels[:, 0], zoomin_cat)
-            train_predict_label_pairs, _, train_pair_type = contextData.pairs_map_under_iou_thresholds[iou_thres][conf_thres]
+            train_predict_label_pairs, _, train_pair_type = contextData.getPairs(iou_thres, conf_thres)
             neighbor_train_pair = []
             for train_gt in neighbor_train_gt:
                 target_pair_ids = np.where(train_predict_label_pairs[:,1]==train_gt)[0].tolist()
@@ -0,0 +1,66 @@
+import numpy as np
+
+# values are stored in float64, as computed: in float32 an IoU equal to a threshold, e.g. 70 / 100,
+# may round below it and change the matching
+IOU_DTYPE = np.float64
+
+
+def empty_coo():
+    return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=IOU_DTYPE)
+
+
+def sparse_iou(iou_pair, bg_thres):
+    """(row, col, iou) of the entries of a dense IoU matrix above bg_thres"""
+    iou_pair = np.asarray(iou_pair)
+    if iou_pair.size == 0:
+        return empty_coo()
+    rows, cols = np.nonzero(iou_pair > bg_thres)
+    return rows, cols, iou_pair[rows, cols].astype(IOU_DTYPE)
+
+
+class SparseIoUStore(object):
+    """IoU of the (predict, label) pairs of the same image that are above bg_thres, in CSR layout
+
+    Row i is predict i (global index), indices[indptr[i]:indptr[i+1]] are the labels it overlaps,
+    as indexes local to the image, and values their IoU. The predicts of an image are contiguous,
+    so the IoU matrix of an image is the block of rows [pr_start, pr_end).
+    Matching only looks at IoU above bg_thres, so it gives the same result on the dense block
+    as on the full matrix.
+    """
+
+    def __init__(self, indptr, indices, values, bg_thres):
+        self.indptr = indptr
+        self.indices = indices
+        self.values = values
+        self.bg_thres = bg_thres
+
+    @classmethod
+    def from_coo(cls, n_rows, rows, cols, values, bg_thres):
+        rows = np.asarray(rows, dtype=np.int64)
+        order = np.argsort(rows, kind='stable')
+        indptr = np.zeros(n_rows+1, dtype=np.int64)
+        indptr[1:] = np.cumsum(np.bincount(rows, minlength=n_rows))
+        return cls(indptr, np.asarray(cols, dtype=np.int32)[order], np.asarray(values, dtype=IOU_DTYPE)[order], bg_thres)
+
+    @classmethod
+    def from_columns(cls, columns, bg_thres):
+        return cls(columns['indptr'], columns['indices'], columns['values'], bg_thres)
+
+    def columns(self):
+        return {'indptr': self.indptr, 'indices': self.indices, 'values': self.values}
+
+    def __len__(self):
+        return len(self.indptr) - 1
+
+    def coo(self):
+        """(row, col, iou) of all stored pairs"""
+        rows = np.repeat(np.arange(len(self), dtype=np.int64), np.diff(self.indptr))
+        return rows, np.asarray(self.indices), np.asarray(self.values)
+
+    def dense(self, start, end, n_cols):
+        """(end - start) * n_cols IoU matrix of rows [start, end), zeros where not stored"""
+        ret = np.zeros((end - start, n_cols))
+        s, e = self.indptr[start], self.indptr[end]
+        rows = np.repeat(np.arange(end - start), np.diff(self.indptr[start:end+1]))
+        ret[rows, self.indices[s:e]] = self.values[s:e]
+        return ret
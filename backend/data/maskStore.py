@@ -0,0 +1,151 @@
+import numpy as np
+import pycocotools.mask as mask_util
+
+# IoU computed beyond twice the possible pairs in a block of RLEMaskStore.iou,
+# about the overhead of one pycocotools call
+BLOCK_SLACK = 256
+
+
+def mask_iou_bound(dt_bbox, dt_area, gt_bbox, gt_area, iscrowd):
+    """upper bound of the mask IoU of each (dt, gt) pair from their bounding boxes (x, y, w, h) and areas
+
+    The mask intersection is at most the box intersection and the smaller area, and the IoU
+    grows with the intersection. For iscrowd gt the IoU is intersection / dt area, as in pycocotools.
+    """
+    dt_bbox, gt_bbox = np.asarray(dt_bbox, dtype=np.float64), np.asarray(gt_bbox, dtype=np.float64)
+    dt_area, gt_area = np.asarray(dt_area, dtype=np.float64)[:, None], np.asarray(gt_area, dtype=np.float64)[None]
+    w = np.minimum(dt_bbox[:, None, 0] + dt_bbox[:, None, 2], gt_bbox[None, :, 0] + gt_bbox[None, :, 2]) - np.maximum(dt_bbox[:, None, 0], gt_bbox[None, :, 0])
+    h = np.minimum(dt_bbox[:, None, 1] + dt_bbox[:, None, 3], gt_bbox[None, :, 1] + gt_bbox[None, :, 3]) - np.maximum(dt_bbox[:, None, 1], gt_bbox[None, :, 1])
+    inter = np.minimum(np.clip(w, 0, None) * np.clip(h, 0, None), np.minimum(dt_area, gt_area))
+    union = np.where(np.asarray(iscrowd)[None] == 1, dt_area, dt_area + gt_area - inter)
+    # no rounding of the bound may drop a pair pycocotools puts just above the threshold
+    return inter / np.maximum(union, 1e-9) + 1e-9
+
+
+def pair_blocks(possible, order):
+    """(rows, cols) blocks covering the possible pairs, taking the rows with any in the given order
+
+    A block grows while its rows * cols stay within twice its possible pairs plus BLOCK_SLACK,
+    so the IoU computed scales with the possible pairs and not with all rows * all cols.
+    """
+    row_pairs = np.count_nonzero(possible, axis=1)
+    blocks = []
+    rows, cols, n_pairs = [], np.zeros(possible.shape[1], dtype=bool), 0
+    for i in np.asarray(order)[row_pairs[order] > 0]:
+        grown = cols | possible[i]
+        grown_pairs = n_pairs + row_pairs[i]
+        if len(rows) > 0 and (len(rows) + 1) * np.count_nonzero(grown) > 2 * grown_pairs + BLOCK_SLACK:
+            blocks.append((np.array(rows), np.flatnonzero(cols)))
+            rows, grown, grown_pairs = [], possible[i].copy(), row_pairs[i]
+        rows.append(i)
+        cols, n_pairs = grown, grown_pairs
+    if len(rows) > 0:
+        blocks.append((np.array(rows), np.flatnonzero(cols)))
+    return blocks
+
+
+class RLEMaskStore(object):
+    """compressed RLE masks of one side (labels or predicts) in one contiguous buffer
+
+    The counts of mask i are data[offsets[i]:offsets[i+1]], its size (h, w) is sizes[i].
+    All arrays can be memory-mapped from the buffer; area and bbox of every mask are
+    computed once and kept next to the counts.
+    Slicing with [start:end] returns a store sharing the same buffers.
+    """
+
+    def __init__(self, data, offsets, sizes, area=None, bbox=None):
+        self.data = data
+        self.offsets = offsets
+        self.sizes = sizes
+        self._area = area
+        self._bbox = bbox
+
+    @classmethod
+    def from_strings(cls, strings, sizes):
+        """build from a list of counts strings and the (h, w) of each mask"""
+        encoded = [s.encode('utf-8') if isinstance(s, str) else s for s in strings]
+        offsets = np.zeros(len(encoded)+1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(s) for s in encoded])
+        data = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+        return cls(data, offsets, np.asarray(sizes).astype(np.int32).reshape(-1, 2))
+
+    @classmethod
+    def from_columns(cls, columns, prefix):
+        return cls(columns[prefix + '_data'], columns[prefix + '_offsets'], columns[prefix + '_sizes'],
+                   columns.get(prefix + '_area'), columns.get(prefix + '_bbox'))
+
+    def columns(self, prefix):
+        """buffer columns of the store, area and bbox included"""
+        # offsets of a sliced store do not start at 0
+        base = self.offsets[0]
+        return {
+            prefix + '_data': self.data[base:self.offsets[-1]],
+            prefix + '_offsets': self.offsets - base,
+            prefix + '_sizes': self.sizes,
+            prefix + '_area': self.area(),
+            prefix + '_bbox': self.bbox(),
+        }
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def counts(self, i):
+        return self.data[self.offsets[i]:self.offsets[i+1]].tobytes()
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            start, stop, step = i.indices(len(self))
+            assert step == 1, "only contiguous slices of masks are supported"
+            return RLEMaskStore(self.data, self.offsets[start:stop+1], self.sizes[start:stop],
+                                None if self._area is None else self._area[start:stop],
+                                None if self._bbox is None else self._bbox[start:stop])
+        return self.counts(i).decode('utf-8')
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def rle(self, i):
+        h, w = self.sizes[i]
+        return {'size': [int(h), int(w)], 'counts': self.counts(i)}
+
+    def rles(self):
+        # one chunk of bytes for the whole store, split without per-mask array slicing
+        base = self.offsets[0]
+        chunk = self.data[base:self.offsets[-1]].tobytes()
+        offsets = (self.offsets - base).tolist()
+        sizes = self.sizes.tolist()
+        return [{'size': sizes[i], 'counts': chunk[offsets[i]:offsets[i+1]]} for i in range(len(self))]
+
+    def area(self):
+        if self._area is None:
+            self._area = mask_util.area(self.rles()) if len(self) > 0 else np.zeros(0, dtype=np.uint32)
+        return self._area
+
+    def bbox(self):
+        """x, y, w, h in pixels"""
+        if self._bbox is None:
+            self._bbox = mask_util.toBbox(self.rles()) if len(self) > 0 else np.zeros((0, 4))
+        return self._bbox
+
+    def iou(self, gt, iscrowd, bg_thres=None):
+        """len(self) * len(gt) IoU matrix against the masks of another store
+
+        With bg_thres, the IoU is only computed for pairs whose bounding boxes allow an IoU
+        above bg_thres, the others are left 0.
+        """
+        if bg_thres is None:
+            return mask_util.iou(self.rles(), gt.rles(), iscrowd)
+        iscrowd = np.asarray(iscrowd)
+        ret = np.zeros((len(self), len(gt)))
+        possible = mask_iou_bound(self.bbox(), self.area(), gt.bbox(), gt.area(), iscrowd) > bg_thres
+        dts, gts = self.rles(), gt.rles()
+        # predicts by box center x, so that a block holds predicts overlapping the same labels
+        bbox = self.bbox()
+        for rows, cols in pair_blocks(possible, np.argsort(bbox[:, 0] + bbox[:, 2] / 2, kind='stable')):
+            ious = mask_util.iou([dts[i] for i in rows], [gts[j] for j in cols], iscrowd[cols])
+            ret[np.ix_(rows, cols)] = np.where(possible[np.ix_(rows, cols)], ious, 0)
+        return ret
+
+    def decode(self, i):
+        return mask_util.decode(self.rle(i))
@@ -0,0 +1,151 @@
+import numpy as np
+
+
+def match_image(pr_cat, pr_conf, gt_cat, gt_iscrowd, iou_pair, pos_thres, conf_thres, bg_thres=0.1, max_det=100):
+    """match the predictions and labels of one image
+
+    Gives the same (pairs, ious, types) as the original per-prediction matching, kept in
+    tests/test_matching.py, but writes into preallocated outputs and replaces the rescans of
+    all pairs for each gt by one grouping of the pairs by gt.
+    Sorts that may break ties are done on the same arrays as in the reference, so ties are resolved
+    the same way.
+
+    Args:
+        pr_cat, pr_conf: category and confidence of each prediction
+        gt_cat, gt_iscrowd: category and iscrowd flag of each label
+        iou_pair (np.ndarray): n_pr * n_gt IoU
+    Returns:
+        pairs (np.ndarray): k * 2 (predict, label) local indexes, -1 if unmatched
+        ious (np.ndarray): k IoU of each pair
+        types (np.ndarray): k type of each pair
+    """
+    n_pr, n_gt = len(pr_cat), len(gt_cat)
+    pr_idx = np.where(pr_conf > conf_thres)[0]
+    pr_idx = pr_idx[np.argsort(-pr_conf[pr_idx])]
+    # at most max_det predictions of each category, counted in confidence order
+    if len(pr_idx) > max_det:
+        cats = pr_cat[pr_idx]
+        cat_order = np.argsort(cats, kind='stable')
+        sorted_cats = cats[cat_order]
+        rank = np.empty(len(pr_idx), dtype=np.int64)
+        rank[cat_order] = np.arange(len(pr_idx)) - np.searchsorted(sorted_cats, sorted_cats, side='left')
+        pr_idx = pr_idx[rank < max_det]
+
+    # one slot per prediction in matching order, Bkgd unless matched below, ignored slots are dropped
+    n_slots = len(pr_idx)
+    ret_match = np.empty((n_slots + n_gt, 2), dtype=np.int32)
+    ret_ious = np.zeros(n_slots + n_gt, dtype=np.float64)
+    ret_type = np.full(n_slots + n_gt, 9, dtype=np.int32) # Bkgd
+    ret_match[:n_slots, 0] = pr_idx
+    ret_match[:n_slots, 1] = -1
+    keep = np.ones(n_slots + n_gt, dtype=bool)
+
+    gt_match_cnt = np.zeros_like(gt_cat)
+    gt_find_tp = np.zeros(n_gt, dtype=bool)
+    is_crowd = gt_iscrowd == 1
+    not_crowd = gt_iscrowd == 0
+    if n_pr == 0 or n_gt == 0:
+        # pycocotools returns an empty list instead of an n_pr * 0 matrix
+        possible_all = np.zeros((n_pr, n_gt), dtype=bool)
+    else:
+        possible_all = np.asarray(iou_pair) > bg_thres
+    # predictions without any overlapping gt stay Bkgd and do not change the matching state
+    for slot in np.flatnonzero(possible_all[pr_idx].any(axis=1)) if n_slots > 0 else []:
+        _pr_idx = pr_idx[slot]
+        row = iou_pair[_pr_idx]
+        possible_match_gt = np.flatnonzero(possible_all[_pr_idx])
+        same = gt_cat[possible_match_gt] == pr_cat[_pr_idx]
+        same_cat_gt = possible_match_gt[same]
+        if len(same_cat_gt) > 0:
+            same_cat_gt = same_cat_gt[np.argsort(-row[same_cat_gt])]
+            not_is_crowd_match = same_cat_gt[not_crowd[same_cat_gt]]
+            find_TP_match = False
+            if len(not_is_crowd_match) > 0:
+                # the highest IoU gt above pos_thres that has no TP yet,
+                # compared as scalars like the reference, numpy < 2 promotes scalars and arrays differently
+                for _gt in not_is_crowd_match:
+                    if row[_gt] < pos_thres:
+                        break
+                    if not gt_find_tp[_gt]:
+                        find_TP_match = True
+                        best_match = _gt
+                        gt_find_tp[_gt] = True
+                        break
+                if not find_TP_match:
+                    best_match = not_is_crowd_match[np.argmax(
+                        row[not_is_crowd_match] + np.exp(-gt_match_cnt[not_is_crowd_match])
+                    )]
+            if not find_TP_match:
+                # if cannot find TP match and can match with iscrowd object, ignore
+                is_crowd_match = same_cat_gt[is_crowd[same_cat_gt]]
+                if len(is_crowd_match) > 0 and row[is_crowd_match[0]] >= pos_thres:
+                    keep[slot] = False
+                    continue
+            if len(not_is_crowd_match) > 0:
+                gt_match_cnt[best_match] += 1
+                ret_match[slot, 1], ret_ious[slot] = best_match, row[best_match]
+                # mark as Dup here, will edit the one with largest confidence to TP
+                ret_type[slot] = 5 if row[best_match] >= pos_thres else 7
+                continue
+        diff_cat_gt = possible_match_gt[~same]
+        diff_cat_gt = diff_cat_gt[not_crowd[diff_cat_gt]]
+        if len(diff_cat_gt) > 0:
+            # match only one Cls error
+            best_match = diff_cat_gt[np.argmax(
+                row[diff_cat_gt] + np.exp(-gt_match_cnt[diff_cat_gt])
+            )]
+            gt_match_cnt[best_match] += 1
+            ret_match[slot, 1], ret_ious[slot] = best_match, row[best_match]
+            ret_type[slot] = 6 if row[best_match] >= pos_thres else 8
+        # otherwise matched only with iscrowd gt below pos_thres, stays Bkgd
+    n = n_slots
+
+    # pairs of each gt, in matching order
+    matched_gt = ret_match[:n, 1]
+    has_gt = np.flatnonzero((matched_gt != -1) & keep[:n])
+    gt_rows = has_gt[np.argsort(matched_gt[has_gt], kind='stable')]
+    gt_bounds = np.searchsorted(matched_gt[gt_rows], np.arange(n_gt + 1), side='left')
+    # if not matched as TP, Loc or Cls, consider as Miss (even if matched as Cls+Loc)
+    found = np.zeros(n_gt, dtype=bool)
+    found[matched_gt[has_gt[ret_type[has_gt] != 8]]] = True
+    missed = np.flatnonzero(not_crowd & ~found)
+    ret_match[n:n+len(missed), 0] = -1
+    ret_match[n:n+len(missed), 1] = missed
+    ret_ious[n:n+len(missed)] = 0
+    ret_type[n:n+len(missed)] = 10 # Miss
+    n += len(missed)
+
+    for _gt_idx in np.flatnonzero(not_crowd):
+        rows = gt_rows[gt_bounds[_gt_idx]:gt_bounds[_gt_idx+1]]
+        if len(rows) == 0:
+            continue
+        prs, types = ret_match[rows, 0], ret_type[rows]
+        # select only one Non-Dup pair for each gt
+        # in the order [TP, Loc, Cls, Loc+Cls]
+        for rt in [5, 7, 6, 8]:
+            is_rt = types == rt
+            if np.any(is_rt):
+                match_prs = prs[is_rt]
+                best = np.flatnonzero(is_rt)[np.argsort(-pr_conf[match_prs])[0]]
+                # edit type of best_match to non-dup type by minus 4
+                types[best] = rt - 4
+                break
+        # select one non-dup pair for each pr cat
+        row_cats = pr_cat[prs]
+        for _cat in np.unique(row_cats):
+            if _cat == gt_cat[_gt_idx]:
+                continue
+            is_cat = row_cats == _cat
+            # if has been matched in a non-dup pair, continue
+            if np.any(types[is_cat] <= 4):
+                continue
+            for rt, new_type in [(6, 11), (8, 12)]:
+                is_rt = is_cat & (types == rt)
+                if np.any(is_rt):
+                    best = np.flatnonzero(is_rt)[np.argsort(-pr_conf[prs[is_rt]])[0]]
+                    types[best] = new_type
+                    break
+        ret_type[rows] = types
+
+    keep[n:] = False
+    return ret_match[keep], ret_ious[keep], ret_type[keep]
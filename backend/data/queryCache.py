@@ -0,0 +1,89 @@
+import numpy as np
+from data.thresholdCache import ThresholdCache
+
+
+def canonical_query(query, range_features, ordered=()):
+    """hashable form of a range tree query, the same for queries that select the same pairs
+
+    Ranges are rounded to float32 like the values in the tree, value lists are sorted and deduplicated
+    except those in ordered, whose order gives the rows or columns of the result.
+    """
+    items = []
+    for name, values in sorted(query.items()):
+        if name in range_features:
+            values = tuple(float(np.float32(v)) for v in values)
+        elif name in ordered:
+            values = tuple(float(v) for v in values)
+        else:
+            values = tuple(sorted(set(float(v) for v in values)))
+        items.append((name, values))
+    return tuple(items)
+
+
+def canonical_arg(arg, range_features, ordered=()):
+    """hashable form of an argument of a range tree query, dicts of value lists are queries"""
+    if isinstance(arg, dict):
+        if all(isinstance(value, (list, tuple)) for value in arg.values()):
+            return canonical_query(arg, range_features, ordered)
+        return tuple(sorted((name, canonical_arg(value, range_features)) for name, value in arg.items()))
+    if isinstance(arg, (list, tuple)):
+        return tuple(canonical_arg(value, range_features) for value in arg)
+    if isinstance(arg, (float, np.floating)):
+        return float(arg)
+    return arg
+
+
+def freeze(result):
+    """read-only result and its size in bytes, cached results are shared between requests"""
+    if isinstance(result, np.ndarray):
+        result.flags.writeable = False
+        return result, result.nbytes
+    if isinstance(result, (list, tuple)):
+        frozen = [freeze(value) for value in result]
+        return tuple(value for value, _ in frozen), sum(nbytes for _, nbytes in frozen) + 8 * len(frozen)
+    if hasattr(result, 'nbytes'):
+        return result, result.nbytes
+    return result, 8
+
+
+class QueryCache(ThresholdCache):
+    """memory-bounded LRU of range tree query results
+
+    Keys are (threshold key, method, canonical arguments). Identical queries running at the same time
+    are computed once. Results are frozen: arrays are read-only and lists are tuples.
+    """
+
+    def __init__(self, max_bytes):
+        super().__init__(max_bytes)
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, compute):
+        computed = []
+
+        def counted():
+            computed.append(True)
+            return freeze(compute())
+        value = super().get(key, counted)
+        with self.lock:
+            if computed:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return value
+
+    def invalidate(self, threshold_key):
+        """drop the results of the trees of one (iou_thres, conf_thres)"""
+        with self.lock:
+            for key in [key for key in self.entries if key[0] == threshold_key]:
+                _, nbytes = self.entries.pop(key)
+                self.nbytes -= nbytes
+
+    def stats(self):
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'entries': len(self.entries),
+                'bytes': self.nbytes,
+            }
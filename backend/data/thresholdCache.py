@@ -0,0 +1,61 @@
+import threading
+from collections import OrderedDict
+
+
+class ThresholdCache(object):
+    """memory-bounded LRU of the results computed for one (iou_thres, conf_thres)
+
+    Pinned entries (computed at start-up) are never evicted and do not count against max_bytes.
+    A request for a key that is being computed by another thread waits for that result
+    instead of computing it again.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.entries = OrderedDict() # key => (value, nbytes)
+        self.pinned = {}
+        self.pending = {} # key => threading.Event
+        self.lock = threading.Lock()
+
+    def pin(self, key, value):
+        with self.lock:
+            self.pinned[key] = value
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.pinned or key in self.entries
+
+    def keys(self):
+        with self.lock:
+            return list(self.pinned.keys()) + list(self.entries.keys())
+
+    def get(self, key, compute):
+        """value of key, compute() => (value, nbytes) is called on a miss"""
+        while True:
+            with self.lock:
+                if key in self.pinned:
+                    return self.pinned[key]
+                if key in self.entries:
+                    self.entries.move_to_end(key)
+                    return self.entries[key][0]
+                event = self.pending.get(key)
+                if event is None:
+                    event = self.pending[key] = threading.Event()
+                    break
+            # computed by another request, check again when done
+            event.wait()
+        try:
+            value, nbytes = compute()
+            with self.lock:
+                self.entries[key] = (value, nbytes)
+                self.nbytes += nbytes
+                # evict least recently used entries, keep at least the new one
+                while self.nbytes > self.max_bytes and len(self.entries) > 1:
+                    _, (_, evicted_bytes) = self.entries.popitem(last=False)
+                    self.nbytes -= evicted_bytes
+            return value
+        finally:
+            with self.lock:
+                del self.pending[key]
+            event.set()
@@ -151,6 +151,11 @@ def classStatistics():
         query = request.json['query']
     return jsonify(dataCtrler.getClassStatistics(query))
 
+@app.route('/api/queryCacheStats', methods=["POST"])
+def queryCacheStats():
+    dataCtrler = dataCtrlerChoose(request)
+    return jsonify(dataCtrler.getQueryCacheStats())
+
 @app.route('/api/slices', methods=["POST"])
 def problematicSlices():
     dataCtrler = dataCtrlerChoose(request)
@@ -166,7 +171,7 @@ def showSlice():
     query = None
     if 'query' in request.json:
         query = request.json['query']
-    return jsonify(dataCtrler.filterSamples(query))
+    return jsonify(dataCtrler.filterSamples(query).tolist())
 
 def main():
     global trainDataCtrler, validDataCtrler, singleValidGrid, singleTrainGrid, combinedValidGrid, combinedTrainGrid
@@ -176,6 +181,12 @@ def main():
     parser.add_argument("--port", type=int, default=5010)
     parser.add_argument("--seg", action='store_true')
     parser.add_argument("--dataName", type=str, default="")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--feature_dtype", type=str, default="float32", choices=["float32", "float16"])
+    parser.add_argument("--threshold_cache_mb", type=int, default=1024)
+    parser.add_argument("--query_threads", type=int, default=1)
+    parser.add_argument("--query_cache_mb", type=int, default=256)
+    parser.add_argument("--approx_sample_pairs", type=int, default=200000)
     args = parser.parse_args()
 
     trainDataPath = os.path.join(args.dataPath, "train_data")
@@ -187,12 +198,16 @@ def main():
 
     if os.path.exists(trainDataPath):
         trainBufferPath = os.path.join(trainDataPath, "buffer")
-        trainDataCtrler.process(trainDataPath, trainBufferPath, segmentation=args.seg)
+        trainDataCtrler.process(trainDataPath, trainBufferPath, segmentation=args.seg, workers=args.workers, feature_dtype=args.feature_dtype,
+            threshold_cache_mb=args.threshold_cache_mb, query_threads=args.query_threads,
+            query_cache_mb=args.query_cache_mb, approx_sample_pairs=args.approx_sample_pairs)
         singleTrainGrid = GridInteraction(trainDataCtrler)
 
     if os.path.exists(validDataPath):
         validBufferPath = os.path.join(validDataPath, "buffer")
-        validDataCtrler.process(validDataPath, validBufferPath, segmentation=args.seg)
+        validDataCtrler.process(validDataPath, validBufferPath, segmentation=args.seg, workers=args.workers, feature_dtype=args.feature_dtype,
+            threshold_cache_mb=args.threshold_cache_mb, query_threads=args.query_threads,
+            query_cache_mb=args.query_cache_mb, approx_sample_pairs=args.approx_sample_pairs)
         singleValidGrid = GridInteraction(validDataCtrler)
 
     # combinedValidGrid = GridInteraction(validDataCtrler, trainDataCtrler)
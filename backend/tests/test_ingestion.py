@@ -0,0 +1,38 @@
+import json
+
+import numpy as np
+import pytest
+
+from data.ingestion import BulkAnnotationReader
+
+
+def image_sizes():
+    # (width, height) of images a and b, as read from the image files
+    return np.array([100, 200]), np.array([50, 80])
+
+
+@pytest.mark.parametrize('segmentation', [False, True])
+def test_results_list_takes_sizes_of_image_files(tmp_path, segmentation):
+    # a COCO results list has no images section, e.g. next to per-image label files
+    anns = [
+        {'image_id': 'b', 'category_id': 1, 'bbox': [10, 20, 30, 40], 'score': 0.9,
+         'segmentation': [[10, 20, 40, 20, 40, 60, 10, 60]]},
+        {'image_id': 'a', 'category_id': 2, 'bbox': [0, 0, 50, 50], 'score': 0.5,
+         'segmentation': {'size': [50, 100], 'counts': 'PPYo1'}},
+    ]
+    path = str(tmp_path / 'predicts.json')
+    with open(path, 'w') as f:
+        json.dump(anns, f)
+    image2index, classID2Idx = {'a': 0, 'b': 1}, {1: 0, 2: 1, -1: 2}
+    with pytest.raises(ValueError):
+        BulkAnnotationReader(image2index, classID2Idx, segmentation).read(path, predict=True)
+    raw, raw2imageid, imageid2raw, masks = \
+        BulkAnnotationReader(image2index, classID2Idx, segmentation, image_sizes).read(path, predict=True)
+    assert raw2imageid.tolist() == [0, 1]
+    if segmentation:
+        # im_h, im_w of each mask
+        assert raw[:, 2:4].tolist() == [[50, 100], [80, 200]]
+        assert len(masks) == 2
+    else:
+        # normalized cx, cy, w, h
+        np.testing.assert_allclose(raw[:, 2:], [[0.25, 0.5, 0.5, 1], [0.125, 0.5, 0.15, 0.5]])
@@ -0,0 +1,21 @@
+import numpy as np
+import pytest
+
+from data.iouStore import SparseIoUStore, sparse_iou
+from data.matching import match_image
+
+
+@pytest.mark.parametrize('pos_thres', [0.5, 0.55, 0.6, 0.65, 0.7, 0.75, 0.8, 0.85, 0.9, 0.95])
+def test_iou_equal_to_threshold_matches(pos_thres):
+    # an IoU of exactly pos_thres, as from intersection / union of integer areas, is a TP
+    iou = round(pos_thres * 100) / 100
+    assert iou >= pos_thres
+    rows, cols, values = sparse_iou(np.array([[iou]]), 0.1)
+    store = SparseIoUStore.from_coo(1, rows, cols, values, 0.1)
+    iou_pair = store.dense(0, 1, 1)
+    assert iou_pair[0, 0] == iou
+    pairs, ious, types = match_image(np.array([0]), np.array([0.9]), np.array([0]), np.array([0]),
+                                     iou_pair, pos_thres, 0.05)
+    assert pairs.tolist() == [[0, 0]]
+    assert ious.tolist() == [iou]
+    assert types.tolist() == [1]
@@ -0,0 +1,150 @@
+import numpy as np
+import pytest
+
+from data.matching import match_image
+
+
+def match_image_reference(pr_cat, pr_conf, gt_cat, gt_iscrowd, iou_pair, pos_thres, conf_thres, bg_thres, max_det, n_cats):
+    """original per-prediction matching, kept as the reference of match_image"""
+    ret_ious = np.zeros(0)
+    ret_match = -1*np.ones((0, 2), dtype=np.int32)
+    # define type here
+    # -1 for ignored, 0 for abandoned;
+    # 1~4 for TP, Cls(confusion), Loc, and Cls+Loc
+    # 5~8 for Dup, Cls+Dup, Loc+Dup, and Cls+Loc+Dup
+    # 9 for Bkgd, 10 for Miss
+    # 11 for Cls+Dup (only one for each gt), 12 Cls+Loc+Dup (only one for each gt)
+    ret_type = np.zeros(0, dtype=np.int32)
+    pr_idx = np.where(pr_conf > conf_thres)[0]
+    pr_idx = pr_idx[np.argsort(-pr_conf[pr_idx])]
+    gt_match_cnt = np.zeros_like(gt_cat)
+    gt_find_tp = np.zeros_like(gt_cat)
+    cat_match_cnt = [0 for _ in range(n_cats)]
+    for _pr_idx in pr_idx:
+        cat_match_cnt[pr_cat[_pr_idx]] += 1
+        if cat_match_cnt[pr_cat[_pr_idx]] > max_det:
+            continue
+        possible_match_gt = np.where(iou_pair[_pr_idx, :]>bg_thres)[0]
+        if len(possible_match_gt) == 0:
+            ret_ious = np.concatenate((ret_ious, [0]))
+            ret_match = np.concatenate((ret_match, np.array([[_pr_idx, -1]])))
+            ret_type = np.concatenate((ret_type, [9])) # Bkgd
+            continue
+        same_cat_gt = possible_match_gt[gt_cat[possible_match_gt]==pr_cat[_pr_idx]]
+        find_TP_match = False
+        if len(same_cat_gt) > 0:
+            same_cat_gt = same_cat_gt[np.argsort(-iou_pair[_pr_idx, same_cat_gt])]
+            not_is_crowd_match = same_cat_gt[gt_iscrowd[same_cat_gt]==0]
+            is_crowd_match = same_cat_gt[gt_iscrowd[same_cat_gt]==1]
+            # first try match with not iscrowd gt
+            if len(not_is_crowd_match) > 0:
+                # select gt with largest IoU
+                for _gt in not_is_crowd_match:
+                    if iou_pair[_pr_idx, _gt] >= pos_thres:
+                        if gt_find_tp[_gt] == 0:
+                            find_TP_match = True
+                            best_match = _gt
+                            gt_find_tp[_gt] = 1
+                            break
+                    else:
+                        break
+                if not find_TP_match:
+                    best_match = not_is_crowd_match[np.argmax(
+                        iou_pair[_pr_idx, not_is_crowd_match] + np.exp(-gt_match_cnt[not_is_crowd_match])
+                    )]
+            # if cannot match with not iscrowd gt, try if can match with iscrowd gt
+            if not find_TP_match and len(is_crowd_match) > 0:
+                # if cannot find TP match and can match with iscrowd object, ignore
+                if iou_pair[_pr_idx, is_crowd_match[0]] >= pos_thres:
+                    continue
+            if len(not_is_crowd_match) > 0:
+                gt_match_cnt[best_match] += 1
+                ret_ious = np.concatenate((ret_ious, [iou_pair[_pr_idx, best_match]]))
+                ret_match = np.concatenate((ret_match, np.array([[_pr_idx, best_match]])))
+                if iou_pair[_pr_idx, best_match] >= pos_thres:
+                    # mark as Dup here, will edit the one with largest confidence to TP
+                    ret_type = np.concatenate((ret_type, [5]))
+                else:
+                    ret_type = np.concatenate((ret_type, [7])) # Loc
+                continue # if found TP match, do not match Cls error
+        diff_cat_gt = possible_match_gt[gt_cat[possible_match_gt]!=pr_cat[_pr_idx]]
+        diff_cat_gt = diff_cat_gt[gt_iscrowd[diff_cat_gt]==0]
+        if len(diff_cat_gt) > 0:
+            # match only one Cls error
+            best_match = diff_cat_gt[np.argmax(
+                iou_pair[_pr_idx, diff_cat_gt] + np.exp(-gt_match_cnt[diff_cat_gt])
+            )]
+            gt_match_cnt[best_match] += 1
+            ret_ious = np.concatenate((ret_ious, [iou_pair[_pr_idx, best_match]]))
+            ret_match = np.concatenate((ret_match, np.array([[_pr_idx, best_match]])))
+            if iou_pair[_pr_idx, best_match] >= pos_thres:
+                ret_type = np.concatenate((ret_type, [6])) # Cls
+            else:
+                ret_type = np.concatenate((ret_type, [8])) # Cls+Loc
+            continue
+        # some pr may be matched with iscrowd gt, but did not reach a large enough iou, cannot be processed above
+        ret_ious = np.concatenate((ret_ious, [0]))
+        ret_match = np.concatenate((ret_match, np.array([[_pr_idx, -1]])))
+        ret_type = np.concatenate((ret_type, [9])) # Bkgd
+
+    for _gt_idx in np.where(gt_iscrowd==0)[0]:
+        # if not matched as TP, Loc or Cls, consider as Miss (even if matched as Cls+Loc)
+        if _gt_idx not in ret_match[ret_type!=8,1]:
+            ret_ious = np.concatenate((ret_ious, [0]))
+            ret_match = np.concatenate((ret_match, np.array([[-1, _gt_idx]])))
+            ret_type = np.concatenate((ret_type, [10])) # Miss
+        gtm_pr_list = (ret_match[:, 1]==_gt_idx) & (ret_match[:, 0]!=-1)
+        # select only one Non-Dup pair for each gt
+        # in the order [TP, Loc, Cls, Loc+Cls]
+        for rt in [5, 7, 6, 8]:
+            match_prs = ret_match[np.logical_and(gtm_pr_list, ret_type==rt), 0]
+            if len(match_prs) > 0:
+                best_match = match_prs[np.argsort(-pr_conf[match_prs])[0]]
+                # edit type of best_match to non-dup type by minus 4
+                ret_type[np.logical_and(ret_match[:,0]==best_match, gtm_pr_list)] = rt - 4
+                break
+
+        # select one non-dup pair for each pr cat
+        if len(pr_cat) == 0:
+            continue
+        ret_pr_cat = pr_cat[ret_match[:, 0]]
+        gtm_pr_cat = np.unique(ret_pr_cat[gtm_pr_list])
+        for _cat in gtm_pr_cat:
+            if _cat == gt_cat[_gt_idx]:
+                continue
+            # if has been matched in a non-dup pair, continue
+            if np.any(ret_type[gtm_pr_list & (ret_pr_cat==_cat)]<=4):
+                continue
+            match_prs = ret_match[gtm_pr_list & (ret_type==6) & (ret_pr_cat==_cat), 0]
+            if len(match_prs) > 0:
+                best_match = match_prs[np.argsort(-pr_conf[match_prs])[0]]
+                # edit type of best_match to cls
+                ret_type[np.logical_and(ret_match[:,0]==best_match, gtm_pr_list)] = 11
+            else:
+                match_prs = ret_match[gtm_pr_list & (ret_type==8) & (ret_pr_cat==_cat), 0]
+                if len(match_prs) > 0:
+                    best_match = match_prs[np.argsort(-pr_conf[match_prs])[0]]
+                    # edit type of best_match to cls+loc
+                    ret_type[np.logical_and(ret_match[:,0]==best_match, gtm_pr_list)] = 12
+
+    return ret_match, ret_ious, ret_type
+
+
+@pytest.mark.parametrize("seed", range(3))
+def test_match_image_equals_reference(seed):
+    rng = np.random.default_rng(seed)
+    n_cats = 5
+    for trial in range(1000):
+        n_pr, n_gt = rng.integers(0, 60), rng.integers(0, 30)
+        if trial % 10 == 0:
+            n_pr = rng.integers(100, 400)
+        pr_cat = rng.integers(0, n_cats, n_pr).astype(np.int32)
+        pr_conf = np.round(rng.uniform(0, 1, n_pr), 2)
+        gt_cat = rng.integers(0, n_cats, n_gt).astype(np.int32)
+        gt_iscrowd = (rng.uniform(0, 1, n_gt) < 0.1).astype(np.int32)
+        iou_pair = np.round(rng.uniform(0, 1, (n_pr, n_gt)) ** 3, 2).astype(np.float32 if trial % 2 else np.float64)
+        args = (pr_cat, pr_conf, gt_cat, gt_iscrowd, iou_pair, rng.choice([0.5, 0.75]), 0.1, 0.1, int(rng.choice([100, 5])))
+        # the reference gives int32 only for images without pairs, match_image always
+        for expected, got, dtype in zip(match_image_reference(*args, n_cats), match_image(*args), (np.int32, np.float64, np.int32)):
+            assert got.dtype == dtype, trial
+            assert expected.shape == got.shape and np.array_equal(expected, got), trial